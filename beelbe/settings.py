@@ -13,8 +13,10 @@ https://docs.djangoproject.com/en/1.10/ref/settings/
 import datetime
 import logging.config
 import os
+import sys
 from pathlib import Path  # python3 only
 
+import django
 from django.utils.translation import ugettext_lazy as _
 from dotenv import load_dotenv, find_dotenv
 
@@ -64,12 +66,16 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # first, so that the queries of the other middleware are counted too
+    'experiments.middleware.ExperimentsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.locale.LocaleMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    # routes the live state of the session of the request to its database (see experiments.routers)
+    'experiments.middleware.SessionDatabaseMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -109,6 +115,48 @@ DATABASES = {
     }
 }
 
+# The live state of a session can be placed on another database (e.g. another local PostgreSQL instance) by adding
+# it here and setting its alias on the session (Session.database). When the session is finished, its rows are
+# copied back to the EXPERIMENTS_ARCHIVE_DATABASE (see experiments.routers and manage.py consolidate_sessions).
+DATABASE_ROUTERS = ['experiments.routers.SessionRouter']
+EXPERIMENTS_ARCHIVE_DATABASE = 'default'
+
+# Caches. The 'shared' cache is used by all the processes of the server (the versions of the experiment
+# configuration, the sessions of the participants and the reports of the watchdog). It is memcached when
+# EXPERIMENTS_MEMCACHED gives its address (e.g. 127.0.0.1:11211, requires pymemcache, or python-memcached before
+# Django 3.2), the database otherwise (create its table with manage.py createcachetable).
+if os.getenv('EXPERIMENTS_MEMCACHED'):
+    SHARED_CACHE = {
+        'BACKEND': 'django.core.cache.backends.memcached.{}'.format(
+            'PyMemcacheCache' if django.VERSION >= (3, 2) else 'MemcachedCache'),
+        'LOCATION': os.getenv('EXPERIMENTS_MEMCACHED'),
+    }
+else:
+    SHARED_CACHE = {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'experiments_cache',
+    }
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'shared': SHARED_CACHE,
+}
+
+# The server runs a single process, so the local memory caches are shared by all the requests
+EXPERIMENTS_SINGLE_PROCESS = False
+
+if sys.argv[1:2] == ['test']:
+    # the tests play the sharded sessions on a second database of the same server (see
+    # experiments.tests.test_routers), and run in a single process
+    EXPERIMENTS_SINGLE_PROCESS = True
+    DATABASES['sessions'] = dict(DATABASES['default'], TEST={
+        'NAME': 'test_{}_sessions'.format(DATABASES['default']['NAME'] or 'beelbe')})
+    CACHES['shared'] = {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'shared',
+    }
+
 # Password validation
 # https://docs.djangoproject.com/en/1.10/ref/settings/#auth-password-validators
 
@@ -128,11 +176,62 @@ AUTH_PASSWORD_VALIDATORS = [
 ]
 
 AUTHENTICATION_BACKENDS = [
+    # the participants can log in with the access code of the session (manage.py access_codes), it is checked
+    # before the password, which is much slower to verify
+    'experiments.auth.AccessCodeBackend',
     'experiments.auth.ExperimentsBackend',
     'django.contrib.auth.backends.ModelBackend',
 ]
 
-SESSION_ENGINE = "django.contrib.sessions.backends.db"
+# The sessions are kept in the SESSION_CACHE_ALIAS cache and written to the database when a key other than
+# the experiment state changes, or every EXPERIMENTS_SESSION_WRITE_INTERVAL seconds (see experiments.sessions).
+# The writes are only deferred with a memory cache shared by the processes (EXPERIMENTS_MEMCACHED): with the
+# database cache, the sessions are written directly to the database at every change, without the cache.
+SESSION_ENGINE = "experiments.sessions"
+SESSION_CACHE_ALIAS = 'shared'
+EXPERIMENTS_SESSION_WRITE_INTERVAL = 30
+
+# Group barrier (wait view). The notifier wakes up the participants blocked on the sync view
+# as soon as the last member of the group arrives. PostgresNotifier works across processes,
+# LocalNotifier can only be used when the server runs a single process.
+EXPERIMENTS_BARRIER_NOTIFIER = 'experiments.notifiers.PostgresNotifier'
+# Maximum number of seconds a sync request is held (keep it below the worker timeout). A held request
+# releases its database connections but keeps its worker thread, so the server must run threaded
+# workers with a thread per participant that can wait at the same time (see README.md).
+EXPERIMENTS_SYNC_TIMEOUT = 25
+# Backend of the group barriers (RequestMonitor). MemoryMonitorBackend keeps the barriers in memory
+# and writes them back to the database every EXPERIMENTS_MONITOR_FLUSH_INTERVAL seconds, it can
+# only be used when the server runs a single process.
+EXPERIMENTS_MONITOR_BACKEND = 'experiments.monitors.DatabaseMonitorBackend'
+EXPERIMENTS_MONITOR_FLUSH_INTERVAL = 1.0
+# Cache that holds the version of the experiment configuration (see experiments.config). Each process
+# compares its version with the shared one at most every EXPERIMENTS_CONFIG_TTL seconds, so the admin
+# changes reach every process after that delay.
+EXPERIMENTS_CONFIG_CACHE = 'shared'
+EXPERIMENTS_CONFIG_TTL = 2.0
+# The watchdog (manage.py watch_sessions) scans the barriers every EXPERIMENTS_WATCHDOG_INTERVAL seconds and
+# reports the barriers that don't open after EXPERIMENTS_WATCHDOG_STUCK_AFTER seconds. Its reports are stored
+# in the EXPERIMENTS_WATCHDOG_CACHE cache, where the server reads them to show them on the monitor.
+EXPERIMENTS_WATCHDOG_INTERVAL = 10
+EXPERIMENTS_WATCHDOG_STUCK_AFTER = 60
+EXPERIMENTS_WATCHDOG_CACHE = 'shared'
+# The monitor graph fetches the game data updated since its last refresh, and the rows updated in the
+# EXPERIMENTS_MONITOR_LAG seconds before it again, as they may have been committed later
+EXPERIMENTS_MONITOR_LAG = 10
+# Each request is logged as a JSON line on the experiments.metrics logger, and the metrics of the requests of the
+# last EXPERIMENTS_METRICS_WINDOW seconds are served on the monitor (monitor/metrics/)
+EXPERIMENTS_METRICS_WINDOW = 300
+# Processes that hash the passwords when the participants are added to a session (None: one per CPU)
+EXPERIMENTS_ENROLMENT_PROCESSES = None
+# Characters of the access codes of the participants (see experiments.auth.AccessCodeBackend). The codes of a
+# participant are not checked for EXPERIMENTS_ACCESS_CODE_LOCKOUT seconds after EXPERIMENTS_ACCESS_CODE_ATTEMPTS
+# wrong ones, counted in the EXPERIMENTS_ACCESS_CODE_CACHE cache
+EXPERIMENTS_ACCESS_CODE_LENGTH = 8
+EXPERIMENTS_ACCESS_CODE_ATTEMPTS = 10
+EXPERIMENTS_ACCESS_CODE_LOCKOUT = 300
+EXPERIMENTS_ACCESS_CODE_CACHE = 'shared'
+# Directory where experiments.toolkit.dbtools caches the tables of the finished sessions
+EXPERIMENTS_ANALYSIS_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'beelbe')
 
 # Internationalization
 # https://docs.djangoproject.com/en/1.10/topics/i18n/
@@ -208,6 +307,10 @@ logging.config.dictConfig({
             'level': 'ERROR',
             'propagate': True,
         },
+        # one JSON line per request (see experiments.middleware)
+        'experiments.metrics': {
+            'level': 'INFO',
+        },
         'beelbe': {
             'level': 'DEBUG',
             'handlers': ['console'],
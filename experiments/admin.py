@@ -3,14 +3,23 @@ from django.urls import reverse
 from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext_lazy as _
 
-from experiments.utils import export_as_csv
+from experiments import exports
+from experiments.utils import export_as_csv, export_as_parquet, export_as_arrow
 # Register your models here.
 from .models import (
     Player, Experiment, Session, RunNow, Treatment, Game,
     CollectiveRiskGame, Survey, Profile, RequestMonitor, Group, GameData, EndProbability, Instruction,
 )
 
-admin.site.register(Profile, admin.ModelAdmin)
+# Export actions of the experiment data (the columnar formats are only offered when pyarrow is installed)
+DATA_EXPORT_ACTIONS = [export_as_csv()] + ([export_as_parquet(), export_as_arrow()] if exports.pyarrow else [])
+
+
+class ProfileAdmin(admin.ModelAdmin):
+    actions = DATA_EXPORT_ACTIONS
+
+
+admin.site.register(Profile, ProfileAdmin)
 admin.site.register(Game, admin.ModelAdmin)
 # admin.site.register(CollectiveRiskGame, admin.ModelAdmin)
 admin.site.register(RunNow, admin.ModelAdmin)
@@ -77,7 +86,7 @@ class GameDataAdmin(admin.ModelAdmin):
     list_filter = [ExperimentFilter, SessionFilter, GroupFilter, 'round', 'player']
     search_fields = ['session', 'group', 'round', 'action', 'prediction_question']
     ordering = ('session', 'round', 'group',)
-    actions = [export_as_csv()]
+    actions = DATA_EXPORT_ACTIONS
 
     can_delete = False
 
@@ -115,7 +124,7 @@ admin.site.register(GameData, GameDataAdmin)
 
 
 class RequestMonitorAdmin(admin.ModelAdmin):
-    fields = ('name', 'var', 'condition', 'group', 'queue')
+    fields = ('name', 'phase', 'round', 'var', 'condition', 'group', 'queue')
 
     def session(self, obj):
         return obj.group.session
@@ -124,7 +133,7 @@ class RequestMonitorAdmin(admin.ModelAdmin):
         return obj.group.session.experiment
 
     list_display = ('experiment', 'session', 'group', 'name', 'var', 'condition',)
-    list_filter = ['group', 'name']
+    list_filter = ['group', 'phase', 'round']
     search_fields = ['name', 'group']
 
 
@@ -274,7 +283,8 @@ class SessionAdmin(admin.ModelAdmin):
     fieldsets = [
         (None, {'fields': ['session_number', 'session_metadata', 'scheduled_date']}),
         ('Experiment info', {'fields': ['experiment', 'treatment']}),
-        ('Advanced', {'fields': ['time_start', 'time_finish', 'finished', 'structure_assigned', 'group_size'],
+        ('Advanced', {'fields': ['time_start', 'time_finish', 'finished', 'structure_assigned', 'group_size',
+                                 'random_seed', 'database'],
                       'classes': ['collapse']}),
     ]
     inlines = [PlayerInLine, ]
@@ -422,7 +432,7 @@ class SurveyAdmin(admin.ModelAdmin):
     list_display = ('username', 'group_number', 'experiment', 'treatment', 'session',)
     list_filter = (ExperimentFilter, SessionFilter, 'gender', 'age', 'level_studies', 'profession',)
     search_fields = ['player__pk']
-    actions = [export_as_csv()]
+    actions = DATA_EXPORT_ACTIONS
 
 
 admin.site.register(Survey, SurveyAdmin)
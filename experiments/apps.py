@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class ExperimentsConfig(AppConfig):
     name = 'experiments'
     verbose_name = 'Web platform for behavioral economics experiments'
+
+    def ready(self):
+        # connect the signals that invalidate the configuration cache and copy the active flag of the users
+        # to the databases of the sessions
+        from . import config, routers  # noqa
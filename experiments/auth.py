@@ -1,22 +1,29 @@
+import base64
+import hashlib
+import hmac
+
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.backends import ModelBackend
+from django.core.cache import caches
 from django.core.exceptions import PermissionDenied
 from django.http import Http404
-from django.shortcuts import get_object_or_404
 from django.utils.translation import get_language
 
 from experiments.constants import Constants
-from .models import Session, Player, RunNow, Experiment
+from . import config, routers
+from .models import Session, Player, Profile, generate_access_key
 
 
 def authenticate(request, session_id, username="", password=""):
-    # Check if experiment on
-    run_now = RunNow.objects.all()[:1].get()
-    if not run_now.experiment_on:
+    # Check if the experiments session is correct and is being run
+    try:
+        run = config.get_run(session_id)
+        exp_session = config.get_session(int(session_id))
+    except (ValueError, Session.DoesNotExist):
+        raise Http404
+    if run is None or not run.experiment_on:
         raise Http404
-
-    # Check if the experiments session is correct
-    exp_session = get_object_or_404(Session, pk=session_id)
 
     return exp_session
 
@@ -73,35 +80,158 @@ class ExperimentsBackend(ModelBackend):
                 if user.is_superuser or user.is_staff:
                     return None
 
-                # second get run_now object
-                run_now = RunNow.objects.all()[:1].get()
-
-                experiment = Experiment.objects.get(pk=run_now.experiment_id)
-                exp_session = Session.objects.get(pk=run_now.session_id)
-                # Check if user is registered for the current experiment and session
-                if (user.player.experiment != experiment) or (user.player.session != exp_session) \
-                        or (user.player.session.treatment != exp_session.treatment) \
-                        or (not run_now.experiment_on):
+                # second get the run of the user's session
+                run = config.get_run(user.player.session_id) if user.player.session_id is not None else None
+                # Check if the session is being run and the user is registered for its experiment
+                if run is None or (not run.experiment_on) or (user.player.experiment_id != run.experiment_id):
                     raise PermissionDenied
-
-                # Check if user has a player associated
-                try:
-                    player = Player.objects.get(user=user, experiment=experiment, session=exp_session)
-                    if player.profile.finished or (player.profile.experiment_state == Constants.STATE_FINISH) or (
-                                player.group is None):
-                        raise PermissionDenied
-                except (KeyError, Player.DoesNotExist):
-                    # Create new entry in Participant table
-                    player = Player(user=user, experiment=experiment, session=exp_session)
-                    player.save()
-
-                # Setup experiment state if participant is new to the experiment
-                if not player.profile.participated:
-                    player.profile.experiment_state = Constants.STATE_LOGIN
-                    player.profile.language = get_language()
-                    player.profile.save()
-                    # Create a session entry for the participant
-                    request.session['experiment_state'] = Constants.STATE_LOGIN
-                    request.session.save()
+                experiment = config.get_experiment(run.experiment_id)
+                exp_session = config.get_session(run.session_id)
+
+                # the live state of the participant is on the database of the session
+                with routers.session_database(exp_session.pk):
+                    # Check if user has a player associated
+                    try:
+                        player = Player.objects.get(user=user, experiment=experiment, session=exp_session)
+                        if player.profile.finished or (player.profile.experiment_state == Constants.STATE_FINISH) or (
+                                    player.group is None):
+                            raise PermissionDenied
+                    except (KeyError, Player.DoesNotExist):
+                        # Create new entry in Participant table
+                        player = Player(user=user, experiment=experiment, session=exp_session)
+                        player.save()
+
+                    # Setup experiment state if participant is new to the experiment
+                    if not player.profile.participated:
+                        player.profile.experiment_state = Constants.STATE_LOGIN
+                        player.profile.language = get_language()
+                        player.profile.save()
+                        # Create a session entry for the participant
+                        if request is not None:
+                            request.session['experiment_state'] = Constants.STATE_LOGIN
+                if request is not None:
+                    request.session[routers.SESSION_KEY] = exp_session.pk
 
                 return user
+
+
+def get_access_code(session, username):
+    """
+    The access code of a participant is the HMAC-SHA256 of its username, keyed with the access key of the
+    session and the SECRET_KEY, encoded in base32 and truncated to EXPERIMENTS_ACCESS_CODE_LENGTH characters.
+    The codes are not stored, they can be computed again at any time and they all change with the access key.
+    :param session: Session object
+    :param username: username of the participant
+    :return: str - access code
+    """
+    key = hashlib.sha256("{}{}".format(settings.SECRET_KEY, session.access_key).encode()).digest()
+    digest = hmac.new(key, "{}:{}".format(session.pk, username).encode(), hashlib.sha256).digest()
+    return base64.b32encode(digest).decode()[:getattr(settings, 'EXPERIMENTS_ACCESS_CODE_LENGTH', 8)]
+
+
+def get_access_codes(session):
+    """:returns dict - access code of each active participant of the session, by username"""
+    usernames = Player.objects.filter(session=session, user__is_active=True).order_by('pk').values_list(
+        'user__username', flat=True)
+    return {username: get_access_code(session, username) for username in usernames}
+
+
+def rotate_access_key(session):
+    """Invalidates all the access codes of the session"""
+    session.access_key = generate_access_key()
+    session.save(update_fields=['access_key'])
+
+
+BASE32_ALPHABET = frozenset('ABCDEFGHIJKLMNOPQRSTUVWXYZ234567')
+
+
+def normalize_access_code(code):
+    # the codes are shown in groups of 4 characters, and base32 has no lower case letters
+    return code.replace('-', '').replace(' ', '').upper()
+
+
+def is_access_code(code):
+    """:returns bool - True if the (normalized) code has the shape of an access code: base32 characters only"""
+    return len(code) == getattr(settings, 'EXPERIMENTS_ACCESS_CODE_LENGTH', 8) and all(
+        c in BASE32_ALPHABET for c in code)
+
+
+def _failures_key(username):
+    return 'experiments:access_code:failures:{}'.format(username)
+
+
+def record_access_code_failure(username):
+    """Counts a wrong access code of the user (the count expires EXPERIMENTS_ACCESS_CODE_LOCKOUT seconds later)"""
+    cache = caches[getattr(settings, 'EXPERIMENTS_ACCESS_CODE_CACHE', 'shared')]
+    key = _failures_key(username)
+    if not cache.add(key, 1, getattr(settings, 'EXPERIMENTS_ACCESS_CODE_LOCKOUT', 300)):
+        try:
+            cache.incr(key)
+        except ValueError:
+            # expired in between
+            pass
+
+
+def is_access_code_locked(username):
+    """:returns bool - True if too many wrong access codes were given for the user"""
+    cache = caches[getattr(settings, 'EXPERIMENTS_ACCESS_CODE_CACHE', 'shared')]
+    return cache.get(_failures_key(username), 0) >= getattr(settings, 'EXPERIMENTS_ACCESS_CODE_ATTEMPTS', 10)
+
+
+class AccessCodeBackend(ModelBackend):
+    """
+    Authenticates the participants with the access code of their session instead of their password.
+    The code is checked with a keyed hash (see get_access_code) and the session and its run are read
+    from the configuration cache, so a login costs a single query (the user with its player and profile)
+    and no password hashing. When the code doesn't match, the next backend checks the password.
+    Passwords that don't have the shape of an access code are left to the next backend without any query.
+    After EXPERIMENTS_ACCESS_CODE_ATTEMPTS wrong codes, the codes of the user are not checked for
+    EXPERIMENTS_ACCESS_CODE_LOCKOUT seconds, so they can't be guessed.
+    The same conditions as ExperimentsBackend apply: the session must be on, and the participant must
+    be assigned to a group and not have finished the experiment.
+    """
+
+    def authenticate(self, request=None, username=None, password=None, **kwargs):
+        if not username or not password:
+            return None
+        code = normalize_access_code(password)
+        if not is_access_code(code) or is_access_code_locked(username):
+            return None
+        UserModel = get_user_model()
+        try:
+            user = UserModel._default_manager.select_related('player__profile').get(
+                **{UserModel.USERNAME_FIELD: username, 'player__session__isnull': False})
+        except UserModel.DoesNotExist:
+            return None
+        exp_session = config.get_session(user.player.session_id)
+        if not exp_session.access_key or not hmac.compare_digest(
+                code, get_access_code(exp_session, username)):
+            record_access_code_failure(username)
+            return None
+        if not self.user_can_authenticate(user) or user.is_superuser or user.is_staff:
+            return None
+
+        run = config.get_run(exp_session.pk)
+        if run is None or not run.experiment_on or user.player.experiment_id != run.experiment_id:
+            raise PermissionDenied
+
+        with routers.session_database(exp_session.pk) as database:
+            player = user.player
+            if database != routers.get_archive_database():
+                # the live state of the participant is on the database of the session
+                player = Player.objects.select_related('profile').get(pk=player.pk)
+            profile = player.profile
+            if profile.finished or profile.experiment_state == Constants.STATE_FINISH or player.group_id is None:
+                raise PermissionDenied
+
+            # Setup experiment state if participant is new to the experiment
+            if not profile.participated:
+                profile.experiment_state = Constants.STATE_LOGIN
+                profile.language = get_language()
+                Profile.objects.filter(pk=profile.pk).update(experiment_state=profile.experiment_state,
+                                                             language=profile.language)
+                if request is not None:
+                    request.session['experiment_state'] = Constants.STATE_LOGIN
+        if request is not None:
+            request.session[routers.SESSION_KEY] = exp_session.pk
+        return user
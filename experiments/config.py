@@ -0,0 +1,162 @@
+# coding=utf-8
+# ==============================================================================
+# beelbe
+# Copyright © 2016 Elias F. Domingos. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Process-wide cache of the configuration of the running experiments (RunNow, experiment,
+treatment, session and game rows). These rows don't change during a live session, so the
+participant requests read them from memory instead of querying the database. Several sessions
+can be run at the same time, the run state of each one is read with get_run(session_id) from the
+session of the participant.
+
+The cache is versioned: every save or delete of a configuration row (e.g. from the admin)
+increments a version counter stored in the Django cache selected by the
+EXPERIMENTS_CONFIG_CACHE setting, which is shared by all the processes. Each process compares
+its local version with the shared one at most every EXPERIMENTS_CONFIG_TTL seconds and drops
+its rows when they differ, so a change reaches every process after that delay (the process
+that made it drops its rows at once). Changes done with QuerySet.update() don't send signals,
+so they must call invalidate() explicitly.
+"""
+
+# import the logging library
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+
+from .models import RunNow, Experiment, Treatment, Session, Game, CollectiveRiskGame
+
+# Get an instance of a logger
+logger = logging.getLogger(__name__)
+
+VERSION_KEY = 'experiments:config:version'
+CONFIG_MODELS = (RunNow, Experiment, Treatment, Session, Game, CollectiveRiskGame)
+
+_lock = threading.Lock()
+_rows = {}
+_version = None
+# time of the last comparison with the shared version
+_checked = 0.0
+
+
+def _shared_cache():
+    return caches[getattr(settings, 'EXPERIMENTS_CONFIG_CACHE', 'shared')]
+
+
+def is_shared_cache(alias):
+    """
+    :returns bool - False if the cache is private to the process (local memory or dummy cache), unless the
+             server runs a single process (EXPERIMENTS_SINGLE_PROCESS, e.g. runserver or the tests)
+    """
+    if getattr(settings, 'EXPERIMENTS_SINGLE_PROCESS', False):
+        return True
+    return not isinstance(caches[alias], (LocMemCache, DummyCache))
+
+
+def _get(key, load):
+    """
+    :param key: (model, pk) of the row
+    :param load: callable that reads the row from the database
+    :return: cached row
+    """
+    global _rows, _version, _checked
+    now = time.monotonic()
+    if now - _checked >= getattr(settings, 'EXPERIMENTS_CONFIG_TTL', 2.0):
+        shared = _shared_cache().get(VERSION_KEY, 0)
+        with _lock:
+            _checked = now
+            if shared != _version:
+                _rows, _version = {}, shared
+    with _lock:
+        version = _version
+        try:
+            return _rows[key]
+        except KeyError:
+            pass
+    row = load()
+    with _lock:
+        # don't store rows read while the cache was being invalidated
+        if version == _version:
+            _rows[key] = row
+    return row
+
+
+def get_run_now():
+    """:returns RunNow - the first run (the session shown by default on the admin pages)"""
+    return _get((RunNow, None), lambda: RunNow.objects.order_by('pk')[:1].get())
+
+
+def get_run(session_id):
+    """:returns RunNow - run state of the session, None if the session is not being run"""
+    session_id = int(session_id)
+    return _get((RunNow, session_id), lambda: RunNow.objects.filter(session_id=session_id).first())
+
+
+def get_runs():
+    """:returns list - RunNow of the sessions that are on"""
+    return _get((RunNow, 'on'), lambda: list(RunNow.objects.filter(experiment_on=True).order_by('pk')))
+
+
+def get_experiment(experiment_id):
+    return _get((Experiment, experiment_id), lambda: Experiment.objects.get(pk=experiment_id))
+
+
+def get_treatment(treatment_id):
+    return _get((Treatment, treatment_id), lambda: Treatment.objects.get(pk=treatment_id))
+
+
+def get_session(session_id):
+    return _get((Session, session_id), lambda: Session.objects.get(pk=session_id))
+
+
+def get_game(game_id):
+    """:returns CollectiveRiskGame - parameters of the game (threshold, endowment, rounds, risk_prob...)"""
+    return _get((CollectiveRiskGame, game_id), lambda: CollectiveRiskGame.objects.get(pk=game_id))
+
+
+def get_session_game(session_id):
+    """:returns CollectiveRiskGame - game played on the session"""
+    return get_game(get_treatment(get_session(session_id).treatment_id).game_id)
+
+
+def invalidate():
+    """Drops the cached rows on every process"""
+    global _rows, _version, _checked
+    cache = _shared_cache()
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.set(VERSION_KEY, 1, None)
+    with _lock:
+        _rows, _version, _checked = {}, None, 0.0
+
+
+def invalidate_config(sender, **kwargs):
+    logger.debug("{} modified, invalidating the configuration cache".format(sender.__name__))
+    invalidate()
+    # a process could have read the old row before the change was committed
+    transaction.on_commit(invalidate)
+
+
+for model in CONFIG_MODELS:
+    post_save.connect(invalidate_config, sender=model, dispatch_uid='config_save_{}'.format(model.__name__))
+    post_delete.connect(invalidate_config, sender=model, dispatch_uid='config_delete_{}'.format(model.__name__))
@@ -64,6 +64,14 @@ class Constants(object):
     MONITOR_S2 = "monitorS2"  # defines name of the queue for going to state S2
     MONITOR_S3 = "monitorS3"  # defines the name of the queue for going to state S3
     MONITOR_S4 = "monitorS4"  # defines the name of the queue for going to state S4
+    MONITOR_PHASE_S2 = 2  # phase of the monitors for going to state S2 (one per round)
+    MONITOR_PHASE_S3 = 3  # phase of the monitors for going to state S3 (one per round)
+    MONITOR_PHASE_S4 = 4  # phase of the monitor for going to state S4 (always round 0)
+    MONITOR_PHASES = (
+        (MONITOR_PHASE_S2, MONITOR_S2),
+        (MONITOR_PHASE_S3, MONITOR_S3),
+        (MONITOR_PHASE_S4, MONITOR_S4),
+    )
 
     GENDER_MALE = 'M'
     GENDER_FERMALE = 'F'
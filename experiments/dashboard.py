@@ -0,0 +1,91 @@
+# coding=utf-8
+# ==============================================================================
+# beelbe
+# Copyright © 2016 Elias F. Domingos. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Data of the admin monitor of a session. The state of every group and of its members is read
+with a single query over the players of the session (the user, profile and group columns are
+joined, and the monitors in which each player is waiting are counted), so the cost of a refresh
+doesn't grow with the number of queries per group.
+
+A member is flagged as in_barrier while it is in the queue of a group barrier (RequestMonitor).
+With the MemoryMonitorBackend the queues are read from the last flush to the database.
+"""
+
+from itertools import groupby
+
+from django.db.models import Count
+
+from .constants import Constants
+from .models import Player
+
+GROUP_FIELDS = (
+    ('group__group_number', 'group_number'),
+    ('group__current_round', 'current_round'),
+    ('group__public_account', 'public_account'),
+    ('group__members_acted', 'members_acted'),
+    ('group__finishing_round', 'finishing_round'),
+    ('group__dice_results', 'dice_results'),
+    ('group__game_finished', 'game_finished'),
+)
+
+MEMBER_FIELDS = (
+    ('pk', 'player'),
+    ('user__username', 'username'),
+    ('user__is_active', 'is_active'),
+    ('profile__private_account', 'private_account'),
+    ('profile__experiment_state', 'experiment_state'),
+    ('profile__transition_state', 'transition_state'),
+    ('profile__last_round', 'last_round'),
+    ('profile__threshold_state', 'threshold_state'),
+)
+
+
+def get_value_in_euros(private_account, threshold_state, conversion_rate):
+    """:returns float - payment of a member (see Profile.get_value_in_euros)"""
+    if threshold_state == Constants.LOSS:
+        return 2.5
+    return private_account * conversion_rate + 2.5
+
+
+def get_session_groups(session, game):
+    """
+    :param session: Session object
+    :param game: CollectiveRiskGame played on the session
+    :return: list - one dict per group (ordered by group number) with its current round, public
+             account, final round and the list of its members, each one with its profile state
+             and whether it is waiting in a barrier
+    """
+    threshold_states = dict(Constants.THRESHOLD_STATES)
+    rows = Player.objects.filter(session=session, group__isnull=False).order_by(
+        'group__group_number', 'pk').values(*[lookup for lookup, _ in GROUP_FIELDS + MEMBER_FIELDS]).annotate(
+        barriers=Count('monitors'))
+
+    groups = []
+    for _, members in groupby(rows, key=lambda row: row['group__group_number']):
+        members = list(members)
+        group = {name: members[0][lookup] for lookup, name in GROUP_FIELDS}
+        group['members'] = []
+        for row in members:
+            member = {name: row[lookup] for lookup, name in MEMBER_FIELDS}
+            member['in_barrier'] = row['barriers'] > 0
+            member['threshold_state_display'] = str(threshold_states.get(member['threshold_state'], ''))
+            member['euros'] = get_value_in_euros(member['private_account'], member['threshold_state'],
+                                                 game.conversion_rate)
+            group['members'].append(member)
+        group['members_waiting'] = sum(member['in_barrier'] for member in group['members'])
+        groups.append(group)
+    return groups
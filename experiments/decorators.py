@@ -6,8 +6,41 @@ from django.shortcuts import get_object_or_404
 from django.urls import reverse_lazy
 from django.views import generic
 
+from experiments import config, fsm
 from experiments.constants import Constants
 from experiments.models import Player
+from experiments.sessions import check_session_state
+
+
+def get_player(request):
+    """
+    Returns the player of the logged in user. The player is loaded once per request, together with
+    its user, profile, group, experiment and session, and then shared by all decorators and views
+    that handle the request. The experiment state in which the request arrived is kept on
+    request.experiment_state (see experiments.middleware), and the one of the session is corrected
+    from the profile.
+    :param request: HttpRequest
+    :return: Player object
+    """
+    try:
+        return request.player
+    except AttributeError:
+        request.player = get_object_or_404(
+            Player.objects.select_related('user', 'profile', 'group', 'experiment', 'session'),
+            pk=request.user.id)
+        request.experiment_state = request.player.profile.experiment_state
+        if hasattr(request, 'session'):
+            # the state recorded on the session may be behind the profile (see experiments.sessions)
+            check_session_state(request.session, request.player.profile)
+        return request.player
+
+
+def get_game(player):
+    """
+    :param player: Player object
+    :return: CollectiveRiskGame of the player's session (read from the configuration cache)
+    """
+    return config.get_session_game(player.session_id)
 
 
 class LoginRequiredMixinExperiments(generic.View):
@@ -42,7 +75,7 @@ def check_game_finished():
     def decorator(view_func):
         @wraps(view_func)
         def _wrapper_view(request, *args, **kwargs):
-            player = get_object_or_404(Player, pk=request.user.id)
+            player = get_player(request)
             if player.session.finished or player.profile.finished:
                 return HttpResponseRedirect(reverse_lazy('experiments:logout'))
             return view_func(request, *args, **kwargs)
@@ -57,48 +90,20 @@ def check_experiment_state(sender=None):
     Should check the experiment state and from where the student has
     come, so that if the fsm schema is not being followed, the view
     should not be called and instead the participant should be
-    redirected to the correct state. Also, if the experiment_state is
-    Constants.STATE_FINISH, the participant should be logged out
+    redirected to the correct state (see experiments.fsm). Also, if the
+    experiment_state is Constants.STATE_FINISH, the participant should
+    be logged out
     :return: decorator
     """
 
     def decorator(view_func):
         @wraps(view_func)
         def _wrapper_view(request, *args, **kwargs):
-            player = get_object_or_404(Player, pk=request.user.id)
+            player = get_player(request)
             if (player.profile.experiment_state not in sender) or (
                         player.profile.experiment_state == Constants.STATE_FINISH):
-                # Check if player in a transition:
-                if player.profile.transition_state == Constants.STATE_TRANSITION_S2:
-                    # transition to state S2 is finish_results_view
-                    return HttpResponseRedirect(
-                        reverse_lazy('experiments:results_round', kwargs={'session_id': player.session.id}))
-                elif player.profile.transition_state == Constants.STATE_TRANSITION_S3:
-                    # transition to state S3 is finish_round_view
-                    return HttpResponseRedirect(
-                        reverse_lazy('experiments:game_round', kwargs={'session_id': player.session.id}))
-                elif player.profile.transition_state == Constants.STATE_TRANSITION_S4:
-                    # transition to state S4 is transition_risk
-                    return HttpResponseRedirect(
-                        reverse_lazy('experiments:results_risk_wait', kwargs={'session_id': player.session.id}))
-
-                if player.profile.experiment_state == Constants.STATE_TEST:
-                    return HttpResponseRedirect(
-                        reverse_lazy('experiments:test', kwargs={'session_id': player.session.id}))
-                elif player.profile.experiment_state == Constants.STATE_GAME_S2:
-                    return HttpResponseRedirect(
-                        reverse_lazy('experiments:game', kwargs={'session_id': player.session.id}))
-                elif player.profile.experiment_state == Constants.STATE_GAME_S3:
-                    return HttpResponseRedirect(
-                        reverse_lazy('experiments:results', kwargs={'session_id': player.session.id}))
-                elif player.profile.experiment_state == Constants.STATE_GAME_S4:
-                    return HttpResponseRedirect(
-                        reverse_lazy('experiments:results_risk', kwargs={'session_id': player.session.id}))
-                elif player.profile.experiment_state == Constants.STATE_QUIZ:
-                    return HttpResponseRedirect(
-                        reverse_lazy('experiments:userinfo', kwargs={'session_id': player.session.id}))
-                else:
-                    return HttpResponseRedirect(reverse_lazy('experiments:logout'))
+                return HttpResponseRedirect(
+                    fsm.get_redirect_url(player.profile, player.session_id, default='experiments:logout'))
             return view_func(request, *args, **kwargs)
 
         return _wrapper_view
@@ -108,15 +113,29 @@ def check_experiment_state(sender=None):
 
 def check_transition(sender=None, target=None):
     """
-    Should enforce a finite state machine by checking that the transition between states is correct. Only the
-    states described on sender can transit to the current view, and the current view must transition only to one
-    of the possible states described at target.
-    
-    :param sender: previous state
+    Enforces the finite state machine: the participant enters the target state before the view is
+    called, only if it is still on one of the states of sender. Otherwise another request of the
+    participant changed its state meanwhile, and it is redirected to the view of its current state.
+
+    :param sender: previous states (defaults to fsm.TRANSITIONS[target])
     :param target: next state
-    :return: 
+    :return: decorator
     """
-    pass
+
+    def decorator(view_func):
+        @wraps(view_func)
+        def _wrapper_view(request, *args, **kwargs):
+            player = get_player(request)
+            if not fsm.transit(player.profile, target, sender=sender):
+                player.profile.refresh_from_db(fields=['experiment_state', 'transition_state'])
+                return HttpResponseRedirect(
+                    fsm.get_redirect_url(player.profile, player.session_id, default='experiments:logout'))
+            request.session['experiment_state'] = target
+            return view_func(request, *args, **kwargs)
+
+        return _wrapper_view
+
+    return decorator
 
 
 def test_concurrently(times):
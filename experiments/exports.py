@@ -0,0 +1,230 @@
+# coding=utf-8
+# ==============================================================================
+# beelbe
+# Copyright © 2016 Elias F. Domingos. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Streaming exports of the experiment data (used by the admin export actions).
+
+Rows are read with a single values_list query over a server-side cursor (iterator), so the
+related objects are never instantiated and the memory used doesn't depend on the number of rows:
+- CSV is streamed to the client with a StreamingHttpResponse.
+- Arrow (IPC stream format) is streamed record batch by record batch.
+- Parquet needs its footer at the end of the file, so it is written to a spooled temporary file
+  (kept in memory while small) and then sent with a FileResponse.
+Arrow and Parquet require pyarrow.
+
+The rows are read from the archive database. The live state of a session played on its own database
+(see experiments.routers) is only copied there when the session is consolidated, so the export actions
+refuse the rows of these sessions and warn that they are missing from the export (see get_live_sessions).
+"""
+
+import csv
+import io
+import tempfile
+
+from django.db import models
+from django.http import StreamingHttpResponse, FileResponse
+
+from . import routers
+from .models import Session
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+DEFAULT_CHUNK_SIZE = 2000
+
+# Columns of the related objects added to the export of each model (resolved with joins)
+EXPORT_RELATED = {
+    'gamedata': ('player__user__username', 'session__session_number', 'group__group_number'),
+    'profile': ('player__user__username', 'player__session_id', 'player__group__group_number'),
+    'survey': ('player__user__username', 'player__session_id', 'player__group__group_number'),
+}
+
+
+# Session of the rows of the live state exported by the admin (see experiments.routers.LIVE_MODELS)
+SESSION_LOOKUPS = {
+    'gamedata': 'session',
+    'group': 'session',
+    'player': 'session',
+    'profile': 'player__session',
+    'requestmonitor': 'group__session',
+}
+
+
+def get_live_sessions(queryset=None):
+    """
+    :param queryset: rows to export (None for all the sessions)
+    :return: dict - database of each session (of the rows of the queryset) whose live state is still on
+             its own database, so its rows on the archive database are missing or not up to date
+    """
+    sessions = Session.objects.exclude(database='').exclude(database=routers.get_archive_database())
+    if queryset is not None:
+        lookup = SESSION_LOOKUPS.get(queryset.model._meta.model_name)
+        if lookup is None:
+            return {}
+        sessions = sessions.filter(pk__in=queryset.order_by().values(lookup))
+    return dict(sessions.order_by('pk').values_list('pk', 'database'))
+
+
+def get_export_columns(model):
+    """
+    :param model: Django model
+    :return: list - lookups exported for the model: its own fields (foreign keys as ids) and the
+             related columns of EXPORT_RELATED
+    """
+    return [field.attname for field in model._meta.concrete_fields] + list(
+        EXPORT_RELATED.get(model._meta.model_name, ()))
+
+
+def resolve_field(model, lookup):
+    """:returns Field - model field that holds the values of the lookup (e.g. player__user__username)"""
+    *path, name = lookup.split('__')
+    for relation in path:
+        model = model._meta.get_field(relation).related_model
+    field = {f.attname: f for f in model._meta.concrete_fields}.get(name) or model._meta.get_field(name)
+    # foreign keys are exported as the primary key of the related object
+    while field.is_relation:
+        field = field.target_field
+    return field
+
+
+def iter_rows(queryset, columns, chunk_size=DEFAULT_CHUNK_SIZE):
+    """:returns iterator over the tuples of the columns, read chunk_size rows at a time"""
+    return queryset.values_list(*columns).iterator(chunk_size=chunk_size)
+
+
+class Echo(object):
+    """File-like object that returns what is written, so that csv.writer can be streamed"""
+
+    def write(self, value):
+        return value
+
+
+def stream_csv(queryset, filename, header=True, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    :param queryset: rows to export
+    :param filename: name of the attachment (without extension)
+    :param header: whether the first row contains the column names
+    :param chunk_size: rows fetched from the database at a time
+    :return: StreamingHttpResponse
+    """
+    columns = get_export_columns(queryset.model)
+    writer = csv.writer(Echo())
+
+    def rows():
+        if header:
+            yield writer.writerow(columns)
+        for row in iter_rows(queryset, columns, chunk_size):
+            yield writer.writerow(row)
+
+    response = StreamingHttpResponse(rows(), content_type='text/csv')
+    response['Content-Disposition'] = 'attachment; filename={}.csv'.format(filename)
+    return response
+
+
+def _arrow_type(field):
+    if isinstance(field, (models.AutoField, models.IntegerField)):
+        return pyarrow.int64()
+    if isinstance(field, models.FloatField):
+        return pyarrow.float64()
+    if isinstance(field, models.BooleanField):
+        return pyarrow.bool_()
+    if isinstance(field, models.DateTimeField):
+        return pyarrow.timestamp('us', tz='UTC')
+    if isinstance(field, models.DateField):
+        return pyarrow.date32()
+    if isinstance(field, models.TimeField):
+        return pyarrow.time64('us')
+    return pyarrow.string()
+
+
+def arrow_schema(model, columns):
+    """:returns pyarrow.Schema - one column per lookup, typed after the model fields"""
+    return pyarrow.schema([pyarrow.field(column, _arrow_type(resolve_field(model, column))) for column in columns])
+
+
+def iter_record_batches(queryset, columns, schema, chunk_size=DEFAULT_CHUNK_SIZE):
+    """:returns iterator over pyarrow.RecordBatch of at most chunk_size rows"""
+    chunk = []
+    for row in iter_rows(queryset, columns, chunk_size):
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            yield _record_batch(chunk, schema)
+            chunk = []
+    if chunk:
+        yield _record_batch(chunk, schema)
+
+
+def _record_batch(rows, schema):
+    return pyarrow.RecordBatch.from_arrays(
+        [pyarrow.array(values, type=field.type) for values, field in zip(zip(*rows), schema)], schema=schema)
+
+
+def _check_pyarrow():
+    if pyarrow is None:
+        raise ImportError("pyarrow is required to export in Arrow or Parquet format (pip install pyarrow)")
+
+
+def stream_arrow(queryset, filename, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    :return: StreamingHttpResponse with the rows in Arrow IPC stream format
+    """
+    _check_pyarrow()
+    columns = get_export_columns(queryset.model)
+    schema = arrow_schema(queryset.model, columns)
+
+    def chunks():
+        sink = io.BytesIO()
+        writer = pyarrow.ipc.new_stream(sink, schema)
+        for batch in iter_record_batches(queryset, columns, schema, chunk_size):
+            writer.write_batch(batch)
+            yield sink.getvalue()
+            sink.seek(0)
+            sink.truncate()
+        writer.close()
+        yield sink.getvalue()
+
+    response = StreamingHttpResponse(chunks(), content_type='application/vnd.apache.arrow.stream')
+    response['Content-Disposition'] = 'attachment; filename={}.arrows'.format(filename)
+    return response
+
+
+def write_parquet(queryset, output, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Writes the rows to a Parquet file, one row group per chunk
+    :param output: path or file object
+    """
+    _check_pyarrow()
+    columns = get_export_columns(queryset.model)
+    schema = arrow_schema(queryset.model, columns)
+    with pyarrow.parquet.ParquetWriter(output, schema) as writer:
+        for batch in iter_record_batches(queryset, columns, schema, chunk_size):
+            writer.write_table(pyarrow.Table.from_batches([batch], schema=schema))
+
+
+def parquet_response(queryset, filename, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    :return: FileResponse with the rows in Parquet format
+    """
+    output = tempfile.SpooledTemporaryFile(max_size=16 * 1024 * 1024)
+    write_parquet(queryset, output, chunk_size)
+    output.seek(0)
+    return FileResponse(output, as_attachment=True, filename='{}.parquet'.format(filename),
+                        content_type='application/vnd.apache.parquet')
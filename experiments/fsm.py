@@ -0,0 +1,105 @@
+# coding=utf-8
+# ==============================================================================
+# beelbe
+# Copyright © 2016 Elias F. Domingos. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Finite state machine followed by the participants of an experiment.
+
+The state of a participant is the experiment_state and transition_state of its profile. The tables
+below are built once: VIEWS and TRANSITION_VIEWS give the view to which a participant in a state is
+sent back (a transition has precedence over the state in which it started), and TRANSITIONS gives
+the states from which each state can be entered. The transitions are done with a conditional UPDATE
+of the profile, so that two requests of the same participant (e.g. two tabs) can't both do one.
+"""
+
+# import the logging library
+import logging
+
+from django.urls import reverse_lazy
+
+from .constants import Constants
+from .models import Profile
+
+# Get an instance of a logger
+logger = logging.getLogger(__name__)
+
+# view of each experiment state
+VIEWS = {
+    Constants.STATE_TEST: 'experiments:test',
+    Constants.STATE_GAME_S2: 'experiments:game',
+    Constants.STATE_GAME_S3: 'experiments:results',
+    Constants.STATE_GAME_S4: 'experiments:results_risk',
+    Constants.STATE_QUIZ: 'experiments:userinfo',
+    Constants.STATE_FINISH: 'experiments:logout',
+}
+# view that completes each transition
+TRANSITION_VIEWS = {
+    Constants.STATE_TRANSITION_S2: 'experiments:results_round',
+    Constants.STATE_TRANSITION_S3: 'experiments:game_round',
+    Constants.STATE_TRANSITION_S4: 'experiments:results_risk_wait',
+}
+# views whose url doesn't depend on the session
+SESSION_FREE_VIEWS = frozenset(['experiments:logout'])
+# states from which each state of the game can be entered
+TRANSITIONS = {
+    Constants.STATE_GAME_S2: frozenset([Constants.STATE_TEST, Constants.STATE_GAME_S3, Constants.STATE_GAME_S2]),
+    Constants.STATE_GAME_S3: frozenset([Constants.STATE_GAME_S2, Constants.STATE_GAME_S3]),
+    Constants.STATE_GAME_S4: frozenset([Constants.STATE_GAME_S3, Constants.STATE_GAME_S4]),
+}
+
+
+def get_view(profile):
+    """
+    :param profile: Profile of the participant
+    :return: str - name of the view of the state of the participant (None if the state has no view)
+    """
+    return TRANSITION_VIEWS.get(profile.transition_state) or VIEWS.get(profile.experiment_state)
+
+
+def get_redirect_url(profile, session_id, default=None):
+    """
+    :param profile: Profile of the participant
+    :param session_id: id of the session of the participant
+    :param default: name of the view used when the state has no view
+    :return: url of the view of the state of the participant (None if neither the state nor default have one)
+    """
+    view = get_view(profile) or default
+    if view is None:
+        return None
+    if view in SESSION_FREE_VIEWS:
+        return reverse_lazy(view)
+    return reverse_lazy(view, kwargs={'session_id': session_id})
+
+
+def transit(profile, target, sender=None):
+    """
+    Moves a participant to a state, out of any transition, if its profile is still on one of the
+    states of sender when the UPDATE is done. The profile object is updated as well.
+    :param profile: Profile of the participant
+    :param target: state to enter
+    :param sender: states from which target can be entered (defaults to TRANSITIONS[target])
+    :return: bool - True if the participant is now on target, False if its state changed meanwhile
+    """
+    if sender is None:
+        sender = TRANSITIONS[target]
+    updated = Profile.objects.filter(pk=profile.pk, experiment_state__in=sender).update(
+        experiment_state=target, transition_state=Constants.STATE_NO_TRANSITION)
+    if not updated:
+        logger.info("[Player {}] state changed before the transition to {}".format(profile.pk, target))
+        return False
+    profile.experiment_state = target
+    profile.transition_state = Constants.STATE_NO_TRANSITION
+    return True
@@ -0,0 +1,39 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from experiments.auth import get_access_codes, rotate_access_key
+from experiments.models import Session
+
+
+class Command(BaseCommand):
+    help = 'Prints (or saves) the access codes with which the participants of a session can log in instead of ' \
+           'their password. Requires experiments.auth.AccessCodeBackend in AUTHENTICATION_BACKENDS.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('session_id', type=int)
+        parser.add_argument('--rotate', action='store_true',
+                            help='Generate a new access key first, which invalidates the previous codes')
+        parser.add_argument('--output', default=None,
+                            help='JSON file where the credentials are saved (same format as utils.add_users2session)')
+
+    def handle(self, *args, **options):
+        try:
+            session = Session.objects.get(pk=options['session_id'])
+        except Session.DoesNotExist:
+            raise CommandError('Session {} does not exist'.format(options['session_id']))
+
+        if options['rotate']:
+            rotate_access_key(session)
+            self.stdout.write(self.style.WARNING('The previous access codes of session {} are no longer valid'.format(
+                session.pk)))
+
+        codes = get_access_codes(session)
+        if options['output']:
+            with open(options['output'], 'w') as json_file:
+                json.dump({str(i): {'username': username, 'password': code}
+                           for i, (username, code) in enumerate(codes.items(), 1)}, json_file)
+            self.stdout.write(self.style.SUCCESS('{} access codes written to {}'.format(len(codes), options['output'])))
+        else:
+            for username, code in codes.items():
+                self.stdout.write('{:<20} {}'.format(username, code))
@@ -0,0 +1,75 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from experiments.toolkit.benchmark import Benchmark, BenchmarkError, compare_reports, read_report, write_report
+
+
+class Command(BaseCommand):
+    help = 'Provisions a session on a test database, plays it with the test client and writes the queries, ' \
+           'latency and locks of each request path to a JSON report.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--players', type=int, default=24, help='Participants of the session')
+        parser.add_argument('--group-size', type=int, default=6)
+        parser.add_argument('--rounds', type=int, default=10)
+        parser.add_argument('--experiments', default=None,
+                            help='JSON file loaded with ExperimentsLoader (its treatments must use the game uid '
+                                 '"benchmark")')
+        parser.add_argument('--seed', type=int, default=None)
+        parser.add_argument('--language', default='en')
+        parser.add_argument('--database', default=None,
+                            help='Alias of the database on which the session is played (see experiments.routers)')
+        parser.add_argument('--report', default='benchmark.json', help='JSON file where the report is written')
+        parser.add_argument('--baseline', default=None,
+                            help='Report of a previous run, the command fails if a request path regressed')
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help='Relative increase of the latency tolerated when comparing with the baseline')
+        parser.add_argument('--keepdb', action='store_true', help='Keep the test database between runs')
+        parser.add_argument('--noinput', '--no-input', action='store_false', dest='interactive',
+                            help='Destroy an existing test database without asking')
+
+    def handle(self, *args, **options):
+        try:
+            benchmark = Benchmark(players=options['players'], group_size=options['group_size'],
+                                  rounds=options['rounds'], experiments_path=options['experiments'],
+                                  language=options['language'], seed=options['seed'],
+                                  database=options['database'])
+            baseline = read_report(options['baseline']) if options['baseline'] else None
+        except (IOError, ValueError) as e:
+            raise CommandError(e)
+        if benchmark.database not in connections.databases:
+            raise CommandError('The database {} is not in settings.DATABASES'.format(benchmark.database))
+
+        # the benchmark creates users and sessions, it never runs on the database of the experiments
+        setup_test_environment()
+        old_names = []
+        try:
+            for alias in sorted({DEFAULT_DB_ALIAS, benchmark.database}):
+                old_names.append((connections[alias], connections[alias].creation.create_test_db(
+                    verbosity=options['verbosity'], autoclobber=not options['interactive'],
+                    keepdb=options['keepdb'])))
+            report = benchmark.run()
+        except BenchmarkError as e:
+            raise CommandError(e)
+        finally:
+            for db_connection, old_name in old_names:
+                db_connection.creation.destroy_test_db(old_name, verbosity=options['verbosity'],
+                                                       keepdb=options['keepdb'])
+            teardown_test_environment()
+
+        write_report(report, options['report'])
+        for name, stats in report['provisioning'].items():
+            self.stdout.write('{:<20} {seconds:>8.3f}s  {queries:>6} queries'.format(name, **stats))
+        for endpoint, stats in report['endpoints'].items():
+            self.stdout.write('{:<20} {requests:>6} requests  {queries_mean:>6.1f} queries  p50 {p50_ms:>7.1f}ms  '
+                              'p99 {p99_ms:>7.1f}ms  {locking_statements_mean:>5.1f} locks  held p99 '
+                              '{lock_held_p99_ms:>7.1f}ms'.format(endpoint, **stats))
+
+        if baseline is not None:
+            regressions = compare_reports(baseline, report, options['tolerance'])
+            for regression in regressions:
+                self.stdout.write(self.style.WARNING(regression))
+            if regressions:
+                raise CommandError('{} regressions compared to {}'.format(len(regressions), options['baseline']))
+        self.stdout.write(self.style.SUCCESS('Report written to {}'.format(options['report'])))
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from experiments.models import Session
+from experiments.routers import consolidate_session, get_archive_database
+
+
+class Command(BaseCommand):
+    help = 'Copies the live state of the finished sessions played on another database back to the archive ' \
+           'database (EXPERIMENTS_ARCHIVE_DATABASE). The consolidated sessions are read from the archive ' \
+           'database from then on, and are not consolidated again.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('session_ids', nargs='*', type=int,
+                            help='Sessions to consolidate (defaults to all the finished sessions)')
+        parser.add_argument('--purge', action='store_true',
+                            help='Delete the rows of the sessions from their database afterwards')
+
+    def handle(self, *args, **options):
+        sessions = Session.objects.exclude(database='').exclude(database=get_archive_database())
+        if options['session_ids']:
+            sessions = sessions.filter(pk__in=options['session_ids'])
+            missing = set(options['session_ids']) - set(sessions.values_list('pk', flat=True))
+            if missing:
+                raise CommandError('Sessions {} do not exist or are played on the archive database'.format(
+                    ', '.join(str(pk) for pk in sorted(missing))))
+        else:
+            sessions = sessions.filter(finished=True)
+
+        for session in sessions:
+            if not session.finished:
+                self.stdout.write(self.style.WARNING('Session {} is not finished yet'.format(session.pk)))
+            database = session.database
+            try:
+                copied = consolidate_session(session, purge=options['purge'])
+            except ValueError as e:
+                raise CommandError(str(e))
+            self.stdout.write(self.style.SUCCESS('Session {}: {} game data rows copied from {}'.format(
+                session.pk, copied, database)))
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from experiments.toolkit.loadtest import LoadTest, read_credentials, write_report
+
+
+class Command(BaseCommand):
+    help = 'Plays a session on a running server with virtual participants (one per user of the credentials file) ' \
+           'and writes the latency of each endpoint to a JSON report. Requires aiohttp.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('session_id', type=int, help='Session played by the participants (it must be running)')
+        parser.add_argument('credentials', help='JSON file with the users, as saved by utils.add_users2session')
+        parser.add_argument('--base-url', default='http://localhost:8000', help='Root url of the server')
+        parser.add_argument('--think-time', default='uniform:0,10',
+                            help='Seconds spent on each page: none, const:s, uniform:a,b, exp:mean or '
+                                 'lognormal:mu,sigma')
+        parser.add_argument('--ramp-up', type=float, default=0, help='Seconds over which the participants start')
+        parser.add_argument('--participants', type=int, default=None,
+                            help='Number of participants (defaults to all users of the credentials file)')
+        parser.add_argument('--max-connections', type=int, default=1000)
+        parser.add_argument('--timeout', type=float, default=60, help='Seconds before a request fails')
+        parser.add_argument('--max-wait', type=float, default=300,
+                            help='Seconds a participant waits on a barrier before giving up')
+        parser.add_argument('--seed', type=int, default=None)
+        parser.add_argument('--language', default='en')
+        parser.add_argument('--report', default='loadtest.json', help='JSON file where the report is written')
+
+    def handle(self, *args, **options):
+        try:
+            credentials = read_credentials(options['credentials'])[:options['participants']]
+            load_test = LoadTest(options['base_url'], options['session_id'], credentials,
+                                 think_time=options['think_time'], ramp_up=options['ramp_up'],
+                                 max_connections=options['max_connections'], timeout=options['timeout'],
+                                 max_wait=options['max_wait'], seed=options['seed'], language=options['language'])
+        except (IOError, ValueError, KeyError, ImportError) as e:
+            raise CommandError(e)
+
+        report = load_test.run()
+        write_report(report, options['report'])
+
+        for endpoint, stats in report['endpoints'].items():
+            self.stdout.write('{:<20} {requests:>8} requests  p50 {p50_ms:>8.1f}ms  p95 {p95_ms:>8.1f}ms  '
+                              'p99 {p99_ms:>8.1f}ms'.format(endpoint, **stats))
+        style = self.style.SUCCESS if not report['failed'] else self.style.WARNING
+        self.stdout.write(style('{completed}/{participants} participants finished, {requests} requests in '
+                                '{duration:.1f}s ({throughput:.1f} req/s)'.format(**report)))
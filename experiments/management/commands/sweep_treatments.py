@@ -0,0 +1,58 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from experiments.models import CollectiveRiskGame
+from experiments.toolkit.simulation import CRDParameters
+from experiments.toolkit.sweep import run_sweep
+
+
+class Command(BaseCommand):
+    help = 'Simulates a grid of Collective-Risk treatments on all cores and stores the results in a CSV file. ' \
+           'Running it again with the same output file resumes an interrupted sweep.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('game_id', type=int, help='CollectiveRiskGame that provides the base parameters')
+        parser.add_argument('output', help='CSV file where the results are appended')
+        parser.add_argument('--grid', default='{}',
+                            help='JSON object {parameter: [values]}, e.g. \'{"threshold": [100, 120], '
+                                 '"risk_prob": [0.5, 0.9]}\', or the path of a JSON file')
+        parser.add_argument('--strategies', default=None,
+                            help='Composition of the groups, e.g. "fair*3;mixed:0.2,0.3,0.5*3" '
+                                 '(defaults to fair share for every member)')
+        parser.add_argument('--groups', type=int, default=100000, help='Groups simulated per treatment')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--workers', type=int, default=None, help='Number of processes (default: all cores)')
+
+    def handle(self, *args, **options):
+        try:
+            game = CollectiveRiskGame.objects.get(pk=options['game_id'])
+        except CollectiveRiskGame.DoesNotExist:
+            raise CommandError('CollectiveRiskGame {} does not exist'.format(options['game_id']))
+
+        grid = options['grid']
+        try:
+            if not grid.lstrip().startswith('{'):
+                with open(grid) as grid_file:
+                    grid = grid_file.read()
+            grid = json.loads(grid)
+        except (IOError, ValueError) as e:
+            raise CommandError('Invalid grid: {}'.format(e))
+
+        base_params = CRDParameters.from_game(game)
+        unknown = set(grid) - set(base_params.__dict__) - {'strategies'}
+        if unknown:
+            raise CommandError('Unknown parameters {}'.format(', '.join(sorted(unknown))))
+        strategies = options['strategies'] or 'fair*{}'.format(game.group_size)
+
+        time_start = time.perf_counter()
+        try:
+            run, skipped = run_sweep(base_params, grid, strategies, options['groups'], options['output'],
+                                     seed=options['seed'], workers=options['workers'],
+                                     callback=lambda row: self.stdout.write(
+                                         'success {success_rate:.3f} | {task}'.format(**row)))
+        except ValueError as e:
+            raise CommandError(e)
+        self.stdout.write(self.style.SUCCESS('{} treatments simulated ({} already done) in {:.1f}s'.format(
+            run, skipped, time.perf_counter() - time_start)))
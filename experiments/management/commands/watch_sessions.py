@@ -0,0 +1,83 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+
+from experiments import config, routers
+from experiments.models import Session
+from experiments.monitors import get_monitor_backend, MemoryMonitorBackend
+from experiments.watchdog import Watchdog, store_report
+
+
+class Command(BaseCommand):
+    help = 'Watches the barriers of a live session, reports the participants that stall their group ' \
+           '(shown on the admin monitor) and optionally repairs the queues.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--session', type=int, default=None,
+                            help='Session to watch (defaults to all the sessions that are on)')
+        parser.add_argument('--interval', type=float, default=None,
+                            help='Seconds between two scans (default: EXPERIMENTS_WATCHDOG_INTERVAL)')
+        parser.add_argument('--stuck-after', type=float, default=None,
+                            help='Seconds after which a barrier that does not open is checked '
+                                 '(default: EXPERIMENTS_WATCHDOG_STUCK_AFTER)')
+        parser.add_argument('--repair', action='store_true', help='Repair the queues of the stalled barriers')
+        parser.add_argument('--once', action='store_true',
+                            help='Report once and exit (the time spent waiting is only known between two scans, '
+                                 'so the barriers are scanned a first time and checked stuck-after seconds later)')
+
+    def handle(self, *args, **options):
+        if options['repair'] and isinstance(get_monitor_backend(), MemoryMonitorBackend):
+            # the queues live in the memory of the server process, they can't be modified from here
+            raise CommandError('The queues of the MemoryMonitorBackend can only be repaired by the server process')
+
+        if not config.is_shared_cache(getattr(settings, 'EXPERIMENTS_WATCHDOG_CACHE', 'shared')):
+            self.stderr.write(self.style.WARNING('EXPERIMENTS_WATCHDOG_CACHE is local to this process, the reports '
+                                                 'will not be shown on the admin monitor'))
+
+        interval = options['interval'] or getattr(settings, 'EXPERIMENTS_WATCHDOG_INTERVAL', 10)
+        stuck_after = options['stuck_after'] if options['stuck_after'] is not None else getattr(
+            settings, 'EXPERIMENTS_WATCHDOG_STUCK_AFTER', 60)
+        # with --once, a first scan records the queue entries, which are checked stuck_after seconds later
+        baseline = options['once'] and stuck_after > 0
+        # a watchdog remembers the entries of the monitors it scans, so there is one per session
+        watchdogs = {}
+
+        while True:
+            session_ids = [options['session']] if options['session'] else [run.session_id for run in config.get_runs()]
+            sessions = Session.objects.in_bulk(session_ids)
+            if options['session'] and not sessions:
+                raise CommandError('Session {} does not exist'.format(options['session']))
+
+            reports = []
+            for session_id in session_ids:
+                if session_id not in sessions:
+                    continue
+                watchdog = watchdogs.setdefault(session_id, Watchdog(stuck_after=stuck_after,
+                                                                     repair=options['repair']))
+                with routers.session_database(session_id):
+                    report = watchdog.scan(sessions[session_id])
+                if baseline:
+                    # no entry has waited yet, so there is nothing to report
+                    continue
+                store_report(report)
+                reports.append(report)
+                for issue in report['issues']:
+                    self.stdout.write('session {session} group {group_number} player {player} ({phase}, {round}) '
+                                      'waited {waited}s: {cause} - {detail}{suffix}'.format(
+                                          session=session_id, suffix=' [repaired]' if issue['repaired'] else '',
+                                          **issue))
+            if baseline:
+                baseline = False
+                time.sleep(stuck_after)
+                close_old_connections()
+                continue
+            if options['once']:
+                break
+            time.sleep(interval)
+            close_old_connections()
+
+        self.stdout.write(self.style.SUCCESS('{} sessions, {} players waiting, {} issues'.format(
+            len(reports), sum(report['waiting'] for report in reports),
+            sum(len(report['issues']) for report in reports))))
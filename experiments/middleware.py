@@ -1,2 +1,200 @@
+# coding=utf-8
+# ==============================================================================
+# beelbe
+# Copyright © 2016 Elias F. Domingos. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Instrumentation of the requests.
+
+ExperimentsMiddleware records, for every request, the number of SQL queries, the time spent in
+the database, the wall time and the transaction retries (the DatabaseError paths of the views,
+after which the participant is sent back to submit the form again, see record_retry). Each request
+is logged as a JSON line on the experiments.metrics logger, and the samples are kept per view and
+per experiment state (the state of the participant when the request arrived), so that the
+histograms of the last EXPERIMENTS_METRICS_WINDOW seconds can be read on the monitor (see
+views_admin.fetch_metrics).
+
+The samples are kept in the memory of each server process, with several workers each one reports
+its own requests (the logs contain all of them). The queries of all the databases are counted
+(see experiments.routers).
+
+SessionDatabaseMiddleware activates the database of the session of each request (see
+experiments.routers).
+"""
+
+import json
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import ExitStack
+
+import numpy as np
+from django.conf import settings
+from django.db import connections
+
+from . import routers
+
+# One JSON line per request
+metrics_logger = logging.getLogger('experiments.metrics')
+
+# Upper bounds (ms) of the histogram buckets
+HISTOGRAM_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+# Maximum number of samples kept per view and state
+MAX_SAMPLES = 10000
+NO_STATE = '-'
+
+
+class QueryTimer(object):
+    """Database execute wrapper that counts the queries of a request and the time spent on them"""
+
+    def __init__(self):
+        self.queries = 0
+        self.time = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.time += time.perf_counter() - start
+            self.queries += 1
+
+
+def record_retry(request):
+    """Counts a transaction that failed on the request (the participant has to submit it again)"""
+    request.transaction_retries = getattr(request, 'transaction_retries', 0) + 1
+
+
+def _histogram(values):
+    # bucket i counts the values in (HISTOGRAM_BUCKETS[i - 1], HISTOGRAM_BUCKETS[i]]
+    counts = np.bincount(np.searchsorted(HISTOGRAM_BUCKETS, values), minlength=len(HISTOGRAM_BUCKETS) + 1)
+    return {('<={}'.format(bound) if bound != np.inf else '>{}'.format(HISTOGRAM_BUCKETS[-1])): int(count)
+            for bound, count in zip(HISTOGRAM_BUCKETS + (np.inf,), counts)}
+
+
+class MetricsStore(object):
+    """Samples of the requests of the last window seconds, per (view, experiment state)"""
+
+    def __init__(self, window=None):
+        self.window = window if window is not None else getattr(settings, 'EXPERIMENTS_METRICS_WINDOW', 300)
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def add(self, view, state, queries, db_ms, wall_ms, retries):
+        with self._lock:
+            samples = self._samples.setdefault((view, state), deque(maxlen=MAX_SAMPLES))
+            samples.append((time.monotonic(), queries, db_ms, wall_ms, retries))
+
+    def clear(self):
+        with self._lock:
+            self._samples = {}
+
+    def summary(self):
+        """
+        :return: list - per view and state: number of requests, queries, db and wall time percentiles,
+                 histograms of the db and wall time and transaction retries
+        """
+        since = time.monotonic() - self.window
+        with self._lock:
+            for samples in self._samples.values():
+                while samples and samples[0][0] < since:
+                    samples.popleft()
+            snapshot = {key: list(samples) for key, samples in self._samples.items() if samples}
+
+        rows = []
+        for (view, state), samples in sorted(snapshot.items()):
+            _, queries, db_ms, wall_ms, retries = (np.asarray(column) for column in zip(*samples))
+            rows.append({
+                'view': view,
+                'state': state,
+                'requests': len(samples),
+                'queries_mean': float(queries.mean()),
+                'queries_max': int(queries.max()),
+                'db_ms_p50': float(np.percentile(db_ms, 50)),
+                'db_ms_p99': float(np.percentile(db_ms, 99)),
+                'wall_ms_p50': float(np.percentile(wall_ms, 50)),
+                'wall_ms_p99': float(np.percentile(wall_ms, 99)),
+                'retries': int(retries.sum()),
+                'db_histogram': _histogram(db_ms),
+                'wall_histogram': _histogram(wall_ms),
+            })
+        return rows
+
+
+metrics = MetricsStore()
+
+
 class ExperimentsMiddleware(object):
-    pass
\ No newline at end of file
+    """Records the queries, database time, wall time and transaction retries of each request"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        timer = QueryTimer()
+        start = time.perf_counter()
+        with ExitStack() as stack:
+            for db_connection in connections.all():
+                stack.enter_context(db_connection.execute_wrapper(timer))
+            response = self.get_response(request)
+        wall_ms = (time.perf_counter() - start) * 1000
+
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match is not None else NO_STATE
+        # the player is only loaded (see decorators.get_player) by the views of the participants
+        player = getattr(request, 'player', None)
+        state = getattr(request, 'experiment_state', NO_STATE)
+        retries = getattr(request, 'transaction_retries', 0)
+        db_ms = timer.time * 1000
+
+        metrics.add(view, state, timer.queries, db_ms, wall_ms, retries)
+        metrics_logger.info(json.dumps({
+            'view': view,
+            'state': state,
+            'method': request.method,
+            'status': response.status_code,
+            'player': player.pk if player is not None else None,
+            'queries': timer.queries,
+            'db_ms': round(db_ms, 3),
+            'wall_ms': round(wall_ms, 3),
+            'retries': retries,
+        }, sort_keys=True))
+        return response
+
+
+class SessionDatabaseMiddleware(object):
+    """
+    Activates the database of the live state of the session of the request: the session of the participant
+    (stored on login, see experiments.auth) or, on the admin views, the session_id of the url or the query.
+    Must be placed after SessionMiddleware.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        try:
+            return self.get_response(request)
+        finally:
+            routers.deactivate()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        session_id = request.session.get(routers.SESSION_KEY) or view_kwargs.get('session_id') or \
+            request.GET.get('session_id')
+        try:
+            routers.activate(int(session_id) if session_id is not None else None)
+        except ValueError:
+            routers.deactivate()
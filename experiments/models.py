@@ -22,11 +22,12 @@ import logging
 from django.contrib.auth.models import User
 from django.core.exceptions import (ValidationError, NON_FIELD_ERRORS)
 from django.core.validators import validate_comma_separated_integer_list
-from django.db import models, transaction
-from django.db.models import Max, F, Sum
+from django.db import models, router, transaction
+from django.db.models import Max, Sum, F
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 from django.utils import timezone
+from django.utils.crypto import get_random_string
 from django.utils.translation import ugettext_lazy as _
 from nltk.corpus import words
 from numpy import random
@@ -149,6 +150,11 @@ class Treatment(models.Model):
         ordering = ('experiment', 'game',)
 
 
+def generate_access_key():
+    """:returns str - random key of the access codes of a session (see experiments.auth.AccessCodeBackend)"""
+    return get_random_string(32)
+
+
 class Session(models.Model):
     experiment = models.ForeignKey(Experiment, on_delete=models.CASCADE, related_name="sessions")
     treatment = models.ForeignKey(Treatment, on_delete=models.CASCADE, related_name="sessions")
@@ -163,6 +169,12 @@ class Session(models.Model):
         default=False
     )
     group_size = models.IntegerField('group size', default=0)
+    random_seed = models.IntegerField('Seed of the final rounds of the groups', null=True, blank=True)
+    access_key = models.CharField('Key of the access codes', max_length=32, default=generate_access_key,
+                                  editable=False)
+    database = models.CharField('Database of the live state', max_length=100, blank=True, default='',
+                                help_text='Alias in settings.DATABASES where the session is played (see '
+                                          'experiments.routers), empty for the archive database')
 
     def set_time_start(self):
         pass
@@ -312,6 +324,8 @@ class GameData(models.Model):
     time_question_start = models.DateTimeField('Time question starts', null=True)
     time_question_end = models.DateTimeField('Time question ends', null=True)
     time_question_elapsed = models.TimeField('Time taken to make the prediction', null=True, blank=True)
+    # set on every save, the QuerySet.update() calls must set it too (read by the admin monitor)
+    time_updated = models.DateTimeField('Last update', auto_now=True, db_index=True)
 
     def get_decision_interval(self):
         """:returns timedelta"""
@@ -338,6 +352,7 @@ class GameData(models.Model):
 
     class Meta:
         ordering = ('session', 'player__group', 'player')
+        unique_together = ('player', 'session', 'round')
 
 
 def generate_random_password():
@@ -351,9 +366,13 @@ def generate_random_password():
 
 
 class RunNow(models.Model):
+    """
+    Run state of a session. Several sessions can be run at the same time, each one with its own row
+    (see config.get_run).
+    """
     experiment_id = models.IntegerField('Experiment ID', default=0)
     treatment_id = models.IntegerField('Treatment ID', default=0)
-    session_id = models.IntegerField('Session ID', default=0)
+    session_id = models.IntegerField('Session ID', default=0, unique=True)
     experiment_on = models.BooleanField(default=False)
 
     def __str__(self):
@@ -362,41 +381,45 @@ class RunNow(models.Model):
 
 
 class RequestMonitor(models.Model):
+    """
+    Barrier of a group. Monitors are identified by (group, phase, round) and are created
+    the first time a member of the group touches them (see experiments.monitors).
+    """
     name = models.CharField(max_length=20)
+    phase = models.IntegerField('Phase', choices=Constants.MONITOR_PHASES, default=Constants.MONITOR_PHASE_S4)
+    round = models.IntegerField('Round', default=0)
     var = models.IntegerField('Queue 1', default=0)
     condition = models.BooleanField('Condition', default=False)
     group = models.ForeignKey("Group", related_name="monitors", on_delete=models.PROTECT)
     queue = models.ManyToManyField(Player, related_name='monitors', blank=True)
 
     @staticmethod
-    @transaction.atomic
-    def wait(player, monitor_name):
-        monitor = RequestMonitor.objects.get(group=player.group,
-                                             name=monitor_name)
-        if player not in monitor.queue.all():
-            monitor.queue.add(player)
-            RequestMonitor.objects.filter(id=monitor.id).update(var=F('var') + 1)
+    def get_name(phase, g_round=0):
+        """:returns str - name of the monitor of the phase and round"""
+        if phase == Constants.MONITOR_PHASE_S4:
+            return Constants.MONITOR_S4
+        return "{}r{}".format(dict(Constants.MONITOR_PHASES)[phase], g_round)
+
+    @staticmethod
+    def wait(player, phase, g_round=0):
+        from .monitors import get_monitor_backend
+        get_monitor_backend().wait(player, phase, g_round)
 
     @staticmethod
-    @transaction.atomic
-    def check_condition(group, monitor_name, condition, update_value):
-        monitor = RequestMonitor.objects.get(group=group, name=monitor_name)
-        # If the condition is not update_value, then we update the condition if it's true
-        if monitor.condition is not update_value:
-            if condition(monitor.var):
-                RequestMonitor.objects.filter(id=monitor.id).update(condition=update_value)
-        monitor.refresh_from_db()
+    def check_condition(group, phase, g_round, condition, update_value):
+        from .monitors import get_monitor_backend
+        return get_monitor_backend().check_condition(group, phase, g_round, condition, update_value)
 
-        return monitor.condition
+    @staticmethod
+    def signal(player, phase, g_round=0):
+        from .monitors import get_monitor_backend
+        get_monitor_backend().signal(player, phase, g_round)
 
     @staticmethod
-    @transaction.atomic
-    def signal(player, monitor_name):
-        monitor = RequestMonitor.objects.get(group=player.group,
-                                             name=monitor_name)
-        if player in monitor.queue.all():
-            monitor.queue.remove(player)
-            RequestMonitor.objects.filter(id=monitor.id).update(var=F('var') - 1)
+    def queues_of(player):
+        """:returns list - (phase, round) of the monitors in which the player is waiting"""
+        from .monitors import get_monitor_backend
+        return get_monitor_backend().player_queues(player)
 
     def validate_unique(self, *args, **kwargs):
         super(RequestMonitor, self).validate_unique(*args, **kwargs)
@@ -412,6 +435,7 @@ class RequestMonitor(models.Model):
 
     class Meta:
         ordering = ('group',)
+        unique_together = ('group', 'phase', 'round')
 
     def __str__(self):
         return "{} {}".format(self.group, self.name)
@@ -427,6 +451,9 @@ class Group(models.Model):
     game_finished = models.BooleanField("Indicate if the game has finished", default=False)
     public_account = models.IntegerField("Public account of the group", default=0)
     current_round = models.IntegerField("indicates the current round of the game", default=0)
+    round_contributions = models.CharField("Contributions of the group on each round", max_length=1000, default="",
+                                           blank=True, validators=[validate_comma_separated_integer_list])
+    members_acted = models.IntegerField("Number of members that have acted on the current round", default=0)
     random_value = models.FloatField("Random value generated to determine loss", default=0)
     random_value_generated = models.BooleanField("Indicate if the random value has been already generated",
                                                  default=False)
@@ -434,6 +461,35 @@ class Group(models.Model):
     def __str__(self):
         return "{} Group {}".format(self.session, self.group_number)
 
+    def get_round_contributions(self):
+        """:returns list - total contribution of the group on each round (starting from round 1)"""
+        if not self.round_contributions:
+            return []
+        return [int(contribution) for contribution in self.round_contributions.split(',')]
+
+    @staticmethod
+    def add_contribution(group_id, g_round, contribution):
+        """
+        Adds the contribution of a member to the running totals of the group, so that the public
+        account can be read without aggregating the profiles of the group. The group row is locked
+        until the end of the surrounding transaction.
+        :param group_id: id of the group
+        :param g_round: round in which the member acted (starting from 1)
+        :param contribution: amount transferred to the public account
+        """
+        with transaction.atomic(using=router.db_for_write(Group), savepoint=False):
+            group = Group.objects.select_for_update().only(
+                'current_round', 'round_contributions', 'members_acted').get(pk=group_id)
+            contributions = group.get_round_contributions()
+            contributions += [0] * (g_round - len(contributions))
+            contributions[g_round - 1] += contribution
+            members_acted = group.members_acted + 1 if group.current_round == g_round else 1
+            Group.objects.filter(pk=group_id).update(
+                public_account=F('public_account') + contribution,
+                round_contributions=','.join(str(c) for c in contributions),
+                members_acted=members_acted,
+                current_round=g_round)
+
     def get_round_dice_result(self, current_round, min_round):
         """
         Returns the result of the dice for the correspondent round
@@ -0,0 +1,345 @@
+# coding=utf-8
+# ==============================================================================
+# beelbe
+# Copyright © 2016 Elias F. Domingos. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Backends for the group barriers (RequestMonitor). A barrier is identified by the integer
+key (group, phase, round) and its state is created the first time a member of the group
+touches it, so only the rounds that are actually played get a monitor.
+All backends implement the same wait/signal/check_condition semantics:
+- wait: adds the player to the queue of the monitor and increments var.
+- signal: removes the player from the queue and decrements var.
+- check_condition: sets condition to update_value if condition(var) holds and returns it.
+
+The backend is selected with the EXPERIMENTS_MONITOR_BACKEND setting:
+- experiments.monitors.DatabaseMonitorBackend: every operation runs on the RequestMonitor table.
+- experiments.monitors.MemoryMonitorBackend: operations run on in-process counters and the
+  RequestMonitor table is only updated by a write-behind flush (audit log). The state of a
+  group is loaded from the table the first time the group is touched, so a restart resumes
+  from the last flush. Only valid when the server runs a single process.
+"""
+
+# import the logging library
+import logging
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import close_old_connections, DatabaseError
+from django.db.models import F
+from django.utils.module_loading import import_string
+
+from . import routers
+from .constants import Constants
+from .models import RequestMonitor, Group
+
+# Get an instance of a logger
+logger = logging.getLogger(__name__)
+
+DEFAULT_MONITOR_BACKEND = 'experiments.monitors.DatabaseMonitorBackend'
+
+_backend = None
+_backend_lock = threading.Lock()
+
+# State of a monitor, queue is the set of ids of the players waiting on it
+MonitorSnapshot = namedtuple('MonitorSnapshot', ('group_id', 'phase', 'round', 'var', 'condition', 'queue'))
+
+
+class BaseMonitorBackend(object):
+    """
+    Interface for the monitor backends.
+    """
+
+    def wait(self, player, phase, g_round=0):
+        raise NotImplementedError
+
+    def signal(self, player, phase, g_round=0):
+        raise NotImplementedError
+
+    def check_condition(self, group, phase, g_round, condition, update_value):
+        raise NotImplementedError
+
+    def player_queues(self, player):
+        """:returns list - (phase, round) of the monitors in which the player is waiting"""
+        raise NotImplementedError
+
+    def reset(self, session):
+        """Empties the queues and resets the counters of all monitors of the session"""
+        raise NotImplementedError
+
+    def session_monitors(self, session):
+        """:returns list - MonitorSnapshot of every monitor of the session"""
+        raise NotImplementedError
+
+
+class DatabaseMonitorBackend(BaseMonitorBackend):
+    """
+    Keeps the state of the monitors on the RequestMonitor table.
+    """
+
+    @staticmethod
+    def get_monitor(group_id, phase, g_round):
+        """Point read on (group, phase, round), creating the monitor on first use"""
+        return RequestMonitor.objects.get_or_create(group_id=group_id, phase=phase, round=g_round,
+                                                    defaults={'name': RequestMonitor.get_name(phase, g_round)})[0]
+
+    def wait(self, player, phase, g_round=0):
+        with routers.atomic():
+            monitor = self.get_monitor(player.group_id, phase, g_round)
+            if not monitor.queue.filter(pk=player.pk).exists():
+                monitor.queue.add(player)
+                RequestMonitor.objects.filter(id=monitor.id).update(var=F('var') + 1)
+
+    def signal(self, player, phase, g_round=0):
+        with routers.atomic():
+            monitor = self.get_monitor(player.group_id, phase, g_round)
+            if monitor.queue.filter(pk=player.pk).exists():
+                monitor.queue.remove(player)
+                RequestMonitor.objects.filter(id=monitor.id).update(var=F('var') - 1)
+
+    def check_condition(self, group, phase, g_round, condition, update_value):
+        with routers.atomic():
+            monitor = self.get_monitor(group.pk, phase, g_round)
+            # If the condition is not update_value, then we update the condition if it's true
+            if monitor.condition is not update_value:
+                if condition(monitor.var):
+                    RequestMonitor.objects.filter(id=monitor.id).update(condition=update_value)
+            monitor.refresh_from_db()
+
+            return monitor.condition
+
+    def player_queues(self, player):
+        return list(player.monitors.values_list('phase', 'round'))
+
+    def reset(self, session):
+        RequestMonitor.objects.filter(group__session=session).update(var=0, condition=False)
+        RequestMonitor.queue.through.objects.filter(requestmonitor__group__session=session).delete()
+
+    def session_monitors(self, session):
+        monitors = {monitor_id: MonitorSnapshot(group_id, phase, g_round, var, condition, set())
+                    for monitor_id, group_id, phase, g_round, var, condition in RequestMonitor.objects.filter(
+                        group__session=session).values_list('id', 'group_id', 'phase', 'round', 'var', 'condition')}
+        for monitor_id, player_id in RequestMonitor.queue.through.objects.filter(
+                requestmonitor__group__session=session).values_list('requestmonitor_id', 'player_id'):
+            monitors[monitor_id].queue.add(player_id)
+        return list(monitors.values())
+
+
+class _MonitorState(object):
+    __slots__ = ('id', 'var', 'condition', 'queue')
+
+    def __init__(self, monitor_id, var, condition, queue):
+        self.id = monitor_id
+        self.var = var
+        self.condition = condition
+        self.queue = queue
+
+
+class MemoryMonitorBackend(BaseMonitorBackend):
+    """
+    Keeps the state of the monitors in memory, protected by a single lock (every operation
+    is O(1), and the monitors of a group are read from the table before taking the lock, so
+    the lock is never held for long). Modified monitors are written back to
+    the RequestMonitor table every EXPERIMENTS_MONITOR_FLUSH_INTERVAL seconds; the rows of
+    new monitors are created on the first flush after they are touched.
+    """
+
+    def __init__(self, flush_interval=None):
+        self.flush_interval = flush_interval if flush_interval is not None else getattr(
+            settings, 'EXPERIMENTS_MONITOR_FLUSH_INTERVAL', 1.0)
+        self._lock = threading.RLock()
+        # group id -> {(phase, round) -> _MonitorState}
+        self._groups = {}
+        # group id -> session id, used on reset and to write the monitors back to the database of the session
+        self._sessions = {}
+        # (group id, phase, round) of the monitors that must be written back
+        self._dirty = set()
+        self._flusher = None
+
+    def _load_group(self, group_id):
+        """
+        Loads all monitors of the group from the table (only the first time the group is touched). The
+        queries run outside of the lock, so they don't block the other groups; if another thread loaded
+        the group in the meantime, its monitors are kept.
+        """
+        monitors = {}
+        session_id = None
+        for monitor_id, phase, g_round, var, condition, session_id in RequestMonitor.objects.filter(
+                group_id=group_id).values_list('id', 'phase', 'round', 'var', 'condition', 'group__session_id'):
+            monitors[(phase, g_round)] = _MonitorState(monitor_id, var, condition, set())
+        by_id = {state.id: state for state in monitors.values()}
+        for monitor_id, player_id in RequestMonitor.queue.through.objects.filter(
+                requestmonitor__group_id=group_id).values_list('requestmonitor_id', 'player_id'):
+            by_id[monitor_id].queue.add(player_id)
+        if session_id is None:
+            session_id = Group.objects.filter(pk=group_id).values_list('session_id', flat=True).first()
+        with self._lock:
+            self._sessions.setdefault(group_id, session_id)
+            return self._groups.setdefault(group_id, monitors)
+
+    @contextmanager
+    def _group(self, group_id):
+        """Holds the lock with the monitors of the group loaded, and yields them"""
+        while True:
+            if group_id not in self._groups:
+                self._load_group(group_id)
+            self._lock.acquire()
+            if group_id in self._groups:
+                break
+            # the session of the group was reset in between
+            self._lock.release()
+        try:
+            yield self._groups[group_id]
+        finally:
+            self._lock.release()
+
+    def _get(self, monitors, group_id, phase, g_round):
+        """:returns _MonitorState - monitor of the group, created if needed (the lock must be held)"""
+        try:
+            return monitors[(phase, g_round)]
+        except KeyError:
+            monitors[(phase, g_round)] = _MonitorState(None, 0, False, set())
+            self._mark_dirty(group_id, phase, g_round)
+            return monitors[(phase, g_round)]
+
+    def _mark_dirty(self, group_id, phase, g_round):
+        self._dirty.add((group_id, phase, g_round))
+        self._ensure_flusher()
+
+    def wait(self, player, phase, g_round=0):
+        with self._group(player.group_id) as monitors:
+            monitor = self._get(monitors, player.group_id, phase, g_round)
+            if player.pk not in monitor.queue:
+                monitor.queue.add(player.pk)
+                monitor.var += 1
+                self._mark_dirty(player.group_id, phase, g_round)
+
+    def signal(self, player, phase, g_round=0):
+        with self._group(player.group_id) as monitors:
+            monitor = self._get(monitors, player.group_id, phase, g_round)
+            if player.pk in monitor.queue:
+                monitor.queue.remove(player.pk)
+                monitor.var -= 1
+                self._mark_dirty(player.group_id, phase, g_round)
+
+    def check_condition(self, group, phase, g_round, condition, update_value):
+        while True:
+            with self._group(group.pk) as monitors:
+                monitor = self._get(monitors, group.pk, phase, g_round)
+                var, current = monitor.var, monitor.condition
+            # The condition may run queries, so it is evaluated outside of the lock
+            if current is update_value or not condition(var):
+                return current
+            with self._lock:
+                # Only update if nobody modified the monitor in the meantime, otherwise check again
+                if monitor.var == var and monitor.condition is current:
+                    monitor.condition = update_value
+                    self._mark_dirty(group.pk, phase, g_round)
+                    return update_value
+
+    def player_queues(self, player):
+        with self._group(player.group_id) as monitors:
+            return [key for key, monitor in monitors.items() if player.pk in monitor.queue]
+
+    def reset(self, session):
+        self.flush()
+        with self._lock:
+            for group_id in [g for g, s in self._sessions.items() if s == session.pk]:
+                self._groups.pop(group_id, None)
+                self._sessions.pop(group_id, None)
+            self._dirty = {key for key in self._dirty if key[0] in self._groups}
+        DatabaseMonitorBackend().reset(session)
+
+    def session_monitors(self, session):
+        group_ids = list(Group.objects.filter(session=session).values_list('id', flat=True))
+        snapshots = []
+        for group_id in group_ids:
+            with self._group(group_id) as monitors:
+                for (phase, g_round), monitor in monitors.items():
+                    snapshots.append(MonitorSnapshot(group_id, phase, g_round, monitor.var, monitor.condition,
+                                                     set(monitor.queue)))
+        return snapshots
+
+    def flush(self):
+        """Writes the modified monitors back to the RequestMonitor table (of the database of each session)"""
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            snapshots = {}
+            for group_id, phase, g_round in dirty:
+                monitor = self._groups.get(group_id, {}).get((phase, g_round))
+                if monitor is not None:
+                    snapshots.setdefault(self._sessions.get(group_id), []).append(
+                        (group_id, phase, g_round, monitor, monitor.var, monitor.condition, set(monitor.queue)))
+        for session_id, snapshot in snapshots.items():
+            created = []
+            try:
+                with routers.session_database(session_id), routers.atomic():
+                    through = RequestMonitor.queue.through
+                    for group_id, phase, g_round, monitor, var, condition, queue in snapshot:
+                        if monitor.id is None:
+                            monitor.id = DatabaseMonitorBackend.get_monitor(group_id, phase, g_round).id
+                            created.append(monitor)
+                        RequestMonitor.objects.filter(id=monitor.id).update(var=var, condition=condition)
+                        through.objects.filter(requestmonitor_id=monitor.id).exclude(player_id__in=queue).delete()
+                        stored = set(through.objects.filter(requestmonitor_id=monitor.id).values_list(
+                            'player_id', flat=True))
+                        through.objects.bulk_create([through(requestmonitor_id=monitor.id, player_id=player_id)
+                                                     for player_id in queue - stored])
+            except DatabaseError:
+                logger.exception("[ERROR] Could not write back {} monitors, retrying later".format(len(snapshot)))
+                with self._lock:
+                    # the rows created in the failed transaction were rolled back
+                    for monitor in created:
+                        monitor.id = None
+                    self._dirty.update((group_id, phase, g_round) for group_id, phase, g_round, *_ in snapshot)
+
+    def _ensure_flusher(self):
+        if self._flusher is None or not self._flusher.is_alive():
+            self._flusher = threading.Thread(target=self._flush_loop, name='beelbe-monitor-flusher', daemon=True)
+            self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            close_old_connections()
+            self.flush()
+
+
+def get_monitor_key(monitor_keys, g_round):
+    """
+    Selects the monitor for the current round among the queues in which a player waits
+    :param monitor_keys: list with the (phase, round) of the monitors
+    :param g_round: current round of the player
+    :return: (phase, round) of the monitor
+    """
+    if (Constants.MONITOR_PHASE_S4, 0) in monitor_keys:
+        return Constants.MONITOR_PHASE_S4, 0
+    try:
+        return sorted([key for key in monitor_keys if key[1] == g_round], reverse=True)[0]
+    except IndexError:
+        raise
+
+
+def get_monitor_backend():
+    """:returns BaseMonitorBackend - the process-wide monitor backend selected in the settings"""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = import_string(getattr(settings, 'EXPERIMENTS_MONITOR_BACKEND', DEFAULT_MONITOR_BACKEND))()
+    return _backend
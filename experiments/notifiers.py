@@ -0,0 +1,228 @@
+# coding=utf-8
+# ==============================================================================
+# beelbe
+# Copyright © 2016 Elias F. Domingos. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Notifiers used to wake up the participants that are waiting on a group barrier
+(see experiments.views.sync_view).
+
+There is one channel per barrier (group, phase and round), so a waiting request is only
+woken up by the events of its own barrier. A notifier keeps a version counter per channel.
+A waiting request subscribes to the channel, reads the version before checking the monitor
+condition and then blocks until the version changes, so a notification sent between the
+check and the wait is never lost. The channels are dropped when nobody is subscribed.
+
+The backend is selected with the EXPERIMENTS_BARRIER_NOTIFIER setting:
+- experiments.notifiers.LocalNotifier: in-process, only valid when the server runs a single process.
+- experiments.notifiers.PostgresNotifier: uses PostgreSQL LISTEN/NOTIFY on the database of the session
+  (see experiments.routers), so every process is woken up.
+"""
+
+# import the logging library
+import logging
+import select
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections
+from django.utils.module_loading import import_string
+
+from . import routers
+
+# Get an instance of a logger
+logger = logging.getLogger(__name__)
+
+DEFAULT_NOTIFIER = 'experiments.notifiers.LocalNotifier'
+PG_CHANNEL = 'beelbe_barrier'
+
+_notifier = None
+_notifier_lock = threading.Lock()
+
+
+def group_channel(group, phase, g_round=0):
+    """
+    :param group: Group object or group id
+    :param phase: phase of the monitor
+    :param g_round: round of the monitor
+    :return: name of the channel on which the events of the barrier of the group are published
+    """
+    return "group_{}_{}_{}".format(getattr(group, 'pk', group), phase, g_round)
+
+
+def release_connections():
+    """
+    Closes the database connections of the thread (but the ones inside a transaction), so that a
+    request blocked on a barrier doesn't hold a connection. They are opened again on the next query.
+    """
+    for connection in connections.all():
+        if not connection.in_atomic_block:
+            connection.close()
+
+
+class BaseNotifier(object):
+    """
+    Interface for the barrier notifiers.
+    """
+
+    @contextmanager
+    def subscribe(self, channel):
+        """Keeps the channel while the block runs, the version reads and waits must be done inside"""
+        yield
+
+    def version(self, channel):
+        """:returns int - current version of the channel"""
+        raise NotImplementedError
+
+    def notify(self, channel):
+        """Wakes up every request waiting on the channel"""
+        raise NotImplementedError
+
+    def wait(self, channel, version, timeout):
+        """
+        Blocks until the channel moves past version or the timeout expires.
+        :param channel: channel name
+        :param version: version read before checking the barrier condition
+        :param timeout: maximum number of seconds to block
+        :return: True if the channel was notified, else False
+        """
+        raise NotImplementedError
+
+
+class LocalNotifier(BaseNotifier):
+    """
+    In-process notifier based on one threading.Condition per channel. A channel is dropped when
+    its last subscriber leaves, the notifications of the channels without subscribers are ignored.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # channel -> [version, condition, number of subscribers]
+        self._channels = {}
+
+    def _get_channel(self, channel):
+        with self._lock:
+            try:
+                return self._channels[channel]
+            except KeyError:
+                self._channels[channel] = [0, threading.Condition(threading.Lock()), 0]
+                return self._channels[channel]
+
+    @contextmanager
+    def subscribe(self, channel):
+        with self._lock:
+            state = self._channels.setdefault(channel, [0, threading.Condition(threading.Lock()), 0])
+            state[2] += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                state[2] -= 1
+                if state[2] == 0 and self._channels.get(channel) is state:
+                    del self._channels[channel]
+
+    def version(self, channel):
+        return self._get_channel(channel)[0]
+
+    def notify(self, channel):
+        with self._lock:
+            state = self._channels.get(channel)
+        if state is None:
+            return
+        with state[1]:
+            state[0] += 1
+            state[1].notify_all()
+
+    def wait(self, channel, version, timeout):
+        state = self._get_channel(channel)
+        with state[1]:
+            return state[1].wait_for(lambda: state[0] != version, timeout=timeout)
+
+    def clear(self):
+        """Drops every channel (e.g. when a new session is initialized)"""
+        with self._lock:
+            self._channels = {}
+
+
+class PostgresNotifier(LocalNotifier):
+    """
+    Publishes the notifications with PostgreSQL NOTIFY on the database of the active session
+    (see experiments.routers), or on the database given to the constructor. Each process runs
+    a single listener thread per database that forwards the notifications to its local waiters,
+    so the number of database connections does not grow with the number of waiting participants.
+    NOTIFY is only delivered when the surrounding transaction commits.
+    """
+
+    def __init__(self, using=None):
+        super(PostgresNotifier, self).__init__()
+        self.using = using
+        # database alias -> listener thread
+        self._listeners = {}
+        self._listener_lock = threading.Lock()
+
+    def _database(self):
+        return self.using or routers.get_database()
+
+    def notify(self, channel):
+        with connections[self._database()].cursor() as cursor:
+            cursor.execute("SELECT pg_notify(%s, %s)", [PG_CHANNEL, channel])
+
+    def wait(self, channel, version, timeout):
+        self._ensure_listener(self._database())
+        return super(PostgresNotifier, self).wait(channel, version, timeout)
+
+    def _ensure_listener(self, using):
+        with self._listener_lock:
+            listener = self._listeners.get(using)
+            if listener is None or not listener.is_alive():
+                listener = threading.Thread(target=self._listen, args=(using,),
+                                            name='beelbe-barrier-listener-{}'.format(using), daemon=True)
+                listener.start()
+                self._listeners[using] = listener
+
+    def _listen(self, using):
+        import psycopg2
+        import psycopg2.extensions
+
+        db = settings.DATABASES[using]
+        while True:
+            try:
+                conn = psycopg2.connect(dbname=db['NAME'], user=db['USER'], password=db['PASSWORD'],
+                                        host=db['HOST'] or None, port=db['PORT'] or None)
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                with conn.cursor() as cursor:
+                    cursor.execute("LISTEN {};".format(PG_CHANNEL))
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        event = conn.notifies.pop(0)
+                        super(PostgresNotifier, self).notify(event.payload)
+            except Exception:
+                logger.exception("[ERROR] Barrier listener of {} lost its connection, reconnecting".format(using))
+                time.sleep(1)
+
+
+def get_notifier():
+    """:returns BaseNotifier - the process-wide notifier selected in the settings"""
+    global _notifier
+    if _notifier is None:
+        with _notifier_lock:
+            if _notifier is None:
+                _notifier = import_string(getattr(settings, 'EXPERIMENTS_BARRIER_NOTIFIER', DEFAULT_NOTIFIER))()
+    return _notifier
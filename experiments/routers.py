@@ -0,0 +1,356 @@
+# coding=utf-8
+# ==============================================================================
+# beelbe
+# Copyright © 2016 Elias F. Domingos. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Placement of the live state of the sessions on several databases.
+
+A session whose `database` field names an alias of settings.DATABASES is played on that database:
+the rows written during the game (players, profiles, groups, barriers and game data, see LIVE_MODELS)
+are read and written there, so the locks and the write load of a session never reach the sessions
+played on other databases. The other rows (users, sessions, experiments, treatments, games, runs...)
+are always read and written on the archive database (EXPERIMENTS_ARCHIVE_DATABASE).
+
+The database of a query is the one of the session activated on the thread (see activate and
+session_database). SessionDatabaseMiddleware activates the session of each request, and the objects
+loaded from a database keep using it (e.g. player.profile). Transactions on the live state must be
+opened with routers.atomic, which opens them on the database of the active session.
+
+When a session is initialised (utils.init_experiment) its rows are copied to its database with
+place_session. Django doesn't support relations across databases, so the reference rows that the
+live rows point to are copied as well: they are only used by the foreign keys and the joins, but for
+User.is_active, which the barriers count, so its changes are copied to the database of the session
+while the session is played there (see sync_user_activity).
+Once the session is finished, manage.py consolidate_sessions copies the live rows back to the archive
+database with consolidate_session and clears Session.database in the same transaction, so the session
+is read from the archive database from then on and is never consolidated twice.
+"""
+
+# import the logging library
+import logging
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.color import no_style
+from django.db import connections, transaction
+from django.db.models import AutoField
+from django.db.models.signals import post_save
+
+from . import config
+from .models import (Experiment, Treatment, Session, Game, Player, Profile, Group, RequestMonitor, GameData)
+
+# Get an instance of a logger
+logger = logging.getLogger(__name__)
+
+# models of the live state of the sessions, by model name (the queue of the monitors is a many to many table)
+LIVE_MODELS = frozenset(['player', 'profile', 'group', 'requestmonitor', 'requestmonitor_queue', 'gamedata'])
+ROUTED_APPS = frozenset(['experiments', 'auth'])
+# key of the session of the participant in request.session
+SESSION_KEY = 'experiments_session_id'
+
+_local = threading.local()
+
+
+def get_archive_database():
+    """:returns str - alias of the database that holds everything but the live state of the sharded sessions"""
+    return getattr(settings, 'EXPERIMENTS_ARCHIVE_DATABASE', 'default')
+
+
+def get_session_database(session_id):
+    """
+    :param session_id: id of a session
+    :return: str - alias of the database of the live state of the session (the archive database once
+             the session is consolidated)
+    """
+    try:
+        session = config.get_session(session_id)
+    except Session.DoesNotExist:
+        return get_archive_database()
+    if not session.database:
+        return get_archive_database()
+    if session.database not in connections.databases:
+        raise ImproperlyConfigured("The database {} of session {} is not in settings.DATABASES".format(
+            session.database, session_id))
+    return session.database
+
+
+def activate(session_id):
+    """Routes the live state of the following queries of the thread to the database of the session"""
+    _local.database = get_session_database(session_id) if session_id is not None else None
+
+
+def deactivate():
+    _local.database = None
+
+
+def get_database():
+    """:returns str - alias of the database of the live state of the active session"""
+    return getattr(_local, 'database', None) or get_archive_database()
+
+
+@contextmanager
+def session_database(session_id):
+    """
+    Activates the database of a session inside the block (None activates the archive database)
+    :param session_id: id of the session
+    """
+    previous = getattr(_local, 'database', None)
+    activate(session_id)
+    try:
+        yield get_database()
+    finally:
+        _local.database = previous
+
+
+def on_archive(func):
+    """Runs the function on the archive database, e.g. the initialisation of a session"""
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with session_database(None):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def atomic(savepoint=True):
+    """:returns transaction.atomic on the database of the active session"""
+    return transaction.atomic(using=get_database(), savepoint=savepoint)
+
+
+def is_live(model):
+    return model._meta.app_label == 'experiments' and model._meta.model_name in LIVE_MODELS
+
+
+class SessionRouter(object):
+    """
+    Routes the live state to the database of the active session (or to the database from which an
+    object was loaded), and the rest of the experiments rows to the archive database.
+    """
+
+    @staticmethod
+    def _database(model, **hints):
+        if model._meta.app_label != 'experiments':
+            return None
+        if not is_live(model):
+            return get_archive_database()
+        instance = hints.get('instance')
+        if instance is not None and is_live(type(instance)) and instance._state.db:
+            return instance._state.db
+        return get_database()
+
+    def db_for_read(self, model, **hints):
+        return self._database(model, **hints)
+
+    def db_for_write(self, model, **hints):
+        return self._database(model, **hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the rows the live state points to are copied to the databases of the sessions
+        if obj1._meta.app_label in ROUTED_APPS and obj2._meta.app_label in ROUTED_APPS:
+            return True
+        return None
+
+
+def _session_rows(session, using):
+    """:returns list - querysets of the live rows of the session on a database, but the players"""
+    return [
+        Group.objects.using(using).filter(session=session),
+        Profile.objects.using(using).filter(player__session=session),
+        RequestMonitor.objects.using(using).filter(group__session=session),
+        RequestMonitor.queue.through.objects.using(using).filter(requestmonitor__group__session=session),
+        GameData.objects.using(using).filter(session=session),
+    ]
+
+
+def _clear_session(session, using):
+    """Deletes the rows of the session from the database of a session (not from the archive database)"""
+    players = Player.objects.using(using).filter(session=session)
+    user_ids = list(players.values_list('pk', flat=True))
+    # the players point to their group (PROTECT)
+    players.update(group=None)
+    for queryset in reversed(_session_rows(session, using)):
+        queryset._raw_delete(using)
+    players._raw_delete(using)
+    User.objects.using(using).filter(pk__in=user_ids)._raw_delete(using)
+
+
+def _reset_sequences(models, using):
+    # the rows are copied with their primary keys, the following inserts must not reuse them
+    connection = connections[using]
+    statements = connection.ops.sequence_reset_sql(no_style(), models)
+    if statements:
+        with connection.cursor() as cursor:
+            for statement in statements:
+                cursor.execute(statement)
+
+
+def place_session(session, batch_size=500):
+    """
+    Copies the rows of a session from the archive database to the database of the session (replacing
+    the ones it already holds). It is called when the session is initialised.
+    :param session: Session object
+    :param batch_size: number of rows inserted per query
+    :return: str - alias of the database of the session
+    """
+    archive = get_archive_database()
+    target = get_session_database(session.pk)
+    if target == archive:
+        return target
+
+    with transaction.atomic(using=target):
+        _clear_session(session, target)
+        # rows referenced by the live state
+        treatment = Treatment.objects.using(archive).get(pk=session.treatment_id)
+        game = Game.objects.using(archive).get(pk=treatment.game_id)
+        game = getattr(game, 'collectiveriskgame', game)
+        for row in (Experiment.objects.using(archive).get(pk=session.experiment_id), game, treatment,
+                    Session.objects.using(archive).get(pk=session.pk)):
+            row.save(using=target)
+
+        groups, profiles, monitors, queues, game_data = _session_rows(session, archive)
+        rows = [User.objects.using(archive).filter(player__session=session), groups,
+                Player.objects.using(archive).filter(session=session), profiles, monitors, queues, game_data]
+        for queryset in rows:
+            queryset.model.objects.using(target).bulk_create(queryset.order_by('pk').iterator(chunk_size=batch_size),
+                                                             batch_size=batch_size)
+        _reset_sequences([queryset.model for queryset in rows], target)
+    logger.info("[PLACE] Session {} is played on database {}".format(session.pk, target))
+    return target
+
+
+def sync_user_activity(sender, instance, using, update_fields=None, **kwargs):
+    """
+    Copies the active flag of a user saved on the archive database (e.g. a participant deactivated in the
+    admin) to the database of its session, where the barriers and the watchdog count the active members
+    """
+    if using != get_archive_database() or (update_fields is not None and 'is_active' not in update_fields):
+        return
+    session_id = Player.objects.using(using).filter(user_id=instance.pk).values_list('session_id', flat=True).first()
+    if session_id is None:
+        return
+    target = get_session_database(session_id)
+    if target != using:
+        User.objects.using(target).filter(pk=instance.pk).update(is_active=instance.is_active)
+
+
+post_save.connect(sync_user_activity, sender=User, dispatch_uid='routers_sync_user_activity')
+
+
+def _copy_rows(model, rows, archive_rows, key, fields, using, batch_size):
+    """
+    Makes the archive rows of a model equal to the rows read from the database of a session: the archive
+    rows with the same key are updated in place, the missing ones are inserted and only then the archive
+    rows that are not in the copy are deleted.
+    :param model: model of the rows
+    :param rows: list - rows read from the database of the session (their primary keys are replaced)
+    :param archive_rows: queryset - rows of the session on the archive database
+    :param key: callable that returns the natural key of a row (its primary key is not kept)
+    :param fields: list - names of the fields updated in place
+    :param using: alias of the archive database
+    :param batch_size: number of rows inserted or updated per query
+    """
+    existing = {key(row): row.pk for row in archive_rows}
+    updated, created = [], []
+    for row in rows:
+        pk = existing.pop(key(row), None)
+        if pk is not None:
+            row.pk = pk
+            updated.append(row)
+        else:
+            if isinstance(model._meta.pk, AutoField):
+                row.pk = None
+            created.append(row)
+    if updated and fields:
+        model.objects.using(using).bulk_update(updated, fields, batch_size=batch_size)
+    model.objects.using(using).bulk_create(created, batch_size=batch_size)
+    if existing:
+        model.objects.using(using).filter(pk__in=list(existing.values()))._raw_delete(using)
+
+
+def consolidate_session(session, purge=False, batch_size=500):
+    """
+    Copies the live rows of a session back from its database to the archive database and clears
+    Session.database, in a single transaction. The rows of the session on its database are read first,
+    the archive rows are then updated in place or inserted (the monitors and the game data created during
+    the session get new primary keys), and the archive rows that are not in the copy are deleted last.
+    :param session: Session object
+    :param purge: bool - delete the rows of the session from its database afterwards
+    :param batch_size: number of rows inserted or updated per query
+    :return: int - number of game data rows copied
+    :raises ValueError: if the session has no rows on its database (e.g. they were already purged)
+    """
+    archive = get_archive_database()
+    source = session.database
+    if not source or source == archive:
+        return 0
+
+    from .monitors import get_monitor_backend, MemoryMonitorBackend
+    backend = get_monitor_backend()
+    if isinstance(backend, MemoryMonitorBackend):
+        # the monitors modified since the last flush are only in memory
+        backend.flush()
+
+    groups, profiles, monitors, queues, game_data = (list(queryset.order_by('pk'))
+                                                      for queryset in _session_rows(session, source))
+    players = list(Player.objects.using(source).filter(session=session))
+    if not players or not profiles:
+        raise ValueError("Session {} has no rows on database {}, nothing to consolidate".format(session.pk, source))
+
+    through = RequestMonitor.queue.through
+    monitor_keys = {monitor.pk: (monitor.group_id, monitor.phase, monitor.round) for monitor in monitors}
+    monitor_fields = [field.name for field in RequestMonitor._meta.concrete_fields if not field.primary_key]
+    game_data_fields = [field.name for field in GameData._meta.concrete_fields if not field.primary_key]
+    with transaction.atomic(using=archive):
+        fields = [field.name for field in Group._meta.concrete_fields if not field.primary_key]
+        Group.objects.using(archive).bulk_update(groups, fields, batch_size=batch_size)
+        Player.objects.using(archive).bulk_update(players, ['group'], batch_size=batch_size)
+        fields = [field.name for field in Profile._meta.concrete_fields if not field.primary_key]
+        _copy_rows(Profile, profiles, Profile.objects.using(archive).filter(player__session=session),
+                   lambda row: row.pk, fields, archive, batch_size)
+
+        _copy_rows(RequestMonitor, monitors, RequestMonitor.objects.using(archive).filter(group__session=session),
+                   lambda row: (row.group_id, row.phase, row.round), monitor_fields, archive, batch_size)
+        monitor_ids = {(monitor.group_id, monitor.phase, monitor.round): monitor.pk for monitor in monitors}
+        queues = [through(requestmonitor_id=monitor_ids[monitor_keys[row.requestmonitor_id]], player_id=row.player_id)
+                  for row in queues]
+        _copy_rows(through, queues, through.objects.using(archive).filter(requestmonitor__group__session=session),
+                   lambda row: (row.requestmonitor_id, row.player_id), [], archive, batch_size)
+
+        _copy_rows(GameData, game_data, GameData.objects.using(archive).filter(session=session),
+                   lambda row: (row.player_id, row.session_id, row.round), game_data_fields, archive, batch_size)
+
+        copied = [queryset.count() for queryset in _session_rows(session, archive)[1:]]
+        expected = [len(profiles), len(monitors), len(queues), len(game_data)]
+        if copied != expected:
+            # rolls back the copy, the archive keeps its previous rows
+            raise ValueError("Session {} was not completely copied to {}: {} rows instead of {}".format(
+                session.pk, archive, copied, expected))
+
+        # the session is read from the archive database from now on
+        Session.objects.using(archive).filter(pk=session.pk).update(database='')
+        session.database = ''
+        transaction.on_commit(config.invalidate, using=archive)
+    if purge:
+        with transaction.atomic(using=source):
+            _clear_session(session, source)
+    logger.info("[CONSOLIDATE] {} game data rows of session {} copied from {} to {}".format(
+        len(game_data), session.pk, source, archive))
+    return len(game_data)
@@ -0,0 +1,165 @@
+# coding=utf-8
+# ==============================================================================
+# beelbe
+# Copyright © 2016 Elias F. Domingos. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Session engine of the participants (SESSION_ENGINE = 'experiments.sessions').
+
+The views record the experiment state of the participant on its session at every step of the game,
+which with the db engine is an UPDATE of the session table per request. This engine keeps the
+sessions in the cache selected by SESSION_CACHE_ALIAS and writes them through to the database
+only when a key other than the experiment state changed (e.g. on login or logout), or when the
+last write is older than EXPERIMENTS_SESSION_WRITE_INTERVAL seconds.
+
+The cache must be shared by all the processes of the server and kept in memory (e.g. the 'shared'
+cache of the settings with memcached), otherwise the deferred writes of a process are invisible to
+the others. When the cache is private to the process (local memory), the engine warns and writes
+every change to the database. When the cache is itself stored in the database (DatabaseCache),
+deferring would only trade the session write for a cache write, so the engine skips the cache and
+works like the db engine.
+
+The experiment state on the database may therefore be behind. The reference is
+Profile.experiment_state: check_session_state corrects the session of each request from the
+profile of the participant (see decorators.get_player).
+"""
+
+# import the logging library
+import logging
+import time
+
+from django.conf import settings
+from django.contrib.sessions.backends.cached_db import SessionStore as CachedDBStore
+from django.core.cache import caches
+from django.core.cache.backends.db import DatabaseCache
+from django.contrib.sessions.backends.db import SessionStore as DBStore
+
+from . import config
+
+# Get an instance of a logger
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = 'experiments.sessions'
+EXPERIMENT_STATE_KEY = 'experiment_state'
+# keys whose changes can wait for the next write, they are checked against the profile
+DEFERRED_KEYS = frozenset([EXPERIMENT_STATE_KEY])
+
+
+def _durable(data):
+    return {key: value for key, value in data.items() if key not in DEFERRED_KEYS}
+
+
+_warned = False
+
+
+def uses_cache():
+    """:returns bool - False if the cache of the sessions is stored in the database, where it saves no writes"""
+    return not isinstance(caches[settings.SESSION_CACHE_ALIAS], DatabaseCache)
+
+
+def defers_writes():
+    """:returns bool - True if the cache of the sessions is shared and in memory, so that the writes can be deferred"""
+    global _warned
+    if not uses_cache():
+        return False
+    if config.is_shared_cache(settings.SESSION_CACHE_ALIAS):
+        return True
+    if not _warned:
+        _warned = True
+        logger.warning("The session cache {} is private to each process, the sessions are written through to "
+                       "the database".format(settings.SESSION_CACHE_ALIAS))
+    return False
+
+
+class SessionStore(CachedDBStore):
+    """
+    Cached sessions, written through to the database periodically. The cache holds the session data
+    together with the data last written to the database and the time of that write.
+    """
+    cache_key_prefix = KEY_PREFIX
+
+    def __init__(self, session_key=None):
+        self._written = None
+        self._written_at = 0.0
+        super(SessionStore, self).__init__(session_key)
+
+    def exists(self, session_key):
+        if not uses_cache():
+            return DBStore.exists(self, session_key)
+        return super(SessionStore, self).exists(session_key)
+
+    def delete(self, session_key=None):
+        if not uses_cache():
+            return DBStore.delete(self, session_key)
+        return super(SessionStore, self).delete(session_key)
+
+    def load(self):
+        if not uses_cache():
+            return DBStore.load(self)
+        try:
+            entry = self._cache.get(self.cache_key)
+        except Exception:
+            # Some backends (e.g. memcache) raise an exception on invalid cache keys
+            entry = None
+
+        if entry is not None:
+            data, self._written, self._written_at = entry
+            return data
+
+        # the session data of the database is the one last written
+        s = self._get_session_from_db()
+        if not s:
+            return {}
+        data = self.decode(s.session_data)
+        self._written, self._written_at = dict(data), time.time()
+        self._cache.set(self.cache_key, (data, self._written, self._written_at),
+                        self.get_expiry_age(expiry=s.expire_date))
+        return data
+
+    def must_write(self, data):
+        """:returns bool - True if the session has to be written to the database"""
+        if self._written is None or not defers_writes():
+            return True
+        if time.time() - self._written_at >= getattr(settings, 'EXPERIMENTS_SESSION_WRITE_INTERVAL', 30):
+            return True
+        return _durable(data) != _durable(self._written)
+
+    def save(self, must_create=False):
+        if not uses_cache():
+            return DBStore.save(self, must_create=must_create)
+        if self.session_key is None:
+            return self.create()
+        data = self._get_session(no_load=must_create)
+        if must_create or self.must_write(data):
+            DBStore.save(self, must_create=must_create)
+            self._written, self._written_at = dict(data), time.time()
+        self._cache.set(self.cache_key, (data, self._written, self._written_at), self.get_expiry_age())
+
+
+def check_session_state(session, profile):
+    """
+    Corrects the experiment state recorded on the session of a participant from its profile
+    :param session: SessionBase object of the request
+    :param profile: Profile of the participant
+    :return: bool - True if the session was consistent with the profile
+    """
+    state = session.get(EXPERIMENT_STATE_KEY)
+    if state == profile.experiment_state:
+        return True
+    if state is not None:
+        logger.info("[Player {}] session state {} behind the profile ({})".format(profile.pk, state,
+                                                                                profile.experiment_state))
+    session[EXPERIMENT_STATE_KEY] = profile.experiment_state
+    return False
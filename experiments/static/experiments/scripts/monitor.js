@@ -0,0 +1,91 @@
+// Seconds between two refreshes of the monitor
+var REFRESH_INTERVAL = 5;
+
+$(document).ready(function () {
+    var groups_div = $('#id_monitor_groups');
+
+    function refresh() {
+        $.getJSON(groups_div.attr("data-url"))
+            .done(function (data) {
+                if (data['watchdog']) {
+                    drawWatchdog(data['watchdog']);
+                }
+                groups_div.empty();
+                data['groups'].forEach(function (group) {
+                    groups_div.append(drawGroup(group, data['threshold'], data['deadline_variable']));
+                    groups_div.append($('<div class="w3-col s1 w3-center"><p></p></div>'));
+                });
+            })
+            .always(function () {
+                setTimeout(refresh, REFRESH_INTERVAL * 1000);
+            });
+    }
+
+    setTimeout(refresh, REFRESH_INTERVAL * 1000);
+});
+
+
+/**
+ * Creates the card of a group with the same layout as monitor.html
+ * @param group
+ * @param threshold
+ * @param deadline_variable
+ */
+function drawGroup(group, threshold, deadline_variable) {
+    var columns = ["username", "player", "private_account", "experiment_state", "transition_state",
+        "is_active", "last_round", "threshold_state_display", "euros", "in_barrier"];
+    var header = ["User", "Player", "Private account", "experiment state", "transition state", "active",
+        "current round", "threshold state", "euros", "in barrier"];
+
+    var card = $('<div class="w3-col m3 w3-white w3-card-2 w3-center"></div>');
+    var title = $('<header class="w3-container w3-green"></header>')
+        .append($('<h3></h3>').text("Group " + group['group_number']))
+        .append($('<div></div>').text("round: " + group['current_round'] +
+            " waiting in barrier: " + group['members_waiting']));
+    if (deadline_variable) {
+        title.append($('<div></div>').text("final round: " + group['finishing_round'] +
+            " dice_results: " + group['dice_results']));
+    }
+    card.append(title);
+
+    var table = $('<table class="w3-table w3-striped w3-hoverable"></table>');
+    var row = $('<tr></tr>');
+    header.forEach(function (name) {
+        row.append($('<th></th>').text(name));
+    });
+    table.append(row);
+    group['members'].forEach(function (member) {
+        var row = $('<tr></tr>');
+        columns.forEach(function (column) {
+            row.append($('<td></td>').text(member[column]));
+        });
+        table.append(row);
+    });
+    card.append(table);
+
+    var bar = $('<div class="w3-container w3-blue w3-round-large w3-center"></div>')
+        .css("width", group['public_account'] + "%")
+        .text(group['public_account'] + "/" + threshold);
+    card.append($('<div></div>')
+        .append($('<h5></h5>').text("Public account"))
+        .append($('<div class="w3-dark-grey w3-round-large w3-margin-bottom"></div>').append(bar)));
+    return card;
+}
+
+
+/**
+ * Shows the last report of the watchdog (see experiments.watchdog)
+ * @param report
+ */
+function drawWatchdog(report) {
+    var watchdog_div = $('#id_watchdog').empty();
+    watchdog_div.append($('<h4></h4>').text(report['waiting'] + " players waiting in a barrier (checked at " +
+        report['checked_at'] + ")"));
+    var list = $('<ul></ul>');
+    report['issues'].forEach(function (issue) {
+        list.append($('<li></li>').text("Group " + issue['group_number'] + " player " + issue['player'] +
+            " (" + issue['phase'] + ", " + issue['round'] + ") waited " + issue['waited'] + "s: " +
+            issue['cause'] + " - " + issue['detail'] + (issue['repaired'] ? " [repaired]" : "")));
+    });
+    watchdog_div.append(list);
+}
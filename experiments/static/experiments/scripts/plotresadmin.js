@@ -1,26 +1,61 @@
+// Seconds between two refreshes of the session data
+var REFRESH_INTERVAL = 5;
+
 $(document).ready(function () {
     var plot_div = $('#id_plot_session');
     // Set up a global variable for the names of the stats reported here
     // (in hopes of making it easier to keep line colors consistent
     var reportStats = [];
-    fetch(plot_div.attr("data-url"))
-        .then(function (response) {
-            return response.json();
-        })
-        .then(function (data) {
-            // Plot data
-            var parsedData = parseGameData(data);
-            drawActionsTS(parsedData);
-            drawDataTable(data['game_data']);
-            // Make a vector for all of the stats, so that plot attributes can be
-            // kept consistent - probably a better way to do this.
-            d3.selectAll("tbody tr")
-                .each(function (d) {
-                    reportStats.push(d.key);
-                });
+    // Only the rows updated since the last refresh are fetched. The rows of the last seconds are sent
+    // again (they may have been committed late), so they replace the ones with the same id.
+    var cursor = 0;
+    var gameData = {};
+    // total contribution of each group and round, replaced by the ones of each refresh
+    var totals = {};
 
-        });
+    function refresh() {
+        var url = plot_div.attr("data-url") + "&since=" + cursor;
+        fetch(url, {credentials: "same-origin"})
+            .then(function (response) {
+                return response.json();
+            })
+            .then(function (data) {
+                cursor = data['cursor'];
+                var first = Object.keys(gameData).length === 0;
+                data['game_data'].forEach(function (row) {
+                    gameData[row['id']] = row;
+                });
+                data['totals'].forEach(function (total) {
+                    totals[total['group__group_number'] + '-' + total['round']] = total;
+                });
+                if (data['game_data'].length > 0 || first) {
+                    var rows = Object.keys(gameData).map(function (id) {
+                        return gameData[id];
+                    });
+                    // Plot data
+                    d3.select('#id_plot_session').selectAll("svg, .tooltip").remove();
+                    d3.select('#id_sess_totals_table').selectAll("table").remove();
+                    d3.select('#id_sess_data_table').selectAll("table").remove();
+                    drawActionsTS(parseGameData({'game_data': rows}));
+                    drawTotalsTable(Object.keys(totals).map(function (key) {
+                        return totals[key];
+                    }));
+                    drawDataTable(rows);
+                    // Make a vector for all of the stats, so that plot attributes can be
+                    // kept consistent - probably a better way to do this.
+                    reportStats = [];
+                    d3.selectAll("#id_sess_data_table tbody tr")
+                        .each(function (d) {
+                            reportStats.push(d.key);
+                        });
+                }
+            })
+            .finally(function () {
+                setTimeout(refresh, REFRESH_INTERVAL * 1000);
+            });
+    }
 
+    refresh();
 });
 
 
@@ -130,6 +165,58 @@ function drawActionsTS(actions_ts) {
 }
 
 
+/**
+ * This function creates a table with the total contribution of each group (rows) in each round (columns)
+ * @param totals
+ */
+function drawTotalsTable(totals) {
+    var groups = d3.set(totals, function (d) {
+        return d['group__group_number'];
+    }).values().map(Number).sort(d3.ascending);
+    var rounds = d3.set(totals, function (d) {
+        return d['round'];
+    }).values().map(Number).sort(d3.ascending);
+    var contributions = {};
+    totals.forEach(function (d) {
+        contributions[d['group__group_number'] + '-' + d['round']] = d['contributions'];
+    });
+
+    var table = d3.select("#id_sess_totals_table")
+            .append("table")
+            .attr("class", "table table-condensed table-striped"),
+        thead = table.append("thead"),
+        tbody = table.append("tbody");
+
+    thead.append("tr")
+        .selectAll("th")
+        .data(["group"].concat(rounds.map(function (r) {
+            return "round " + r;
+        })))
+        .enter()
+        .append("th")
+        .text(function (d) {
+            return d;
+        });
+
+    tbody.selectAll("tr")
+        .data(groups)
+        .enter()
+        .append("tr")
+        .selectAll("td")
+        .data(function (group) {
+            return [group].concat(rounds.map(function (r) {
+                var value = contributions[group + '-' + r];
+                return value === undefined ? "" : value;
+            }));
+        })
+        .enter()
+        .append("td")
+        .text(function (d) {
+            return d;
+        });
+}
+
+
 /**
  * This function creates a table with features in a row and game rounds in the columns
  * @param data
@@ -0,0 +1,44 @@
+"""
+Rows shared by the tests: a collective-risk game and a session of a new experiment and treatment.
+"""
+
+from django.utils import timezone
+
+from experiments.models import Experiment, Treatment, Session, CollectiveRiskGame
+
+
+def create_game(**kwargs):
+    """
+    :param kwargs: fields of the game (one group of 2 players, threshold 10 and 10 rounds by default)
+    :return: CollectiveRiskGame
+    """
+    values = dict(game_uid='crd', game_name='crd', game_metadata='', num_players=2, threshold=10, group_size=2,
+                  rounds=10)
+    values.update(kwargs)
+    return CollectiveRiskGame.objects.create(**values)
+
+
+def create_treatment(game=None, experiment=None):
+    """
+    :param game: game of the treatment (create_game() by default)
+    :param experiment: experiment of the treatment (a new one by default)
+    :return: Treatment
+    """
+    if experiment is None:
+        experiment = Experiment.objects.create(experiment_name='experiment', experiment_metadata='')
+    return Treatment.objects.create(experiment=experiment, game=game or create_game(), treatment_name='treatment')
+
+
+def create_session(game=None, treatment=None, **kwargs):
+    """
+    :param game: game of the treatment, when no treatment is given (create_game() by default)
+    :param treatment: treatment of the session (create_treatment(game) by default)
+    :param kwargs: fields of the session (number 1, scheduled now by default)
+    :return: Session
+    """
+    if treatment is None:
+        treatment = create_treatment(game)
+    values = dict(experiment=treatment.experiment, treatment=treatment, session_number=1,
+                  scheduled_date=timezone.now())
+    values.update(kwargs)
+    return Session.objects.create(**values)
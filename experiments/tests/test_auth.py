@@ -0,0 +1,157 @@
+from django.contrib.auth.models import User
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.core.cache import caches
+from django.test import TestCase, RequestFactory, override_settings
+from django.urls import reverse
+from django.utils import translation
+
+import experiments.utils as utils
+from experiments import config
+from experiments.auth import AccessCodeBackend, ExperimentsBackend, get_access_code, get_access_codes, rotate_access_key
+from experiments.constants import Constants
+from experiments.models import RunNow, Profile
+from experiments.tests.factories import create_session, create_treatment
+
+
+class AccessCodeBackendTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.session = create_session(group_size=2)
+        experiment, treatment = cls.session.experiment, cls.session.treatment
+        cls.other_session = create_session(treatment=treatment, session_number=2, group_size=2)
+        RunNow.objects.create(experiment_id=experiment.id, treatment_id=treatment.id, session_id=cls.session.id,
+                              experiment_on=True)
+        utils.add_users({str(i): {'username': 'user{}'.format(i), 'password': 'pass{}'.format(i)} for i in range(2)},
+                        experiment, cls.session, treatment)
+        utils.add_users({'0': {'username': 'other', 'password': 'other'}}, experiment, cls.other_session, treatment)
+        utils.init_experiment()
+
+    def setUp(self):
+        translation.activate('en')
+        config.invalidate()
+        caches['shared'].clear()
+        self.session.refresh_from_db()
+
+    def login(self, username, password):
+        return self.client.post(reverse('experiments:login'), {'username': username, 'password': password})
+
+    def test_codes_are_issued_per_session(self):
+        self.assertEqual(len(self.session.access_key), 32)
+        self.assertNotEqual(self.session.access_key, self.other_session.access_key)
+        codes = get_access_codes(self.session)
+        self.assertEqual(set(codes), {'user0', 'user1'})
+        self.assertNotEqual(codes['user0'], codes['user1'])
+        self.assertEqual(len(codes['user0']), 8)
+
+    def test_login_with_access_code(self):
+        code = get_access_code(self.session, 'user0')
+        response = self.login('user0', '{}-{}'.format(code[:4], code[4:].lower()))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Profile.objects.get(player__user__username='user0').experiment_state,
+                         Constants.STATE_LOGIN)
+
+    def test_single_query_without_hashing(self):
+        request = RequestFactory().post('/')
+        SessionMiddleware().process_request(request)
+        config.get_run(self.session.id)
+        config.get_session(self.session.id)
+        backend = AccessCodeBackend()
+        # the user with its player and profile, and the update of the profile
+        with self.assertNumQueries(2):
+            user = backend.authenticate(request, 'user1', get_access_code(self.session, 'user1'))
+        self.assertEqual(user.username, 'user1')
+        self.assertIsNone(backend.authenticate(request, 'user1', 'pass1'))
+
+    def test_authenticate_without_request(self):
+        user = AccessCodeBackend().authenticate(None, 'user1', get_access_code(self.session, 'user1'))
+        self.assertEqual(user.username, 'user1')
+
+    def test_password_without_request(self):
+        self.assertEqual(ExperimentsBackend().authenticate(None, 'user1', 'pass1').username, 'user1')
+
+    @override_settings(EXPERIMENTS_ACCESS_CODE_ATTEMPTS=3)
+    def test_codes_are_locked_after_wrong_attempts(self):
+        backend = AccessCodeBackend()
+        for attempt in range(3):
+            self.assertIsNone(backend.authenticate(None, 'user0', 'AAAAAAAA'))
+        self.assertIsNone(backend.authenticate(None, 'user0', get_access_code(self.session, 'user0')))
+        # the other participants and the passwords are not locked
+        self.assertIsNotNone(backend.authenticate(None, 'user1', get_access_code(self.session, 'user1')))
+        self.assertEqual(self.login('user0', 'pass0').status_code, 302)
+
+    @override_settings(EXPERIMENTS_ACCESS_CODE_ATTEMPTS=3)
+    def test_password_logins_dont_lock_the_codes(self):
+        for attempt in range(5):
+            self.assertEqual(self.login('user0', 'pass0').status_code, 302)
+            self.client.logout()
+        self.assertIsNone(caches['shared'].get('experiments:access_code:failures:user0'))
+        self.assertIsNotNone(AccessCodeBackend().authenticate(None, 'user0', get_access_code(self.session, 'user0')))
+
+    def test_password_still_works(self):
+        self.assertEqual(self.login('user1', 'pass1').status_code, 302)
+
+    def test_rotated_codes_are_rejected(self):
+        code = get_access_code(self.session, 'user0')
+        rotate_access_key(self.session)
+        self.assertEqual(self.login('user0', code).status_code, 200)
+        self.assertEqual(self.login('user0', get_access_code(self.session, 'user0')).status_code, 302)
+
+    def test_code_of_another_session_is_rejected(self):
+        self.assertEqual(self.login('other', get_access_code(self.other_session, 'other')).status_code, 200)
+        self.assertEqual(self.login('other', get_access_code(self.session, 'other')).status_code, 200)
+        self.assertFalse(User.objects.get(username='other').last_login)
+
+
+class MultiRunTests(TestCase):
+    """Several sessions are run at the same time, each participant logs into the session it belongs to"""
+
+    @classmethod
+    def setUpTestData(cls):
+        treatment = create_treatment()
+        experiment = treatment.experiment
+        cls.sessions = []
+        for number in range(3):
+            session = create_session(treatment=treatment, session_number=number, group_size=2)
+            utils.add_users({str(i): {'username': 's{}u{}'.format(number, i), 'password': 'pass'} for i in range(2)},
+                            experiment, session, treatment)
+            utils.set_run_now(experiment.id, session.id, treatment.id, experiment_on=False)
+            cls.sessions.append(session)
+        # the last session is not started
+        for session in cls.sessions[:2]:
+            utils.init_experiment(session.id)
+
+    def setUp(self):
+        translation.activate('en')
+        config.invalidate()
+
+    def login(self, username, password='pass'):
+        return self.client.post(reverse('experiments:login'), {'username': username, 'password': password})
+
+    def test_runs(self):
+        self.assertEqual([run.session_id for run in config.get_runs()], [session.id for session in self.sessions[:2]])
+        self.assertFalse(config.get_run(self.sessions[2].id).experiment_on)
+        self.assertIsNone(config.get_run(0))
+
+    def test_login_in_every_running_session(self):
+        for session in self.sessions[:2]:
+            self.assertEqual(self.login('s{}u0'.format(session.session_number)).status_code, 302)
+            self.client.logout()
+            username = 's{}u1'.format(session.session_number)
+            self.assertEqual(self.login(username, get_access_code(session, username)).status_code, 302)
+            self.client.logout()
+        self.assertEqual(User.objects.filter(last_login__isnull=False).count(), 4)
+
+    def test_login_rejected_when_session_is_off(self):
+        self.assertEqual(self.login('s2u0').status_code, 200)
+        self.assertEqual(self.login('s2u1', get_access_code(self.sessions[2], 's2u1')).status_code, 200)
+
+    def test_monitor_of_each_session(self):
+        self.client.force_login(User.objects.create_user('admin', '', 'admin', is_staff=True))
+        for session in self.sessions:
+            response = self.client.get(reverse('experiments:monitor', kwargs={'session_id': session.id}))
+            self.assertEqual(response.context['session'].id, session.id)
+            response = self.client.get(reverse('experiments:fetch_data'), {'session_id': session.id})
+            self.assertEqual(response.status_code, 200)
+        response = self.client.get(reverse('experiments:admin'), {'session_id': self.sessions[1].id})
+        self.assertEqual(response.context['session'].id, self.sessions[1].id)
+        self.assertEqual(len(response.context['runs']), 3)
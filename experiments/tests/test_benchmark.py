@@ -0,0 +1,37 @@
+from django.test import TestCase, SimpleTestCase
+
+from experiments.models import GameData, Group
+from experiments.toolkit.benchmark import Benchmark, compare_reports, is_locking
+
+
+class BenchmarkTests(TestCase):
+    def test_run(self):
+        report = Benchmark(players=4, group_size=2, rounds=2, seed=0).run()
+        self.assertEqual(set(report['provisioning']), {'load_experiments', 'add_users', 'init_experiment'})
+        self.assertEqual(Group.objects.filter(game_finished=True).count(), 2)
+        self.assertEqual(GameData.objects.count(), 4 * 2)
+
+        endpoints = report['endpoints']
+        for endpoint in ('login', 'instructions', 'test', 'game', 'game_round', 'results', 'results_round', 'sync',
+                         'results_risk_wait', 'results_risk', 'admin_monitor', 'admin_monitor_ajax',
+                         'admin_fetch_data'):
+            self.assertGreater(endpoints[endpoint]['queries_mean'], 0, endpoint)
+        self.assertEqual(endpoints['game_round']['requests'], 4 * 2)
+        self.assertGreater(endpoints['game_round']['locking_statements_max'], 0)
+        self.assertEqual(endpoints['admin_fetch_data']['statuses'], {'200': 4})
+
+
+class CompareReportsTests(SimpleTestCase):
+    def test_is_locking(self):
+        self.assertTrue(is_locking('UPDATE "experiments_group" SET ...'))
+        self.assertTrue(is_locking('SELECT "id" FROM "experiments_group" WHERE ... FOR UPDATE'))
+        self.assertFalse(is_locking('SELECT "id" FROM "experiments_group"'))
+
+    def test_compare(self):
+        stats = {'queries_max': 5, 'locking_statements_max': 1, 'p50_ms': 10.0, 'p99_ms': 20.0}
+        baseline = {'endpoints': {'game': stats, 'sync': stats}}
+        report = {'endpoints': {'game': dict(stats, queries_max=6), 'sync': dict(stats, p99_ms=23.0),
+                                'results': stats}}
+        self.assertEqual(compare_reports(baseline, report), ['game: queries_max 5 -> 6'])
+        self.assertEqual(compare_reports(baseline, report, tolerance=0.1), ['game: queries_max 5 -> 6',
+                                                                             'sync: p99_ms 20.0 -> 23.0'])
@@ -0,0 +1,49 @@
+import threading
+
+from django.test import SimpleTestCase
+
+from experiments.notifiers import LocalNotifier, group_channel
+
+
+class LocalNotifierTests(SimpleTestCase):
+    def test_wait_times_out_without_notification(self):
+        notifier = LocalNotifier()
+        channel = group_channel(1, 1, 1)
+        self.assertFalse(notifier.wait(channel, notifier.version(channel), timeout=0.05))
+
+    def test_notification_before_wait_is_not_lost(self):
+        notifier = LocalNotifier()
+        channel = group_channel(1, 1, 1)
+        version = notifier.version(channel)
+        notifier.notify(channel)
+        self.assertTrue(notifier.wait(channel, version, timeout=0.05))
+
+    def test_notify_wakes_every_waiter_of_the_group(self):
+        notifier = LocalNotifier()
+        channel = group_channel(1, 1, 1)
+        version = notifier.version(channel)
+        results = []
+
+        def waiter():
+            results.append(notifier.wait(channel, version, timeout=5))
+
+        threads = [threading.Thread(target=waiter) for _ in range(4)]
+        for t in threads:
+            t.start()
+        notifier.notify(group_channel(2, 1, 1))
+        notifier.notify(channel)
+        for t in threads:
+            t.join()
+        self.assertEqual(results, [True] * 4)
+
+    def test_channels_are_dropped_without_subscribers(self):
+        notifier = LocalNotifier()
+        channel = group_channel(1, 1, 1)
+        with notifier.subscribe(channel):
+            version = notifier.version(channel)
+            notifier.notify(channel)
+            self.assertTrue(notifier.wait(channel, version, timeout=0.05))
+        self.assertEqual(notifier._channels, {})
+        # the notifications of the barriers nobody waits on don't create channels
+        notifier.notify(group_channel(2, 1, 1))
+        self.assertEqual(notifier._channels, {})
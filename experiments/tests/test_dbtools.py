@@ -0,0 +1,83 @@
+import shutil
+import tempfile
+
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from experiments.constants import Constants
+from experiments.models import (Group, GameData, Profile, )
+from experiments.tests.factories import create_game, create_session
+from experiments.toolkit import dbtools
+
+
+class DBToolsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.session = create_session(create_game(rounds=3, conversion_rate=0.5), finished=True)
+        cls.experiment = cls.session.experiment
+        group = Group.objects.create(group_number=0, session=cls.session, public_account=12)
+        now = timezone.now()
+        for i, action in enumerate([2, 4]):
+            user = User.objects.create_user('user{}'.format(i), '', 'pass')
+            user.player.session = cls.session
+            user.player.experiment = cls.experiment
+            user.player.group = group
+            user.player.save()
+            Profile.objects.filter(player=user.player).update(private_account=40 - 3 * action, group_number=0,
+                                                              threshold_state=Constants.ACK)
+            for g_round in range(1, 4):
+                GameData.objects.create(player=user.player, opponent=user.player, session=cls.session, group=group,
+                                        round=g_round, action=action, time_round_start=now,
+                                        time_round_ends=now + timezone.timedelta(seconds=g_round))
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.settings = override_settings(EXPERIMENTS_ANALYSIS_CACHE=self.cache_dir)
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        shutil.rmtree(self.cache_dir)
+
+    def test_load_rounds(self):
+        # sessions, versions of the finished sessions and rounds
+        with self.assertNumQueries(3):
+            rounds = dbtools.load_rounds(experiment=self.experiment)
+        self.assertEqual(len(rounds), 6)
+        self.assertEqual(list(rounds.groupby('round')['cumulative_contribution'].first()), [6, 12, 18])
+        self.assertEqual(list(rounds.groupby('round')['threshold_reached'].first()), [False, True, True])
+        self.assertEqual(sorted(rounds['decision_latency'].unique()), [1, 2, 3])
+
+    def test_finished_sessions_are_cached(self):
+        dbtools.load_rounds(sessions=[self.session])
+        GameData.objects.filter(session=self.session).update(action=0)
+        # only the sessions and their versions are queried
+        with self.assertNumQueries(2):
+            rounds = dbtools.load_rounds(sessions=[self.session])
+        self.assertEqual(rounds['action'].sum(), 18)
+        self.assertEqual(dbtools.load_rounds(sessions=[self.session], cache=False)['action'].sum(), 0)
+
+    def test_replayed_sessions_are_reloaded(self):
+        dbtools.load_rounds(sessions=[self.session])
+        # the session is initialised and played again: its game data rows are new
+        game_data = list(GameData.objects.filter(session=self.session))
+        GameData.objects.filter(session=self.session).delete()
+        for row in game_data:
+            row.pk, row.action = None, 0
+            row.save()
+        self.assertEqual(dbtools.load_rounds(sessions=[self.session])['action'].sum(), 0)
+
+    def test_corrected_groups_and_accounts_are_reloaded(self):
+        dbtools.load_all(sessions=[self.session])
+        Group.objects.filter(session=self.session).update(public_account=8, dice_results='3,1')
+        Profile.objects.filter(player__session=self.session).update(private_account=30)
+        data = dbtools.load_all(sessions=[self.session])
+        self.assertEqual(list(data['groups']['public_account']), [8])
+        self.assertEqual(list(data['groups']['dice_results']), ['3,1'])
+        self.assertEqual(list(data['accounts']['private_account']), [30, 30])
+
+    def test_load_all(self):
+        data = dbtools.load_all(experiment=self.experiment)
+        self.assertEqual(list(data['groups']['threshold_reached']), [True])
+        self.assertEqual(sorted(data['accounts']['payoff_euros']), [28 * 0.5 + 2.5, 34 * 0.5 + 2.5])
@@ -0,0 +1,57 @@
+import io
+
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.utils import timezone
+
+from experiments import exports
+from experiments.models import (Session, Group, GameData, )
+from experiments.tests.factories import create_game, create_session
+
+
+class ExportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.session = session = create_session(create_game(num_players=3, group_size=3), session_number=7)
+        group = Group.objects.create(group_number=2, session=session)
+        for i in range(3):
+            user = User.objects.create_user('user{}'.format(i), '', 'pass{}'.format(i))
+            for g_round in range(1, 6):
+                GameData.objects.create(player=user.player, opponent=user.player, session=session, group=group,
+                                        round=g_round, action=2, private_account=40 - 2 * g_round,
+                                        time_round_start=timezone.now())
+
+    def test_stream_csv(self):
+        response = exports.stream_csv(GameData.objects.all(), 'game_data', chunk_size=4)
+        # a single query, however many rows and related objects are exported
+        with self.assertNumQueries(1):
+            lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 16)
+        header = lines[0].split(',')
+        self.assertIn('player_id', header)
+        self.assertIn('player__user__username', header)
+        self.assertEqual(lines[1].split(',')[header.index('group__group_number')], '2')
+        self.assertEqual(lines[1].split(',')[header.index('session__session_number')], '7')
+
+    def test_parquet(self):
+        output = io.BytesIO()
+        with self.assertNumQueries(1):
+            exports.write_parquet(GameData.objects.all(), output, chunk_size=4)
+        output.seek(0)
+        table = exports.pyarrow.parquet.read_table(output)
+        self.assertEqual(table.num_rows, 15)
+        self.assertEqual(sorted(set(table.column('player__user__username').to_pylist())),
+                         ['user0', 'user1', 'user2'])
+        self.assertEqual(table.schema.field('round').type, exports.pyarrow.int64())
+
+    def test_stream_arrow(self):
+        response = exports.stream_arrow(GameData.objects.all(), 'game_data', chunk_size=4)
+        table = exports.pyarrow.ipc.open_stream(b''.join(response.streaming_content)).read_all()
+        self.assertEqual(table.num_rows, 15)
+
+    def test_live_sessions(self):
+        self.assertEqual(exports.get_live_sessions(GameData.objects.all()), {})
+        Session.objects.filter(pk=self.session.pk).update(database='sessions')
+        self.assertEqual(exports.get_live_sessions(GameData.objects.all()), {self.session.pk: 'sessions'})
+        self.assertEqual(exports.get_live_sessions(GameData.objects.none()), {})
+        self.assertEqual(exports.get_live_sessions(), {self.session.pk: 'sessions'})
@@ -0,0 +1,117 @@
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.test import TestCase, RequestFactory
+from django.urls import reverse
+from django.utils import timezone, translation
+
+import experiments.utils as utils
+from experiments import config, fsm, views
+from experiments.constants import Constants
+from experiments.models import RunNow, Profile, Player, GameData, Group
+from experiments.tests.factories import create_game, create_session
+
+
+class StateMachineTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.session = create_session(create_game(num_players=1, group_size=1), group_size=1)
+        experiment, treatment = cls.session.experiment, cls.session.treatment
+        RunNow.objects.create(experiment_id=experiment.id, treatment_id=treatment.id, session_id=cls.session.id)
+        utils.add_users({'0': {'username': 'user0', 'password': 'pass0'}}, experiment, cls.session, treatment)
+        utils.init_experiment()
+
+    def setUp(self):
+        self.kwargs = {'session_id': self.session.id}
+        translation.activate('en')
+        config.invalidate()
+
+    def set_state(self, experiment_state, transition_state=Constants.STATE_NO_TRANSITION):
+        Profile.objects.update(experiment_state=experiment_state, transition_state=transition_state,
+                               last_round=1, participated=True)
+        return Profile.objects.get()
+
+    def test_redirect_urls(self):
+        profile = self.set_state(Constants.STATE_GAME_S3)
+        self.assertEqual(fsm.get_redirect_url(profile, self.session.id), reverse('experiments:results',
+                                                                                 kwargs=self.kwargs))
+        # a transition has precedence over the state in which it started
+        profile = self.set_state(Constants.STATE_GAME_S2, Constants.STATE_TRANSITION_S3)
+        self.assertEqual(fsm.get_redirect_url(profile, self.session.id), reverse('experiments:game_round',
+                                                                                 kwargs=self.kwargs))
+        profile = self.set_state(Constants.STATE_FINISH)
+        self.assertEqual(fsm.get_redirect_url(profile, self.session.id), reverse('experiments:logout'))
+        profile = self.set_state(Constants.STATE_INSTRUCTIONS)
+        self.assertIsNone(fsm.get_redirect_url(profile, self.session.id))
+        self.assertEqual(fsm.get_redirect_url(profile, self.session.id, default='experiments:logout'),
+                         reverse('experiments:logout'))
+
+    def test_transition_of_a_stale_profile_is_rejected(self):
+        profile = self.set_state(Constants.STATE_GAME_S3)
+        # another request of the participant moves it forward meanwhile
+        Profile.objects.update(experiment_state=Constants.STATE_GAME_S4)
+        self.assertFalse(fsm.transit(profile, Constants.STATE_GAME_S2))
+        self.assertEqual(Profile.objects.get().experiment_state, Constants.STATE_GAME_S4)
+
+        self.assertTrue(fsm.transit(profile, Constants.STATE_GAME_S4))
+        self.assertEqual(profile.experiment_state, Constants.STATE_GAME_S4)
+
+    def test_view_redirects_when_the_transition_is_rejected(self):
+        self.client.force_login(User.objects.get(username='user0'))
+        self.set_state(Constants.STATE_GAME_S3)
+        # the state changes between the load of the profile and its transition
+        transit = fsm.transit
+
+        def concurrent_transit(profile, target, sender=None):
+            Profile.objects.update(experiment_state=Constants.STATE_GAME_S4)
+            return transit(profile, target, sender=sender)
+
+        with mock.patch('experiments.fsm.transit', side_effect=concurrent_transit):
+            response = self.client.get(reverse('experiments:game', kwargs=self.kwargs))
+        self.assertRedirects(response, reverse('experiments:results_risk', kwargs=self.kwargs),
+                             fetch_redirect_response=False)
+        self.assertEqual(Profile.objects.get().experiment_state, Constants.STATE_GAME_S4)
+
+    def test_login_redirects_to_the_state_of_the_participant(self):
+        self.set_state(Constants.STATE_GAME_S3)
+        response = self.client.post(reverse('experiments:login'), {'username': 'user0', 'password': 'pass0'})
+        self.assertRedirects(response, reverse('experiments:results', kwargs=self.kwargs),
+                             fetch_redirect_response=False)
+
+    def post_action(self):
+        now = timezone.now()
+        return self.client.post(reverse('experiments:game_round', kwargs=self.kwargs),
+                                {'time_round_start': now, 'time_round_end': now, 'time_elapsed': '00:00:01',
+                                 'action': '4'})
+
+    def test_action_is_recorded_once(self):
+        self.client.force_login(User.objects.get(username='user0'))
+        private_account = self.set_state(Constants.STATE_GAME_S2).private_account
+        self.assertEqual(self.post_action().status_code, 200)
+        # the game view is opened again before the action is submitted a second time
+        Profile.objects.update(transition_state=Constants.STATE_NO_TRANSITION)
+        self.assertEqual(self.post_action().status_code, 200)
+
+        self.assertEqual(GameData.objects.filter(round=1).count(), 1)
+        self.assertEqual(Profile.objects.get().private_account, private_account - 4)
+        self.assertEqual(Group.objects.get().public_account, 4)
+
+    def test_round_is_finished_once(self):
+        user = User.objects.get(username='user0')
+        self.client.force_login(user)
+        self.set_state(Constants.STATE_GAME_S2)
+        self.post_action()
+        self.assertEqual(self.client.get(reverse('experiments:results', kwargs=self.kwargs)).status_code, 200)
+        # another tab of the participant loaded it on the same round
+        stale = Player.objects.select_related('profile', 'group', 'session').get(user=user)
+
+        now = timezone.now()
+        data = {'time_round_start': now, 'time_round_end': now, 'time_elapsed': '00:00:01', 'prediction': '10'}
+        self.assertEqual(self.client.post(reverse('experiments:results_round', kwargs=self.kwargs),
+                                          data).status_code, 200)
+        request = RequestFactory().post(reverse('experiments:results_round', kwargs=self.kwargs), data)
+        request.user, request.player = user, stale
+        self.assertEqual(views.finish_results_view(request, **self.kwargs).status_code, 200)
+
+        self.assertEqual(Profile.objects.get().last_round, 2)
+        self.assertEqual(GameData.objects.get().prediction_question, '10')
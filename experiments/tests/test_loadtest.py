@@ -0,0 +1,64 @@
+import unittest
+
+import numpy as np
+from django.test import SimpleTestCase, LiveServerTestCase
+
+import experiments.utils as utils
+from experiments.models import (RunNow, Instruction, GameData, Group, )
+from experiments.tests.factories import create_game, create_session
+from experiments.toolkit.loadtest import parse_think_time, LatencyRecorder, LoadTest, aiohttp
+
+
+class LoadTestReportTests(SimpleTestCase):
+    def test_think_time(self):
+        random_state = np.random.RandomState(0)
+        self.assertEqual(parse_think_time('none').sample(random_state), 0)
+        self.assertEqual(parse_think_time('const:2').sample(random_state), 2)
+        samples = [parse_think_time('uniform:1,3').sample(random_state) for _ in range(100)]
+        self.assertTrue(all(1 <= sample <= 3 for sample in samples))
+        with self.assertRaises(ValueError):
+            parse_think_time('normal:1,2')
+
+    def test_summary(self):
+        recorder = LatencyRecorder()
+        recorder.time_start, recorder.time_end = 0, 10
+        for latency in range(1, 101):
+            recorder.record('game', latency, 200)
+        recorder.record('sync', 20000, 200)
+        recorder.record_error('sync', ValueError())
+        summary = recorder.summary()
+        self.assertEqual((summary['requests'], summary['throughput']), (101, 10.1))
+        game = summary['endpoints']['game']
+        self.assertEqual((game['p50_ms'], game['max_ms'], game['statuses']), (50.5, 100, {'200': 100}))
+        self.assertEqual(sum(game['histogram'].values()), 100)
+        self.assertEqual(game['histogram']['<=5'], 5)
+        self.assertEqual(summary['endpoints']['sync']['histogram']['<=30000'], 1)
+        self.assertEqual(summary['endpoints']['sync']['errors'], {'ValueError': 1})
+
+
+@unittest.skipIf(aiohttp is None, "aiohttp is not installed")
+class LoadTestSessionTests(LiveServerTestCase):
+    """
+    The test database may not support concurrent requests (sqlite), so the participants play
+    alone in their group and the requests go through a single connection.
+    """
+
+    def setUp(self):
+        self.session = create_session(create_game(group_size=1, rounds=2), group_size=1)
+        experiment, treatment = self.session.experiment, self.session.treatment
+        RunNow.objects.create(experiment_id=experiment.id, treatment_id=treatment.id, session_id=self.session.id,
+                              experiment_on=True)
+        Instruction.objects.create(treatment=treatment, text='page 1[PAGE]page 2', lang='en')
+        self.users = {str(i): {'username': 'user{}'.format(i), 'password': 'pass{}'.format(i)} for i in range(2)}
+        utils.add_users(self.users, experiment, self.session, treatment)
+        utils.init_experiment()
+
+    def test_session(self):
+        credentials = [(user['username'], user['password']) for user in self.users.values()]
+        report = LoadTest(self.live_server_url, self.session.id, credentials, think_time='none', max_connections=1,
+                          timeout=30, max_wait=30, seed=0).run()
+        self.assertEqual((report['completed'], report['failed']), (2, []))
+        self.assertEqual(report['endpoints']['game']['requests'], 4)
+        self.assertEqual(report['endpoints']['results_risk']['statuses'], {'200': 2})
+        self.assertEqual(GameData.objects.filter(session=self.session).count(), 4)
+        self.assertFalse(Group.objects.filter(session=self.session, game_finished=False).exists())
@@ -0,0 +1,259 @@
+import json
+import os
+import tempfile
+
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+
+import experiments.utils as utils
+from experiments import config
+from experiments.constants import Constants
+from experiments.models import (Session, Group, RequestMonitor, Profile)
+from experiments.monitors import DatabaseMonitorBackend, MemoryMonitorBackend
+from experiments.tests.factories import create_game, create_session
+
+
+class MonitorBackendTestsMixin(object):
+    """Tests that every monitor backend must pass"""
+    backend_class = None
+    backend_kwargs = {}
+
+    def setUp(self):
+        self.session = create_session(create_game(rounds=2))
+        self.group = Group.objects.create(group_number=0, session=self.session)
+        self.monitor = RequestMonitor.objects.create(name=Constants.MONITOR_S4, phase=Constants.MONITOR_PHASE_S4,
+                                                     group=self.group)
+        self.players = []
+        for i in range(2):
+            user = User.objects.create_user('user{}'.format(i), '', 'pass{}'.format(i))
+            user.player.group = self.group
+            user.player.save()
+            self.players.append(user.player)
+        self.backend = self.backend_class(**self.backend_kwargs)
+
+    def test_wait(self):
+        self.backend.wait(self.players[0], Constants.MONITOR_PHASE_S4)
+        self.backend.wait(self.players[0], Constants.MONITOR_PHASE_S4)
+        self.assertEqual(self.backend.player_queues(self.players[0]), [(Constants.MONITOR_PHASE_S4, 0)])
+        self.assertEqual(self.backend.player_queues(self.players[1]), [])
+
+    def test_check_condition(self):
+        for player in self.players:
+            self.assertFalse(self.backend.check_condition(self.group, Constants.MONITOR_PHASE_S4, 0, lambda x: x == 2,
+                                                          True))
+            self.backend.wait(player, Constants.MONITOR_PHASE_S4)
+        self.assertTrue(self.backend.check_condition(self.group, Constants.MONITOR_PHASE_S4, 0, lambda x: x == 2, True))
+
+    def test_signal(self):
+        for player in self.players:
+            self.backend.wait(player, Constants.MONITOR_PHASE_S4)
+        self.backend.signal(self.players[0], Constants.MONITOR_PHASE_S4)
+        self.backend.signal(self.players[0], Constants.MONITOR_PHASE_S4)
+        self.assertTrue(self.backend.check_condition(self.group, Constants.MONITOR_PHASE_S4, 0, lambda x: x == 1, True))
+        self.assertEqual(self.backend.player_queues(self.players[0]), [])
+
+    def test_monitor_created_on_first_use(self):
+        self.backend.wait(self.players[0], Constants.MONITOR_PHASE_S2, 3)
+        self.assertFalse(self.backend.check_condition(self.group, Constants.MONITOR_PHASE_S2, 3, lambda x: x == 2,
+                                                      True))
+        self.backend.wait(self.players[1], Constants.MONITOR_PHASE_S2, 3)
+        self.assertTrue(self.backend.check_condition(self.group, Constants.MONITOR_PHASE_S2, 3, lambda x: x == 2,
+                                                     True))
+        self.assertEqual(self.backend.player_queues(self.players[1]), [(Constants.MONITOR_PHASE_S2, 3)])
+
+    def test_reset(self):
+        for player in self.players:
+            self.backend.wait(player, Constants.MONITOR_PHASE_S4)
+        self.backend.reset(self.session)
+        self.assertEqual(self.backend.player_queues(self.players[0]), [])
+        self.assertFalse(self.backend.check_condition(self.group, Constants.MONITOR_PHASE_S4, 0, lambda x: x == 2,
+                                                      True))
+
+    def test_session_monitors(self):
+        self.backend.wait(self.players[0], Constants.MONITOR_PHASE_S4)
+        self.backend.wait(self.players[1], Constants.MONITOR_PHASE_S3, 2)
+        monitors = sorted(self.backend.session_monitors(self.session), key=lambda monitor: monitor.phase)
+        self.assertEqual([(m.group_id, m.phase, m.round, m.var, m.queue) for m in monitors],
+                         [(self.group.pk, Constants.MONITOR_PHASE_S3, 2, 1, {self.players[1].pk}),
+                          (self.group.pk, Constants.MONITOR_PHASE_S4, 0, 1, {self.players[0].pk})])
+
+
+class DatabaseMonitorBackendTests(MonitorBackendTestsMixin, TestCase):
+    backend_class = DatabaseMonitorBackend
+
+
+class MemoryMonitorBackendTests(MonitorBackendTestsMixin, TestCase):
+    backend_class = MemoryMonitorBackend
+    # only flush explicitly
+    backend_kwargs = {'flush_interval': 3600}
+
+    def test_write_behind(self):
+        for player in self.players:
+            self.backend.wait(player, Constants.MONITOR_PHASE_S4)
+        self.assertEqual(RequestMonitor.objects.get(pk=self.monitor.pk).var, 0)
+        self.backend.flush()
+        self.monitor.refresh_from_db()
+        self.assertEqual(self.monitor.var, 2)
+        self.assertEqual(set(self.monitor.queue.values_list('pk', flat=True)), {p.pk for p in self.players})
+        self.backend.signal(self.players[0], Constants.MONITOR_PHASE_S4)
+        self.backend.flush()
+        self.assertEqual(list(self.monitor.queue.values_list('pk', flat=True)), [self.players[1].pk])
+
+    def test_write_behind_creates_monitor(self):
+        self.backend.wait(self.players[0], Constants.MONITOR_PHASE_S3, 1)
+        self.assertFalse(RequestMonitor.objects.filter(phase=Constants.MONITOR_PHASE_S3).exists())
+        self.backend.flush()
+        monitor = RequestMonitor.objects.get(group=self.group, phase=Constants.MONITOR_PHASE_S3, round=1)
+        self.assertEqual(monitor.name, "{}r1".format(Constants.MONITOR_S3))
+        self.assertEqual(monitor.var, 1)
+
+
+class AssignGroupsTests(TestCase):
+    def setUp(self):
+        self.session = create_session(create_game(num_players=12, group_size=3, is_round_variable=True,
+                                                  min_round=4))
+        self.experiment = self.session.experiment
+        for i in range(13):
+            user = User.objects.create_user('user{}'.format(i), '', 'pass{}'.format(i))
+            user.player.experiment = self.experiment
+            user.player.session = self.session
+            user.player.save()
+
+    def test_assign_groups(self):
+        self.assertEqual(utils.assign_groups2players(self.experiment.id, self.session.id), (4, 13))
+        self.assertEqual(Group.objects.filter(session=self.session).count(), 4)
+        for group in Group.objects.filter(session=self.session):
+            self.assertEqual(group.members.count(), 3)
+            self.assertEqual(set(group.members.values_list('profile__group_number', flat=True)),
+                             {group.group_number})
+        # monitors are only created when they are used
+        self.assertFalse(RequestMonitor.objects.exists())
+
+    def test_assign_groups_is_idempotent(self):
+        utils.assign_groups2players(self.experiment.id, self.session.id)
+        self.assertIsNone(utils.assign_groups2players(self.experiment.id, self.session.id))
+        Session.objects.filter(pk=self.session.pk).update(structure_assigned=False)
+        utils.assign_groups2players(self.experiment.id, self.session.id)
+        self.assertEqual(Group.objects.filter(session=self.session).count(), 4)
+        # 13 players in groups of 3: the player left out isn't in any group, whatever the previous draw
+        for group in Group.objects.filter(session=self.session):
+            self.assertEqual(group.members.count(), 3)
+            self.assertEqual(Profile.objects.filter(player__session=self.session,
+                                                    group_number=group.group_number).count(), 3)
+        self.assertEqual(Profile.objects.filter(player__session=self.session, player__group__isnull=True,
+                                                group_number__isnull=True).count(), 1)
+
+
+class AddUsersTests(TestCase):
+    def setUp(self):
+        self.session = create_session(create_game(num_players=20, endowment=40))
+        self.experiment, self.treatment = self.session.experiment, self.session.treatment
+
+    def test_add_users(self):
+        users = {str(i): {'username': 'user{}'.format(i), 'password': 'pass{}'.format(i)} for i in range(20)}
+        with utils.PasswordHasherPool(processes=2) as hasher:
+            self.assertEqual(utils.add_users(users, self.experiment, self.session, self.treatment, hasher=hasher,
+                                             batch_size=7), 20)
+        for user in User.objects.filter(player__session=self.session, player__experiment=self.experiment):
+            self.assertTrue(user.is_active)
+            self.assertTrue(user.check_password(user.username.replace('user', 'pass')))
+        self.assertEqual(Profile.objects.filter(player__session=self.session, private_account=40,
+                                                experiment_state=Constants.STATE_LOGIN).count(), 20)
+
+    def test_add_users2session(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            password_path = os.path.join(tmp_dir, 'passwords.txt')
+            with open(password_path, 'w') as password_file:
+                password_file.write('\n'.join('secret{}'.format(i) for i in range(5)))
+            self.assertIsNone(utils.add_users2session(password_path, tmp_dir + os.sep, self.session, 'part',
+                                                      randomize=False, processes=1, batch_size=2))
+            save_file = os.path.join(tmp_dir, 'exp{}t{}sess1_{}'.format(
+                self.experiment.id, self.treatment.id, self.session.scheduled_date.strftime('%d%m%y')))
+            with open(save_file + '.json') as json_file:
+                users = json.load(json_file)
+            with open(save_file + '.txt') as txt_file:
+                txt = txt_file.read()
+        self.assertEqual(users, {str(i): {'username': 'part{}'.format(i), 'password': 'secret{}'.format(i - 1)}
+                                 for i in range(1, 6)})
+        self.assertTrue(txt.startswith('username: part1\npassword: secret0\n\nusername: part2\n'))
+        self.assertTrue(User.objects.get(username='part5').check_password('secret4'))
+        self.assertEqual(User.objects.filter(player__session=self.session).count(), 5)
+
+
+class ConfigCacheTests(TestCase):
+    def setUp(self):
+        self.game = create_game(num_players=3, group_size=3)
+        self.session = create_session(self.game)
+
+    def test_cached_game(self):
+        self.assertEqual(config.get_session_game(self.session.id).threshold, 10)
+        with self.assertNumQueries(0):
+            self.assertEqual(config.get_session_game(self.session.id).threshold, 10)
+
+    def test_invalidated_on_save(self):
+        config.get_session_game(self.session.id)
+        self.game.threshold = 20
+        self.game.save()
+        self.assertEqual(config.get_session_game(self.session.id).threshold, 20)
+
+    def test_invalidated_on_update(self):
+        self.assertFalse(config.get_session(self.session.id).finished)
+        Session.objects.filter(pk=self.session.pk).update(finished=True)
+        config.invalidate()
+        self.assertTrue(config.get_session(self.session.id).finished)
+
+    def test_invalidated_by_another_process(self):
+        config.get_session(self.session.id)
+        Session.objects.filter(pk=self.session.pk).update(finished=True)
+        # another process increments the shared version
+        config._shared_cache().incr(config.VERSION_KEY)
+        with override_settings(EXPERIMENTS_CONFIG_TTL=60):
+            self.assertFalse(config.get_session(self.session.id).finished)
+        with override_settings(EXPERIMENTS_CONFIG_TTL=0):
+            self.assertTrue(config.get_session(self.session.id).finished)
+
+
+class GroupContributionTests(TestCase):
+    def setUp(self):
+        session = create_session(create_game(num_players=3, group_size=3))
+        self.group = Group.objects.create(group_number=0, session=session)
+
+    def test_add_contribution(self):
+        for g_round, contribution in [(1, 2), (1, 4), (1, 0), (2, 4)]:
+            Group.add_contribution(self.group.pk, g_round, contribution)
+        self.group.refresh_from_db()
+        self.assertEqual(self.group.public_account, 10)
+        self.assertEqual(self.group.get_round_contributions(), [6, 4])
+        self.assertEqual(self.group.current_round, 2)
+        self.assertEqual(self.group.members_acted, 1)
+
+
+class FinalRoundSamplingTests(TestCase):
+    def setUp(self):
+        self.game = create_game(num_players=6, group_size=3, is_round_variable=True, min_round=4,
+                                termination_probability=0.25)
+        self.session = create_session(self.game)
+        for i in range(20):
+            Group.objects.create(group_number=i, session=self.session)
+
+    def test_sample_final_rounds(self):
+        final_rounds, trials = utils.sample_final_rounds(1000, p=0.25, min_round=4, dice_faces=6, random_state=3)
+        self.assertTrue((final_rounds >= 4).all())
+        for final_round, dice in zip(final_rounds, trials):
+            # one trial per round from min_round on, only the last one succeeds
+            self.assertEqual(len(dice), final_round - 4 + 1)
+            self.assertTrue(all(2 <= value <= 6 for value in dice[:-1]))
+            self.assertTrue(1 <= dice[-1] <= 2)
+        again, _ = utils.sample_final_rounds(1000, p=0.25, min_round=4, dice_faces=6, random_state=3)
+        self.assertTrue((final_rounds == again).all())
+
+    def test_session_final_rounds_are_replayed(self):
+        seed = utils.sample_session_final_rounds(self.session, self.game)
+        self.assertEqual(Session.objects.get(pk=self.session.pk).random_seed, seed)
+        selected = list(Group.objects.filter(session=self.session).order_by('group_number').values_list(
+            'finishing_round', 'dice_results', 'finishing_round_selected'))
+        self.assertTrue(all(group[2] for group in selected))
+        Group.objects.filter(session=self.session).update(finishing_round=0, finishing_round_selected=False)
+        self.assertEqual(utils.sample_session_final_rounds(self.session, self.game), seed)
+        self.assertEqual(list(Group.objects.filter(session=self.session).order_by('group_number').values_list(
+            'finishing_round', 'dice_results', 'finishing_round_selected')), selected)
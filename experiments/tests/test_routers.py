@@ -0,0 +1,117 @@
+from django.db import router
+from django.test import TestCase
+
+import experiments.utils as utils
+from experiments import routers
+from experiments.models import (Session, Group, GameData, Profile, RequestMonitor)
+from experiments.tests.factories import create_session, create_treatment
+from experiments.toolkit.benchmark import Benchmark
+
+# database on which the tests play the sessions, besides the archive database (see beelbe.settings)
+SHARD = 'sessions'
+
+
+class SessionRouterTests(TestCase):
+    databases = '__all__'
+
+    def test_routing(self):
+        treatment = create_treatment()
+        sharded, other = (create_session(treatment=treatment, session_number=number, group_size=2, database=database)
+                          for number, database in ((1, SHARD), (2, '')))
+        archive = routers.get_archive_database()
+
+        with routers.session_database(sharded.pk):
+            self.assertEqual(router.db_for_write(Group), SHARD)
+            self.assertEqual(router.db_for_read(Profile), SHARD)
+            self.assertEqual(router.db_for_read(Session), archive)
+            with routers.session_database(other.pk):
+                self.assertEqual(router.db_for_write(Group), archive)
+            self.assertEqual(router.db_for_write(Group), SHARD)
+        self.assertEqual(router.db_for_write(Group), archive)
+        # the objects stay on the database from which they were loaded
+        routers.place_session(sharded)
+        group = Group(session=sharded)
+        group.save(using=SHARD)
+        self.assertEqual(router.db_for_read(RequestMonitor, instance=group), SHARD)
+
+        # the session is read from its database until it is consolidated
+        sharded.finished = True
+        sharded.save()
+        self.assertEqual(routers.get_session_database(sharded.pk), SHARD)
+
+    def test_session_is_played_on_its_database(self):
+        benchmark = Benchmark(players=4, group_size=2, rounds=2, seed=0, database=SHARD)
+        benchmark.run()
+        session = benchmark.session
+        archive = routers.get_archive_database()
+
+        self.assertEqual(GameData.objects.using(SHARD).filter(session=session).count(), 4 * 2)
+        self.assertFalse(GameData.objects.using(archive).filter(session=session).exists())
+        self.assertEqual(Group.objects.using(SHARD).filter(session=session, game_finished=True).count(), 2)
+        self.assertFalse(Group.objects.using(archive).filter(session=session, game_finished=True).exists())
+
+        profiles = set(Profile.objects.using(SHARD).filter(player__session=session).values_list(
+            'pk', 'experiment_state', 'last_round', 'private_account'))
+        self.assertEqual(routers.consolidate_session(session, purge=True), 4 * 2)
+        self.assertEqual(GameData.objects.using(archive).filter(session=session).count(), 4 * 2)
+        self.assertEqual(Group.objects.using(archive).filter(session=session, game_finished=True).count(), 2)
+        self.assertEqual(set(Profile.objects.using(archive).filter(player__session=session).values_list(
+            'pk', 'experiment_state', 'last_round', 'private_account')), profiles)
+        self.assertTrue(RequestMonitor.objects.using(archive).filter(group__session=session).exists())
+        self.assertFalse(Profile.objects.using(SHARD).filter(player__session=session).exists())
+        self.assertEqual(Session.objects.get(pk=session.pk).database, '')
+        self.assertEqual(routers.get_session_database(session.pk), archive)
+
+    def test_deactivated_user_is_seen_by_the_barriers(self):
+        benchmark = Benchmark(players=4, group_size=2, rounds=2, seed=0, database=SHARD)
+        benchmark.run()
+        session = benchmark.session
+        username = Profile.objects.using(SHARD).filter(player__session=session).values_list(
+            'player__user__username', flat=True).first()
+
+        utils.make_player_inactive(username)
+        self.assertEqual(Profile.objects.using(SHARD).filter(player__session=session,
+                                                             player__user__is_active=True).count(), 3)
+        utils.make_player_active(username)
+        self.assertEqual(Profile.objects.using(SHARD).filter(player__session=session,
+                                                             player__user__is_active=True).count(), 4)
+
+    def test_consolidated_session_keeps_its_archive(self):
+        benchmark = Benchmark(players=4, group_size=2, rounds=2, seed=0, database=SHARD)
+        benchmark.run()
+        session = benchmark.session
+        archive = routers.get_archive_database()
+        routers.consolidate_session(session, purge=True)
+
+        # saving the finished session or consolidating it again doesn't touch the archive
+        session = Session.objects.get(pk=session.pk)
+        session.finished = True
+        session.save()
+        self.assertEqual(routers.consolidate_session(session), 0)
+        session.database = SHARD
+        with self.assertRaises(ValueError):
+            routers.consolidate_session(session)
+        self.assertEqual(GameData.objects.using(archive).filter(session=session).count(), 4 * 2)
+        self.assertEqual(Profile.objects.using(archive).filter(player__session=session).count(), 4)
+
+    def test_consolidation_is_repeatable(self):
+        benchmark = Benchmark(players=4, group_size=2, rounds=2, seed=0, database=SHARD)
+        benchmark.run()
+        session = benchmark.session
+        archive = routers.get_archive_database()
+        routers.consolidate_session(session)
+        monitors = RequestMonitor.objects.using(archive).filter(group__session=session).count()
+
+        # e.g. the database was cleared by the admin and the command is run again
+        session.database = SHARD
+        self.assertEqual(routers.consolidate_session(session), 4 * 2)
+        self.assertEqual(GameData.objects.using(archive).filter(session=session).count(), 4 * 2)
+        self.assertEqual(RequestMonitor.objects.using(archive).filter(group__session=session).count(), monitors)
+
+    def test_init_replaces_the_placed_rows(self):
+        benchmark = Benchmark(players=4, group_size=2, rounds=2, seed=0, database=SHARD)
+        benchmark.run()
+        utils.init_experiment(benchmark.session.pk)
+        self.assertFalse(GameData.objects.using(SHARD).filter(session=benchmark.session).exists())
+        self.assertEqual(Profile.objects.using(SHARD).filter(player__session=benchmark.session,
+                                                             last_round=0).count(), 4)
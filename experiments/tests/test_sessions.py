@@ -0,0 +1,103 @@
+from django.contrib.sessions.models import Session as DjangoSession
+from django.core.cache import caches
+from django.conf import settings
+from django.test import TestCase, RequestFactory, override_settings
+
+import experiments.utils as utils
+from experiments.constants import Constants
+from experiments.decorators import get_player
+from experiments.models import Profile
+from experiments.sessions import SessionStore, defers_writes
+from experiments.tests.factories import create_session
+
+
+class SessionStoreTests(TestCase):
+    def setUp(self):
+        caches[settings.SESSION_CACHE_ALIAS].clear()
+        self.session = SessionStore()
+        self.session['_auth_user_id'] = '1'
+        self.session['experiment_state'] = Constants.STATE_LOGIN
+        self.session.save()
+
+    def stored(self):
+        return DjangoSession.objects.get(session_key=self.session.session_key).get_decoded()
+
+    def test_state_changes_are_kept_in_the_cache(self):
+        for state in (Constants.STATE_INSTRUCTIONS, Constants.STATE_TEST, Constants.STATE_GAME_S2):
+            session = SessionStore(self.session.session_key)
+            session['experiment_state'] = state
+            with self.assertNumQueries(0):
+                session.save()
+        self.assertEqual(SessionStore(self.session.session_key)['experiment_state'], Constants.STATE_GAME_S2)
+        self.assertEqual(self.stored()['experiment_state'], Constants.STATE_LOGIN)
+
+    def test_other_changes_are_written_through(self):
+        session = SessionStore(self.session.session_key)
+        session['experiment_state'] = Constants.STATE_TEST
+        session['language'] = 'en'
+        session.save()
+        self.assertEqual(self.stored(), {'_auth_user_id': '1', 'experiment_state': Constants.STATE_TEST,
+                                         'language': 'en'})
+
+    @override_settings(EXPERIMENTS_SESSION_WRITE_INTERVAL=0)
+    def test_periodic_write(self):
+        session = SessionStore(self.session.session_key)
+        session['experiment_state'] = Constants.STATE_TEST
+        session.save()
+        self.assertEqual(self.stored()['experiment_state'], Constants.STATE_TEST)
+
+    def test_load_from_the_database(self):
+        caches[settings.SESSION_CACHE_ALIAS].clear()
+        session = SessionStore(self.session.session_key)
+        self.assertEqual(session['_auth_user_id'], '1')
+        session.flush()
+        self.assertFalse(SessionStore().exists(self.session.session_key))
+
+
+class LocalCacheTests(TestCase):
+    @override_settings(EXPERIMENTS_SINGLE_PROCESS=False)
+    def test_changes_are_written_through(self):
+        session = SessionStore()
+        session['experiment_state'] = Constants.STATE_LOGIN
+        session.save()
+        session = SessionStore(session.session_key)
+        session['experiment_state'] = Constants.STATE_TEST
+        session.save()
+        self.assertEqual(DjangoSession.objects.get(session_key=session.session_key).get_decoded()['experiment_state'],
+                         Constants.STATE_TEST)
+
+
+class DatabaseCacheTests(TestCase):
+    # the cache table doesn't exist in the tests, so any use of the cache would fail
+    @override_settings(CACHES={
+        'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+        'shared': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache', 'LOCATION': 'missing_cache_table'},
+    }, SESSION_CACHE_ALIAS='shared')
+    def test_database_cache_is_skipped(self):
+        self.assertFalse(defers_writes())
+        session = SessionStore()
+        session['experiment_state'] = Constants.STATE_LOGIN
+        session.save()
+        session = SessionStore(session.session_key)
+        session['experiment_state'] = Constants.STATE_TEST
+        session.save()
+        self.assertEqual(DjangoSession.objects.get(session_key=session.session_key).get_decoded()['experiment_state'],
+                         Constants.STATE_TEST)
+        self.assertTrue(SessionStore().exists(session.session_key))
+        session.flush()
+        self.assertFalse(DjangoSession.objects.exists())
+
+
+class ExperimentStateConsistencyTests(TestCase):
+    def test_session_is_corrected_from_the_profile(self):
+        session = create_session(group_size=2)
+        experiment, treatment = session.experiment, session.treatment
+        utils.add_users({'0': {'username': 'user', 'password': 'pass'}}, experiment, session, treatment)
+        Profile.objects.update(experiment_state=Constants.STATE_GAME_S3)
+
+        request = RequestFactory().get('/')
+        request.user = Profile.objects.get().player.user
+        request.session = SessionStore()
+        request.session['experiment_state'] = Constants.STATE_GAME_S2
+        get_player(request)
+        self.assertEqual(request.session['experiment_state'], Constants.STATE_GAME_S3)
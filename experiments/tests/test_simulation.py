@@ -0,0 +1,116 @@
+import csv
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from django.test import SimpleTestCase
+
+from experiments.toolkit.simulation import (CRDParameters, simulate, draw_final_rounds, FixedStrategy,
+                                            FairShareStrategy, MixedStrategy, )
+from experiments.toolkit.sweep import run_sweep, parse_strategies
+from experiments.utils import calculate_final_round
+
+
+class SimulationTests(SimpleTestCase):
+    def setUp(self):
+        self.params = CRDParameters(threshold=120, risk_prob=0.9, group_size=6, endowment=40,
+                                    valid_actions=[0, 2, 4], rounds=10)
+
+    def test_final_rounds_follow_the_geometric_distribution(self):
+        # the game finishes at the first successful trial from min_round on
+        p, min_round = 0.25, 8
+        drawn = draw_final_rounds(p, min_round, 20000, random_state=1)
+        self.assertEqual(drawn.min(), min_round)
+        self.assertAlmostEqual(drawn.mean(), min_round - 1 + 1 / p, delta=0.1)
+        self.assertAlmostEqual(drawn.std(), np.sqrt(1 - p) / p, delta=0.1)
+
+    def test_calculate_final_round_dice(self):
+        for _ in range(100):
+            final_round, trials = calculate_final_round(p=0.25, min_round=8)
+            self.assertEqual(len(trials), final_round - 8 + 1)
+            # only the last trial succeeds: its value is at most p, i.e. 1.5 faces of the dice
+            self.assertLessEqual(trials[-1], 2)
+            self.assertTrue((trials[:-1] >= 2).all())
+
+    def test_fair_share_reaches_threshold(self):
+        result = simulate(self.params, [FairShareStrategy()] * 6, 1000, random_state=0)
+        self.assertTrue(result.success.all())
+        self.assertFalse(result.loss.any())
+        self.assertTrue((result.payoffs == 20).all())
+
+    def test_defection_loses_with_risk_probability(self):
+        result = simulate(self.params, [FixedStrategy(0)] * 6, 20000, random_state=0)
+        self.assertFalse(result.success.any())
+        self.assertAlmostEqual(result.summary()['loss_rate'], 0.9, delta=0.01)
+        self.assertTrue((result.payoffs[result.loss] == 0).all())
+        self.assertTrue((result.payoffs[~result.loss] == 40).all())
+
+    def test_invalid_arguments(self):
+        with self.assertRaises(ValueError):
+            simulate(self.params, [FairShareStrategy()] * 6, 0)
+        with self.assertRaises(ValueError):
+            simulate(self.params, [FairShareStrategy()] * 5, 10)
+
+    def test_variable_deadline_batches(self):
+        params = self.params.copy(is_round_variable=True, min_round=8, termination_probability=1 / 6.)
+        result = simulate(params, [MixedStrategy([0.2, 0.3, 0.5])] * 6, 2500, random_state=0, batch_size=1000)
+        self.assertEqual(result.n_groups, 2500)
+        self.assertTrue((result.final_rounds >= 8).all())
+        # nobody can contribute more than its endowment
+        self.assertTrue((result.payoffs >= 0).all())
+        self.assertTrue((result.public_account <= 6 * 40).all())
+
+
+class SweepTests(SimpleTestCase):
+    def setUp(self):
+        self.params = CRDParameters(threshold=120, risk_prob=0.9, group_size=6, endowment=40,
+                                    valid_actions=[0, 2, 4], rounds=10)
+        self.grid = {'threshold': [100, 120, 140], 'strategies': ['fair*6', 'mixed:0.2,0.3,0.5*3;fixed:4*3']}
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def read(self, path):
+        with open(path, newline='') as csv_file:
+            return sorted((row['task'], row['success_rate']) for row in csv.DictReader(csv_file))
+
+    def test_parse_strategies(self):
+        self.assertEqual(len(parse_strategies('fair*3;mixed:0.2,0.3,0.5*2;fixed:0')), 6)
+        with self.assertRaises(ValueError):
+            parse_strategies('unknown*6')
+
+    def test_sweep_is_deterministic_and_resumable(self):
+        one, two = os.path.join(self.dir, 'one.csv'), os.path.join(self.dir, 'two.csv')
+        self.assertEqual(run_sweep(self.params, self.grid, 'fair*6', 500, one, seed=1, workers=1), (6, 0))
+        # the seeds don't depend on the number of workers
+        run_sweep(self.params, self.grid, 'fair*6', 500, two, seed=1, workers=2)
+        self.assertEqual(self.read(one), self.read(two))
+        # a second run only simulates the missing treatments
+        self.assertEqual(run_sweep(self.params, self.grid, 'fair*6', 500, one, seed=1, workers=2), (0, 6))
+        grid = dict(self.grid, threshold=[100, 120, 140, 160])
+        self.assertEqual(run_sweep(self.params, grid, 'fair*6', 500, one, seed=1, workers=2), (2, 6))
+        self.assertEqual(len(self.read(one)), 8)
+
+    def test_sweep_refuses_another_run(self):
+        output = os.path.join(self.dir, 'sweep.csv')
+        run_sweep(self.params, {'threshold': [100, 120]}, 'fair*6', 500, output, seed=1, workers=1)
+        for params, n_groups, seed in ((self.params, 500, 2), (self.params, 1000, 1),
+                                       (self.params.copy(risk_prob=0.5), 500, 1)):
+            with self.assertRaises(ValueError):
+                run_sweep(params, {'threshold': [100, 120]}, 'fair*6', n_groups, output, seed=seed, workers=1)
+        # a new parameter of the grid has no column in the file
+        with self.assertRaises(ValueError):
+            run_sweep(self.params, {'threshold': [100, 120], 'risk_prob': [0.5]}, 'fair*6', 500, output, seed=1,
+                      workers=1)
+        self.assertEqual(len(self.read(output)), 2)
+
+    def test_sweep_refuses_compositions_of_another_size(self):
+        output = os.path.join(self.dir, 'sizes.csv')
+        with self.assertRaises(ValueError):
+            run_sweep(self.params, {'threshold': [100, 120]}, 'fair*5', 500, output, workers=1)
+        # the second group size doesn't match the composition
+        with self.assertRaises(ValueError):
+            run_sweep(self.params, {'group_size': [6, 4]}, 'fair*6', 500, output, workers=1)
+        self.assertFalse(os.path.exists(output))
@@ -0,0 +1,240 @@
+import datetime
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.db import DatabaseError
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone, translation
+
+import experiments.utils as utils
+from experiments import config
+from experiments.constants import Constants
+from experiments.middleware import metrics
+from experiments.models import (Session, RunNow, Profile, Player, GameData, RequestMonitor, )
+from experiments.tests.factories import create_game, create_session
+
+
+class ViewQueriesTests(TestCase):
+    """
+    The player, its profile, group, session, treatment and game are loaded once per request
+    and shared by the decorators and the view, so the number of queries of each view is fixed.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.session = create_session(create_game(num_players=3, group_size=3), group_size=3)
+        experiment, treatment = cls.session.experiment, cls.session.treatment
+        RunNow.objects.create(experiment_id=experiment.id, treatment_id=treatment.id, session_id=cls.session.id)
+        utils.add_users({str(i): {'username': 'user{}'.format(i), 'password': 'pass{}'.format(i)} for i in range(3)},
+                        experiment, cls.session, treatment)
+        utils.init_experiment()
+
+    def setUp(self):
+        self.user = User.objects.get(username='user0')
+        self.client.force_login(self.user)
+        self.kwargs = {'session_id': self.session.id}
+        # the urls are prefixed with one of settings.LANGUAGES
+        translation.activate('en')
+        # the game configuration is read from memory on a live session
+        config.invalidate()
+        config.get_session_game(self.session.id)
+
+    def set_state(self, experiment_state, transition_state=Constants.STATE_NO_TRANSITION, last_round=1):
+        Profile.objects.filter(player__user=self.user).update(experiment_state=experiment_state,
+                                                              transition_state=transition_state,
+                                                              last_round=last_round, participated=True)
+
+    def test_game_view_queries(self):
+        self.set_state(Constants.STATE_GAME_S2)
+        with self.assertNumQueries(10):
+            response = self.client.get(reverse('experiments:game', kwargs=self.kwargs))
+        self.assertEqual(response.status_code, 200)
+
+    def test_finish_round_view_queries(self):
+        self.set_state(Constants.STATE_GAME_S2)
+        now = timezone.now()
+        with self.assertNumQueries(18):
+            response = self.client.post(reverse('experiments:game_round', kwargs=self.kwargs),
+                                        {'time_round_start': now, 'time_round_end': now, 'time_elapsed': '00:00:01',
+                                         'action': '4'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_results_view_queries(self):
+        self.set_state(Constants.STATE_GAME_S3)
+        with self.assertNumQueries(10):
+            response = self.client.get(reverse('experiments:results', kwargs=self.kwargs))
+        self.assertEqual(response.status_code, 200)
+
+    def test_check_threshold_view_queries(self):
+        self.set_state(Constants.STATE_GAME_S4)
+        with self.assertNumQueries(15):
+            response = self.client.get(reverse('experiments:results_risk', kwargs=self.kwargs))
+        self.assertEqual(response.status_code, 200)
+
+    def test_redirect_queries(self):
+        # a player in the wrong state is redirected after a single player query
+        self.set_state(Constants.STATE_QUIZ)
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('experiments:game', kwargs=self.kwargs))
+        self.assertRedirects(response, reverse('experiments:userinfo', kwargs=self.kwargs),
+                             fetch_redirect_response=False)
+
+
+class RequestMetricsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.session = create_session(create_game(num_players=1, group_size=1), group_size=1)
+        experiment, treatment = cls.session.experiment, cls.session.treatment
+        RunNow.objects.create(experiment_id=experiment.id, treatment_id=treatment.id, session_id=cls.session.id)
+        utils.add_users({'0': {'username': 'user0', 'password': 'pass0'}}, experiment, cls.session, treatment)
+        utils.init_experiment()
+        Profile.objects.update(experiment_state=Constants.STATE_GAME_S2, last_round=1, participated=True)
+        cls.admin = User.objects.create_user('admin', '', 'admin', is_staff=True)
+
+    def setUp(self):
+        self.client.force_login(User.objects.get(username='user0'))
+        self.kwargs = {'session_id': self.session.id}
+        translation.activate('en')
+        config.invalidate()
+        metrics.clear()
+
+    def get_metrics(self):
+        self.client.force_login(self.admin)
+        response = self.client.get(reverse('experiments:metrics'))
+        self.assertEqual(response.status_code, 200)
+        return {(row['view'], row['state']): row for row in response.json()['views']}
+
+    def test_records_view_and_state(self):
+        for _ in range(2):
+            self.assertEqual(self.client.get(reverse('experiments:game', kwargs=self.kwargs)).status_code, 200)
+        row = self.get_metrics()[('experiments:game', Constants.STATE_GAME_S2)]
+        self.assertEqual(row['requests'], 2)
+        self.assertEqual(row['retries'], 0)
+        self.assertGreater(row['queries_max'], 0)
+        self.assertGreaterEqual(row['wall_ms_p99'], row['db_ms_p99'])
+        self.assertEqual(sum(row['wall_histogram'].values()), 2)
+
+    def test_records_transaction_retries(self):
+        now = timezone.now()
+        with mock.patch('experiments.views.GameData.objects.create', side_effect=DatabaseError):
+            response = self.client.post(reverse('experiments:game_round', kwargs=self.kwargs),
+                                        {'time_round_start': now, 'time_round_end': now, 'time_elapsed': '00:00:01',
+                                         'action': '4'})
+        self.assertRedirects(response, reverse('experiments:game', kwargs=self.kwargs), fetch_redirect_response=False)
+        self.assertEqual(self.get_metrics()[('experiments:game_round', Constants.STATE_GAME_S2)]['retries'], 1)
+
+    def test_requires_staff(self):
+        self.assertEqual(self.client.get(reverse('experiments:metrics')).status_code, 302)
+
+
+class AdminMonitorTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.session = create_session(group_size=2)
+        experiment, treatment = cls.session.experiment, cls.session.treatment
+        RunNow.objects.create(experiment_id=experiment.id, treatment_id=treatment.id, session_id=cls.session.id)
+        utils.add_users({str(i): {'username': 'user{}'.format(i), 'password': 'pass{}'.format(i)} for i in range(4)},
+                        experiment, cls.session, treatment)
+        utils.init_experiment()
+        cls.admin = User.objects.create_user('admin', '', 'admin', is_staff=True)
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+        translation.activate('en')
+        config.invalidate()
+        self.url = reverse('experiments:fetch_data')
+
+    def play(self, g_round, action=2):
+        for player in Player.objects.filter(session=self.session).select_related('group'):
+            GameData.objects.create(player=player, opponent=player, session=self.session, group=player.group,
+                                    round=g_round, action=action)
+
+    def fetch(self, **params):
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_requires_staff(self):
+        self.client.logout()
+        self.assertEqual(self.client.get(self.url).status_code, 302)
+
+    @override_settings(EXPERIMENTS_MONITOR_LAG=0)
+    def test_returns_only_new_rows(self):
+        self.play(1)
+        data = self.fetch()
+        self.assertEqual(len(data['game_data']), 4)
+        self.assertEqual([(t['round'], t['contributions'], t['players']) for t in data['totals']], [(1, 4, 2)] * 2)
+
+        self.play(2, action=4)
+        data = self.fetch(since=data['cursor'])
+        self.assertEqual({row['round'] for row in data['game_data']}, {2})
+        self.assertEqual([(t['round'], t['contributions']) for t in data['totals']], [(2, 8)] * 2)
+
+        cursor = data['cursor']
+        data = self.fetch(since=cursor)
+        self.assertEqual((data['game_data'], data['totals']), ([], []))
+        self.assertGreaterEqual(data['cursor'], cursor)
+
+    @override_settings(EXPERIMENTS_MONITOR_LAG=0)
+    def test_returns_updated_rows(self):
+        self.play(1)
+        cursor = self.fetch()['cursor']
+        row = GameData.objects.filter(session=self.session).first()
+        GameData.objects.filter(pk=row.pk).update(public_account=4, time_updated=timezone.now())
+        data = self.fetch(since=cursor)
+        self.assertEqual([(r['id'], r['public_account']) for r in data['game_data']], [(row.pk, 4)])
+
+    def test_sends_the_rows_of_the_lag_window_again(self):
+        # rows updated before the cursor may be committed after it was sent
+        self.play(1)
+        cursor = self.fetch()['cursor']
+        with override_settings(EXPERIMENTS_MONITOR_LAG=60):
+            self.assertEqual(len(self.fetch(since=cursor)['game_data']), 4)
+        GameData.objects.filter(session=self.session).update(
+            time_updated=timezone.now() - datetime.timedelta(seconds=120))
+        with override_settings(EXPERIMENTS_MONITOR_LAG=60):
+            self.assertEqual(self.fetch(since=cursor)['game_data'], [])
+
+    def test_filters_by_group(self):
+        self.play(1)
+        data = self.fetch(group_number=0)
+        self.assertEqual(len(data['game_data']), 2)
+        self.assertEqual([t['group__group_number'] for t in data['totals']], [0])
+
+    @override_settings(EXPERIMENTS_MONITOR_LAG=0)
+    def test_queries_do_not_depend_on_session_size(self):
+        for g_round in range(1, 6):
+            self.play(g_round)
+        cursor = self.fetch()['cursor']
+        self.play(6)
+        # user, new rows and totals (the session of the request is read from the cache)
+        with self.assertNumQueries(3):
+            data = self.fetch(since=cursor)
+        self.assertEqual(len(data['game_data']), 4)
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.client.get(self.url, {'since': 'x'}).status_code, 400)
+
+    def test_monitor_groups(self):
+        player = Player.objects.filter(session=self.session, group__group_number=1).first()
+        RequestMonitor.wait(player, Constants.MONITOR_PHASE_S2, 1)
+        data = self.client.get(reverse('experiments:fetch_monitor_data', args=[self.session.id])).json()
+        self.assertEqual([group['group_number'] for group in data['groups']], [0, 1])
+        self.assertEqual([group['members_waiting'] for group in data['groups']], [0, 1])
+        members = {member['player']: member for member in data['groups'][1]['members']}
+        self.assertTrue(members[player.pk]['in_barrier'])
+        self.assertEqual(members[player.pk]['username'], player.user.username)
+
+    def test_monitor_queries_do_not_depend_on_groups(self):
+        utils.add_users({str(i): {'username': 'extra{}'.format(i), 'password': 'pass'} for i in range(20)},
+                        self.session.experiment, self.session, self.session.treatment)
+        Session.objects.filter(pk=self.session.pk).update(structure_assigned=False)
+        utils.init_experiment()
+        config.get_session_game(self.session.id)
+        # user and groups (the session of the request is read from the cache)
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('experiments:fetch_monitor_data', args=[self.session.id]))
+        self.assertEqual(len(response.json()['groups']), 12)
+        response = self.client.get(reverse('experiments:monitor', args=[self.session.id]))
+        self.assertContains(response, 'extra19')
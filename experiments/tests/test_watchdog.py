@@ -0,0 +1,115 @@
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import TestCase
+
+import experiments.utils as utils
+from experiments.constants import Constants
+from experiments.models import (RunNow, Profile, Player, GameData, RequestMonitor, )
+from experiments.monitors import get_monitor_backend
+from experiments.tests.factories import create_game, create_session
+from experiments.watchdog import Watchdog, get_report
+
+
+class WatchdogTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.session = create_session(create_game(num_players=3, group_size=3), group_size=3)
+        experiment, treatment = cls.session.experiment, cls.session.treatment
+        RunNow.objects.create(experiment_id=experiment.id, treatment_id=treatment.id, session_id=cls.session.id)
+        utils.add_users({str(i): {'username': 'user{}'.format(i), 'password': 'pass{}'.format(i)} for i in range(3)},
+                        experiment, cls.session, treatment)
+        utils.init_experiment()
+
+    def setUp(self):
+        self.backend = get_monitor_backend()
+        self.backend.reset(self.session)
+        self.players = list(Player.objects.filter(session=self.session).order_by('pk'))
+        Profile.objects.filter(player__session=self.session).update(experiment_state=Constants.STATE_GAME_S3,
+                                                                    last_round=1)
+
+    def wait_s3(self, player, action=True):
+        """the player made an action on round 1 and waits for the results"""
+        if action:
+            GameData.objects.create(player=player, opponent=player, session=self.session, group=player.group,
+                                    round=1, action=2)
+        Profile.objects.filter(player=player).update(transition_state=Constants.STATE_TRANSITION_S3)
+        self.backend.wait(player, Constants.MONITOR_PHASE_S3, 1)
+
+    def scan(self, **kwargs):
+        kwargs.setdefault('stuck_after', 0)
+        return Watchdog(backend=self.backend, **kwargs).scan(self.session)
+
+    def causes(self, report):
+        return sorted((issue['player'], issue['cause']) for issue in report['issues'])
+
+    def test_consistent_barrier(self):
+        for player in self.players:
+            self.wait_s3(player)
+        report = self.scan()
+        self.assertEqual((report['waiting'], report['issues']), (3, []))
+
+    def test_waits_before_reporting(self):
+        self.wait_s3(self.players[0])
+        watchdog = Watchdog(backend=self.backend, stuck_after=60)
+        self.assertEqual(watchdog.scan(self.session)['issues'], [])
+        watchdog.stuck_after = 0
+        self.assertEqual(len(watchdog.scan(self.session)['issues']), 2)
+
+    def test_slow_members_are_not_responding(self):
+        self.wait_s3(self.players[0])
+        report = self.scan(repair=True)
+        self.assertEqual(self.causes(report), [(self.players[1].pk, 'not_responding'),
+                                               (self.players[2].pk, 'not_responding')])
+        self.assertEqual(report['stalled_groups'], [self.players[0].group.group_number])
+        self.assertFalse(any(issue['repaired'] for issue in report['issues']))
+
+    def test_inactive_user_is_removed_from_the_queue(self):
+        for player in self.players:
+            self.wait_s3(player)
+        utils.make_player_inactive(self.players[2].user.username)
+        report = self.scan(repair=True)
+        self.assertEqual(self.causes(report), [(self.players[2].pk, 'inactive_user')])
+        self.assertEqual(self.backend.player_queues(self.players[2]), [])
+        # the barrier opens with the active members
+        self.assertTrue(RequestMonitor.check_condition(self.players[0].group, Constants.MONITOR_PHASE_S3, 1,
+                                                       lambda x: x == 2, True))
+
+    def test_missing_wait_is_repaired(self):
+        self.wait_s3(self.players[0])
+        self.wait_s3(self.players[1])
+        # the action of the last member was stored, but its wait was lost
+        GameData.objects.create(player=self.players[2], opponent=self.players[2], session=self.session,
+                                group=self.players[2].group, round=1, action=2)
+        Profile.objects.filter(player=self.players[2]).update(transition_state=Constants.STATE_TRANSITION_S3)
+        report = self.scan(repair=True)
+        self.assertEqual(self.causes(report), [(self.players[2].pk, 'stale_transition')])
+        self.assertTrue(report['issues'][0]['repaired'])
+        self.assertEqual(self.backend.player_queues(self.players[2]), [(Constants.MONITOR_PHASE_S3, 1)])
+
+    def test_stale_queue_and_missing_game_data(self):
+        for player in self.players[:2]:
+            self.wait_s3(player)
+        self.wait_s3(self.players[2], action=False)
+        # the first player left the barrier without being signaled
+        Profile.objects.filter(player=self.players[0]).update(transition_state=Constants.STATE_NO_TRANSITION)
+        report = self.scan()
+        self.assertEqual(self.causes(report), [(self.players[0].pk, 'stale_transition'),
+                                               (self.players[2].pk, 'missing_game_data')])
+        self.assertEqual(len(self.backend.player_queues(self.players[0])), 1)
+
+    def test_multiple_queues(self):
+        for player in self.players:
+            self.wait_s3(player)
+        self.backend.wait(self.players[1], Constants.MONITOR_PHASE_S2, 0)
+        issues = utils.correct_group_monitors_if_player_fails(self.players[1].pk)
+        self.assertEqual([(issue['cause'], issue['phase'], issue['round']) for issue in issues],
+                         [('multiple_queues', Constants.MONITOR_PHASE_S2, 0)])
+        self.assertEqual(self.backend.player_queues(self.players[1]), [(Constants.MONITOR_PHASE_S3, 1)])
+
+    def test_command_stores_the_report(self):
+        self.wait_s3(self.players[0])
+        out = StringIO()
+        call_command('watch_sessions', '--once', '--stuck-after', '0.05', stdout=out)
+        self.assertIn('not_responding', out.getvalue())
+        self.assertEqual(len(get_report(self.session.id)['issues']), 2)
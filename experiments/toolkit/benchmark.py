@@ -0,0 +1,380 @@
+# coding=utf-8
+# ==============================================================================
+# BEELPlatform
+# Copyright © 2016 Elias F. Domingos. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""
+This module benchmarks the request paths of a session, so that regressions in the number of
+queries, the latency or the locking of a view show up between two releases:
+1. A session of configurable size is provisioned with the admin functions (ExperimentsLoader,
+   add_users and init_experiment), and the cost of each of them is measured.
+2. Every participant plays the session with the Django test client, one group after the other
+   (the barriers are checked with sync_view without long-polling, once all the members arrived).
+   The admin monitor is refreshed once per round.
+3. For each request the statements are recorded with a database execute wrapper: number of
+   queries, latency, locking statements (SELECT ... FOR UPDATE, INSERT, UPDATE and DELETE take
+   row locks) and the time the locks are held. A lock taken inside an atomic block is held until
+   the block ends, which is detected on the next statement executed outside of it or at the end of
+   the request, so the lock time is an upper bound.
+4. The results (per endpoint: queries, p50/p99 latency and locks) are written to a JSON file,
+   which can be compared to the one of a previous run with compare_reports.
+
+With a database, the session is played on it (see experiments.routers) and the statements of the
+requests are recorded on it.
+
+The requests don't go through the network nor the web server (see experiments.toolkit.loadtest),
+so the results only depend on the code and the database. The benchmark creates its own users, it
+must run on a test database (see the benchmark management command).
+"""
+
+import json
+import os
+import platform
+import tempfile
+import time
+
+import django
+import numpy as np
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection, connections
+from django.test import Client
+from django.urls import reverse
+from django.utils import timezone, translation
+
+from experiments import routers
+from experiments.models import CollectiveRiskGame, Session, Instruction
+from experiments.utils import ExperimentsLoader, add_users, init_experiment, set_run_now
+
+# Statements that take row locks
+LOCKING_PREFIXES = ('INSERT', 'UPDATE', 'DELETE')
+# Maximum number of rounds played by a group (guards against endless loops)
+MAX_ROUNDS = 1000
+BENCHMARK_GAME_UID = 'benchmark'
+
+
+def atomic_depth(db_connection):
+    """:returns int - number of atomic blocks open on the connection"""
+    return int(db_connection.in_atomic_block) + len(db_connection.savepoint_ids)
+
+
+def is_locking(sql):
+    statement = sql.lstrip().upper()
+    return statement.startswith(LOCKING_PREFIXES) or (statement.startswith('SELECT') and 'FOR UPDATE' in statement)
+
+
+class StatementRecorder(object):
+    """
+    Database execute wrapper that counts the statements of a request and the time its row locks are held
+    """
+
+    def __init__(self, db_connection):
+        self.connection = db_connection
+        # atomic blocks already open when the request starts (e.g. the transaction of a TestCase)
+        self.base_depth = atomic_depth(db_connection)
+        self.queries = 0
+        self.locking = 0
+        self.lock_time = 0.0
+        self._lock_start = None
+
+    def __call__(self, execute, sql, params, many, context):
+        depth = atomic_depth(self.connection)
+        start = time.perf_counter()
+        if self._lock_start is not None and depth <= self.base_depth:
+            self._release(start)
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            if is_locking(sql):
+                self.locking += 1
+                if depth > self.base_depth:
+                    if self._lock_start is None:
+                        self._lock_start = start
+                else:
+                    # autocommit, the lock is released with the statement
+                    self.lock_time += time.perf_counter() - start
+
+    def _release(self, now):
+        self.lock_time += now - self._lock_start
+        self._lock_start = None
+
+    def finish(self, now):
+        if self._lock_start is not None:
+            self._release(now)
+
+
+class EndpointStats(object):
+    """Samples of the requests of an endpoint"""
+
+    def __init__(self):
+        self.latencies = []
+        self.queries = []
+        self.locking = []
+        self.lock_times = []
+        self.statuses = {}
+
+    def add(self, latency, recorder, status):
+        self.latencies.append(latency)
+        self.queries.append(recorder.queries)
+        self.locking.append(recorder.locking)
+        self.lock_times.append(recorder.lock_time * 1000)
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    def summary(self):
+        latencies = np.asarray(self.latencies)
+        queries = np.asarray(self.queries)
+        locking = np.asarray(self.locking)
+        lock_times = np.asarray(self.lock_times)
+        return {
+            'requests': len(latencies),
+            'queries_mean': float(queries.mean()),
+            'queries_max': int(queries.max()),
+            'mean_ms': float(latencies.mean()),
+            'p50_ms': float(np.percentile(latencies, 50)),
+            'p99_ms': float(np.percentile(latencies, 99)),
+            'max_ms': float(latencies.max()),
+            'locking_statements_mean': float(locking.mean()),
+            'locking_statements_max': int(locking.max()),
+            'lock_held_p50_ms': float(np.percentile(lock_times, 50)),
+            'lock_held_p99_ms': float(np.percentile(lock_times, 99)),
+            'statuses': {str(status): count for status, count in sorted(self.statuses.items())},
+        }
+
+
+class BenchmarkError(Exception):
+    """A request of the benchmark didn't return the expected response"""
+
+
+class Benchmark(object):
+    """
+    Provisions a session and plays it with the test client, recording the cost of each request
+    """
+
+    def __init__(self, players=24, group_size=6, rounds=10, experiments_path=None, language='en', seed=None,
+                 database=None):
+        """
+        :param players: number of participants of the session
+        :param group_size: members of each group
+        :param rounds: rounds of the game
+        :param experiments_path: JSON file loaded with ExperimentsLoader (the game uid of its treatments must be
+               'benchmark'), by default a single experiment with one session is created
+        :param language: language of the participant pages
+        :param seed: seed of the actions and predictions of the participants
+        :param database: alias of the database on which the session is played (the archive database by default)
+        """
+        if players < group_size:
+            raise ValueError("At least {} players are needed to form a group".format(group_size))
+        self.players = players
+        self.group_size = group_size
+        self.rounds = rounds
+        self.experiments_path = experiments_path
+        self.language = language
+        self.seed = seed
+        self.database = database or routers.get_archive_database()
+        self.random_state = np.random.RandomState(seed)
+        self.stats = {}
+        self.provisioning = {}
+        self.session = None
+        self.game = None
+        self.users = {}
+        self._cursor = 0
+
+    def _measure(self, name, function, *args):
+        recorder = StatementRecorder(connection)
+        with connection.execute_wrapper(recorder):
+            start = time.perf_counter()
+            result = function(*args)
+            end = time.perf_counter()
+        recorder.finish(end)
+        self.provisioning[name] = {'seconds': end - start, 'queries': recorder.queries,
+                                   'locking_statements': recorder.locking}
+        return result
+
+    def provision(self):
+        """Creates the game, the session and its participants with the admin functions"""
+        self.game = CollectiveRiskGame.objects.create(
+            game_uid=BENCHMARK_GAME_UID, game_name='Benchmark', game_metadata='', num_players=self.players,
+            threshold=self.group_size * self.rounds, group_size=self.group_size, rounds=self.rounds)
+
+        if self.experiments_path is not None:
+            self._measure('load_experiments', ExperimentsLoader(self.experiments_path).load)
+        else:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                path = os.path.join(tmp_dir, 'experiments.json')
+                with open(path, 'w') as json_file:
+                    json.dump(self._experiments_json(), json_file)
+                self._measure('load_experiments', ExperimentsLoader(path).load)
+
+        self.session = Session.objects.select_related('experiment', 'treatment').filter(
+            treatment__game=self.game).latest('pk')
+        self.session.database = self.database
+        self.session.save(update_fields=['database'])
+        Instruction.objects.create(treatment=self.session.treatment, text='[PAGE]', lang=self.language)
+        set_run_now(self.session.experiment_id, self.session.pk, self.session.treatment_id)
+
+        self.users = {str(i): {'username': 'benchmark{}'.format(i), 'password': 'benchmark{}pass'.format(i)}
+                      for i in range(self.players)}
+        self._measure('add_users', add_users, self.users, self.session.experiment, self.session,
+                      self.session.treatment)
+        self._measure('init_experiment', init_experiment, self.session.pk)
+
+    def _experiments_json(self):
+        return {'1': {
+            'experiment_name': 'Benchmark', 'experiment_metadata': '',
+            'treatments': {'1': {
+                'game_uid': BENCHMARK_GAME_UID, 'treatment_name': 'Benchmark', 'treatment_metadata': '',
+                'sessions': {'1': {'session_number': 1, 'session_metadata': '',
+                                   'scheduled_date': timezone.now().isoformat(), 'group_size': self.group_size}},
+            }},
+        }}
+
+    def url(self, name, **kwargs):
+        with translation.override(self.language):
+            if name not in ('login', 'instructions', 'fetch_data'):
+                kwargs.setdefault('session_id', self.session.pk)
+            return reverse('experiments:{}'.format(name), kwargs=kwargs)
+
+    def request(self, endpoint, client, method, url, data=None, expected=(200,)):
+        db_connection = connections[self.database]
+        recorder = StatementRecorder(db_connection)
+        with db_connection.execute_wrapper(recorder):
+            start = time.perf_counter()
+            response = getattr(client, method)(url, data or {})
+            end = time.perf_counter()
+        recorder.finish(end)
+        self.stats.setdefault(endpoint, EndpointStats()).add((end - start) * 1000, recorder,
+                                                             response.status_code)
+        if response.status_code not in expected:
+            raise BenchmarkError("{} {} returned {}".format(method.upper(), url, response.status_code))
+        return response
+
+    def sync(self, clients):
+        for client in clients:
+            response = self.request('sync', client, 'post', self.url('sync'))
+            if not json.loads(response.content.decode())['can_continue']:
+                raise BenchmarkError("The barrier didn't open after all the members arrived")
+
+    def _form(self, **values):
+        now = timezone.now()
+        values.update({'time_round_start': now, 'time_round_end': now, 'time_elapsed': '00:00:01'})
+        return values
+
+    def play(self):
+        """Plays the session, group by group"""
+        actions = [action.strip() for action in self.game.valid_actions.split(',')]
+        clients = {}
+        for user in self.users.values():
+            client = Client()
+            self.request('login', client, 'post', self.url('login'), user, expected=(302,))
+            self.request('instructions', client, 'get', self.url('instructions'))
+            self.request('test', client, 'get', self.url('test'))
+            group_id = User.objects.select_related('player').get(username=user['username']).player.group_id
+            clients.setdefault(group_id, []).append(client)
+
+        admin = Client()
+        admin.force_login(User.objects.create_user('benchmark_admin', is_staff=True))
+
+        for group_id, members in sorted(clients.items(), key=lambda item: item[0] or 0):
+            if group_id is None:
+                # players left without group can't play
+                continue
+            for client in members:
+                self.request('results_round', client, 'get', self.url('results_round'))
+            self.sync(members)
+            for g_round in range(MAX_ROUNDS):
+                for client in members:
+                    self.request('game', client, 'get', self.url('game'))
+                    self.request('game_round', client, 'post', self.url('game_round'),
+                                 self._form(action=self.random_state.choice(actions)))
+                self.sync(members)
+                finished = False
+                for client in members:
+                    self.request('results', client, 'get', self.url('results'))
+                    response = self.request('results_round', client, 'post', self.url('results_round'),
+                                            self._form(prediction=self.random_state.randint(0, 10)),
+                                            expected=(200, 302))
+                    finished = response.status_code == 302
+                self.refresh_monitor(admin)
+                if finished:
+                    break
+                self.sync(members)
+            else:
+                raise BenchmarkError("The game didn't finish after {} rounds".format(MAX_ROUNDS))
+            for client in members:
+                self.request('results_risk_wait', client, 'get', self.url('results_risk_wait'))
+            self.sync(members)
+            for client in members:
+                self.request('results_risk', client, 'post', self.url('results_risk'))
+
+    def refresh_monitor(self, admin):
+        self.request('admin_monitor', admin, 'get', self.url('monitor'))
+        self.request('admin_monitor_ajax', admin, 'get', self.url('fetch_monitor_data'))
+        # the graph only asks for the rows updated since its last refresh
+        response = self.request('admin_fetch_data', admin, 'get', self.url('fetch_data'), {'since': self._cursor})
+        self._cursor = json.loads(response.content.decode())['cursor']
+
+    def run(self):
+        """:returns dict - report of the benchmark"""
+        time_start = time.perf_counter()
+        self.provision()
+        self.play()
+        return {
+            'created_at': timezone.now().isoformat(),
+            'duration': time.perf_counter() - time_start,
+            'parameters': {'players': self.players, 'group_size': self.group_size, 'rounds': self.rounds,
+                           'language': self.language, 'seed': self.seed, 'database': self.database},
+            'environment': {
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'database': connections[self.database].vendor,
+                'monitor_backend': getattr(settings, 'EXPERIMENTS_MONITOR_BACKEND', None),
+                'notifier': getattr(settings, 'EXPERIMENTS_BARRIER_NOTIFIER', None),
+            },
+            'provisioning': self.provisioning,
+            'endpoints': {endpoint: stats.summary() for endpoint, stats in sorted(self.stats.items())},
+        }
+
+
+def compare_reports(baseline, report, tolerance=0.2):
+    """
+    :param baseline: report of a previous run
+    :param report: report of the current run
+    :param tolerance: relative increase of the latency tolerated (the query and lock counts must not grow)
+    :return: list of str - regressions found
+    """
+    regressions = []
+    for endpoint, stats in sorted(report['endpoints'].items()):
+        previous = baseline['endpoints'].get(endpoint)
+        if previous is None:
+            continue
+        for key in ('queries_max', 'locking_statements_max'):
+            if stats[key] > previous[key]:
+                regressions.append("{}: {} {} -> {}".format(endpoint, key, previous[key], stats[key]))
+        for key in ('p50_ms', 'p99_ms'):
+            if stats[key] > previous[key] * (1 + tolerance):
+                regressions.append("{}: {} {:.1f} -> {:.1f}".format(endpoint, key, previous[key], stats[key]))
+    return regressions
+
+
+def read_report(path):
+    with open(path) as json_file:
+        return json.load(json_file)
+
+
+def write_report(report, path):
+    with open(path, 'w') as json_file:
+        json.dump(report, json_file, indent=2, sort_keys=True)
@@ -3,4 +3,300 @@ Created by: Elias F.
 Date: 01/10/2018
 Summary: Here you'll find several util functions to get data from the database and transform into formats ready
          to be processes by machine learning and statistical software (e.g., DataFrames)
-"""
\ No newline at end of file
+
+Each table is loaded with a single query (the related columns are resolved with joins) into a typed
+pandas DataFrame:
+- load_sessions: one row per session, with the treatment and the parameters of the game.
+- load_groups: one row per group, with its final round and public account.
+- load_rounds: one row per player and round, with the action, the accounts, the prediction and the timings.
+- load_accounts: one row per player, with the final private account and the payoff.
+All loaders can be filtered by experiment and/or sessions. The rows of finished sessions don't change anymore,
+so they are stored in a local cache (one pickle file per table and session, in EXPERIMENTS_ANALYSIS_CACHE) and
+reloading a notebook doesn't query the database again. The files are keyed by the version of the rows of the
+session in the table (aggregates of the columns that change, see TABLE_VERSIONS), so a session that is played
+again, or whose groups or accounts are corrected afterwards, is loaded from the database again. Derived columns
+are always recomputed.
+"""
+
+import os
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from django.db.models import Count, Max, Sum, Q
+from django.db.models.functions import Length
+
+from experiments.constants import Constants
+from experiments.models import Session, Group, GameData, Profile
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'beelbe')
+
+SESSION_FIELDS = OrderedDict([
+    ('id', 'session'),
+    ('session_number', 'session_number'),
+    ('experiment_id', 'experiment'),
+    ('experiment__experiment_name', 'experiment_name'),
+    ('treatment_id', 'treatment'),
+    ('treatment__treatment_name', 'treatment_name'),
+    ('scheduled_date', 'scheduled_date'),
+    ('finished', 'finished'),
+    ('group_size', 'session_group_size'),
+    ('random_seed', 'random_seed'),
+    ('treatment__game__collectiveriskgame__threshold', 'threshold'),
+    ('treatment__game__collectiveriskgame__risk_prob', 'risk_prob'),
+    ('treatment__game__collectiveriskgame__group_size', 'group_size'),
+    ('treatment__game__collectiveriskgame__endowment', 'endowment'),
+    ('treatment__game__collectiveriskgame__rounds', 'rounds'),
+    ('treatment__game__collectiveriskgame__is_round_variable', 'is_round_variable'),
+    ('treatment__game__collectiveriskgame__min_round', 'min_round'),
+    ('treatment__game__collectiveriskgame__termination_probability', 'termination_probability'),
+    ('treatment__game__conversion_rate', 'conversion_rate'),
+])
+
+GROUP_FIELDS = OrderedDict([
+    ('session_id', 'session'),
+    ('id', 'group_id'),
+    ('group_number', 'group'),
+    ('finishing_round', 'finishing_round'),
+    ('game_finished', 'game_finished'),
+    ('public_account', 'public_account'),
+    ('random_value', 'random_value'),
+    ('dice_results', 'dice_results'),
+])
+
+ROUND_FIELDS = OrderedDict([
+    ('session_id', 'session'),
+    ('group__group_number', 'group'),
+    ('player_id', 'player'),
+    ('round', 'round'),
+    ('action', 'action'),
+    ('private_account', 'private_account'),
+    ('public_account', 'public_account'),
+    ('prediction_question', 'prediction'),
+    ('time_round_start', 'time_round_start'),
+    ('time_round_ends', 'time_round_ends'),
+    ('time_question_start', 'time_question_start'),
+    ('time_question_end', 'time_question_end'),
+])
+
+ACCOUNT_FIELDS = OrderedDict([
+    ('player__session_id', 'session'),
+    ('group_number', 'group'),
+    ('player_id', 'player'),
+    ('player__user__username', 'username'),
+    ('private_account', 'private_account'),
+    ('threshold_state', 'threshold_state'),
+    ('last_round', 'last_round'),
+    ('finished', 'finished'),
+    ('language', 'language'),
+    ('time_start_experiment', 'time_start_experiment'),
+    ('time_ends_experiment', 'time_ends_experiment'),
+])
+
+# nullable integer columns
+INTEGER_COLUMNS = ('group', 'action', 'private_account', 'public_account', 'threshold_state', 'random_seed')
+DATETIME_COLUMNS = ('scheduled_date', 'time_round_start', 'time_round_ends', 'time_question_start',
+                    'time_question_end', 'time_start_experiment', 'time_ends_experiment')
+
+# model, session lookup and aggregates of the rows of each table (their names can't be the ones of the fields):
+# they change when the rows of a session are created again (the game data rows get new ids) or modified after
+# the session (e.g. corrected payoffs)
+TABLE_VERSIONS = {
+    'groups': (Group, 'session', OrderedDict([
+        ('row_count', Count('id')),
+        ('last_id', Max('id')),
+        ('public_account_sum', Sum('public_account')),
+        ('finishing_round_sum', Sum('finishing_round')),
+        ('finished_count', Count('id', filter=Q(game_finished=True))),
+        ('random_value_sum', Sum('random_value')),
+        ('dice_results_length', Sum(Length('dice_results'))),
+    ])),
+    'rounds': (GameData, 'session', OrderedDict([
+        ('row_count', Count('id')),
+        ('last_id', Max('id')),
+    ])),
+    'accounts': (Profile, 'player__session', OrderedDict([
+        ('row_count', Count('pk')),
+        ('last_id', Max('pk')),
+        ('private_account_sum', Sum('private_account')),
+        ('threshold_state_sum', Sum('threshold_state')),
+        ('last_round_sum', Sum('last_round')),
+        ('finished_count', Count('pk', filter=Q(finished=True))),
+        ('last_end', Max('time_ends_experiment')),
+    ])),
+}
+
+
+def get_cache_dir():
+    return getattr(settings, 'EXPERIMENTS_ANALYSIS_CACHE', DEFAULT_CACHE_DIR)
+
+
+def clear_cache():
+    """Removes all the cached tables"""
+    cache_dir = get_cache_dir()
+    if os.path.isdir(cache_dir):
+        for name in os.listdir(cache_dir):
+            if name.endswith('.pkl'):
+                os.remove(os.path.join(cache_dir, name))
+
+
+def _cache_path(table, session_id, version):
+    return os.path.join(get_cache_dir(), '{}_session_{}_{}.pkl'.format(table, session_id, version))
+
+
+def _remove_cached(table, session_id):
+    """Removes the cached versions of the table of a session"""
+    prefix = '{}_session_{}_'.format(table, session_id)
+    cache_dir = get_cache_dir()
+    if os.path.isdir(cache_dir):
+        for name in os.listdir(cache_dir):
+            if name.startswith(prefix) and name.endswith('.pkl'):
+                os.remove(os.path.join(cache_dir, name))
+
+
+def get_session_versions(session_ids, table='rounds'):
+    """
+    :param session_ids: ids of the sessions
+    :param table: name of the table (see TABLE_VERSIONS)
+    :return: dict - version of the rows of each session in the table ('0' if it has none)
+    """
+    model, session_lookup, aggregates = TABLE_VERSIONS[table]
+    versions = {session_id: '0' for session_id in session_ids}
+    rows = model.objects.filter(**{'{}__in'.format(session_lookup): session_ids}).order_by().values(
+        session_lookup).annotate(**aggregates).values_list(session_lookup, *aggregates)
+    versions.update({row[0]: '{:08x}'.format(zlib.crc32(repr(row[1:]).encode('utf-8'))) for row in rows})
+    return versions
+
+
+def _to_frame(rows, fields):
+    df = pd.DataFrame.from_records(rows, columns=list(fields.values()))
+    for column in df.columns:
+        if column in INTEGER_COLUMNS:
+            df[column] = df[column].astype('Int64')
+        elif column in DATETIME_COLUMNS:
+            df[column] = pd.to_datetime(df[column], utc=True)
+    return df
+
+
+def load_sessions(experiment=None, sessions=None):
+    """
+    :param experiment: Experiment object or id, to load only the sessions of the experiment
+    :param sessions: list of Session objects or ids, to load only these sessions
+    :return: DataFrame - one row per session with the parameters of its game
+    """
+    queryset = Session.objects.all()
+    if experiment is not None:
+        queryset = queryset.filter(experiment=experiment)
+    if sessions is not None:
+        queryset = queryset.filter(pk__in=[getattr(session, 'pk', session) for session in sessions])
+    return _to_frame(list(queryset.order_by('pk').values_list(*SESSION_FIELDS)), SESSION_FIELDS)
+
+
+def _load_table(table, queryset, session_lookup, fields, session_info, cache):
+    """
+    Loads the rows of the sessions that are not cached with a single query and caches the finished sessions
+    """
+    frames = []
+    missing = []
+    finished_ids = [int(session_id) for session_id, finished in zip(session_info['session'], session_info['finished'])
+                    if finished]
+    versions = get_session_versions(finished_ids, table) if cache and finished_ids else {}
+    for session_id, finished in zip(session_info['session'], session_info['finished']):
+        path = _cache_path(table, session_id, versions.get(session_id))
+        if cache and finished and os.path.exists(path):
+            frames.append(pd.read_pickle(path))
+        else:
+            missing.append((session_id, finished))
+
+    if missing:
+        queryset = queryset.filter(**{'{}__in'.format(session_lookup): [session_id for session_id, _ in missing]})
+        df = _to_frame(list(queryset.values_list(*fields).iterator()), fields)
+        if cache:
+            os.makedirs(get_cache_dir(), exist_ok=True)
+        for session_id, finished in missing:
+            part = df[df['session'] == session_id].reset_index(drop=True)
+            if cache and finished:
+                _remove_cached(table, session_id)
+                part.to_pickle(_cache_path(table, session_id, versions[session_id]))
+            frames.append(part)
+
+    if not frames:
+        return _to_frame([], fields)
+    return pd.concat(frames, ignore_index=True)
+
+
+def load_groups(experiment=None, sessions=None, cache=True, session_info=None):
+    """
+    :return: DataFrame - one row per group, with the derived column:
+        - threshold_reached: True if the public account reached the threshold of the game
+    """
+    if session_info is None:
+        session_info = load_sessions(experiment, sessions)
+    df = _load_table('groups', Group.objects.order_by('session', 'group_number'), 'session', GROUP_FIELDS,
+                     session_info, cache)
+    df = df.merge(session_info[['session', 'threshold']], on='session', how='left')
+    df['threshold_reached'] = df['public_account'] >= df['threshold']
+    return df.drop(columns='threshold')
+
+
+def load_rounds(experiment=None, sessions=None, cache=True, session_info=None):
+    """
+    :return: DataFrame - one row per player and round, with the derived columns:
+        - decision_latency / prediction_latency: seconds taken to choose the action / make the prediction
+        - contribution: amount transferred to the public account in the round
+        - group_contribution: total contribution of the group in the round
+        - cumulative_contribution: public account of the group at the end of the round
+        - threshold_reached: True if the cumulative contribution of the group reached the threshold
+    """
+    if session_info is None:
+        session_info = load_sessions(experiment, sessions)
+    df = _load_table('rounds', GameData.objects.order_by('session', 'group', 'round', 'player'), 'session',
+                     ROUND_FIELDS, session_info, cache)
+
+    df['prediction'] = pd.to_numeric(df['prediction'], errors='coerce')
+    df['decision_latency'] = (df['time_round_ends'] - df['time_round_start']).dt.total_seconds()
+    df['prediction_latency'] = (df['time_question_end'] - df['time_question_start']).dt.total_seconds()
+    df['contribution'] = df['action'].fillna(0)
+    df['group_contribution'] = df.groupby(['session', 'group', 'round'])['contribution'].transform('sum')
+
+    totals = df.groupby(['session', 'group', 'round'], as_index=False)['contribution'].sum()
+    totals['cumulative_contribution'] = totals.groupby(['session', 'group'])['contribution'].cumsum()
+    df = df.merge(totals.drop(columns='contribution'), on=['session', 'group', 'round'], how='left')
+    df = df.merge(session_info[['session', 'threshold']], on='session', how='left')
+    df['threshold_reached'] = df['cumulative_contribution'] >= df['threshold']
+    return df.drop(columns='threshold')
+
+
+def load_accounts(experiment=None, sessions=None, cache=True, session_info=None):
+    """
+    :return: DataFrame - one row per player, with the derived columns:
+        - payoff_emus: private account kept at the end of the game (0 if the group lost)
+        - payoff_euros: payment of the player (see Profile.get_value_in_euros)
+        - duration: seconds spent on the experiment
+    """
+    if session_info is None:
+        session_info = load_sessions(experiment, sessions)
+    df = _load_table('accounts', Profile.objects.order_by('player__session', 'group_number', 'player'),
+                     'player__session', ACCOUNT_FIELDS, session_info, cache)
+
+    df = df.merge(session_info[['session', 'conversion_rate']], on='session', how='left')
+    lost = (df['threshold_state'] == Constants.LOSS).fillna(False).to_numpy(dtype=bool)
+    df['payoff_emus'] = np.where(lost, 0, df['private_account'].fillna(0))
+    df['payoff_euros'] = np.where(lost, 2.5, df['private_account'].fillna(0) * df['conversion_rate'] + 2.5)
+    df['duration'] = (df['time_ends_experiment'] - df['time_start_experiment']).dt.total_seconds()
+    return df.drop(columns='conversion_rate')
+
+
+def load_all(experiment=None, sessions=None, cache=True):
+    """
+    :return: dict - DataFrames of the sessions, groups, rounds and accounts
+    """
+    session_info = load_sessions(experiment, sessions)
+    return {
+        'sessions': session_info,
+        'groups': load_groups(cache=cache, session_info=session_info),
+        'rounds': load_rounds(cache=cache, session_info=session_info),
+        'accounts': load_accounts(cache=cache, session_info=session_info),
+    }
@@ -0,0 +1,352 @@
+# coding=utf-8
+# ==============================================================================
+# BEELPlatform
+# Copyright © 2016 Elias F. Domingos. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""
+This module load tests a running server with thousands of virtual participants:
+1. Each participant is a coroutine with its own cookie jar that plays a full session through the
+   HTTP endpoints (login, instructions, test, game, results, sync and risk check), in the same
+   order as a browser. All participants share a single connection pool.
+2. Between two pages the participant "thinks" for a time drawn from a configurable distribution
+   (see parse_think_time), the barriers are waited with long-polling sync requests.
+3. The latency of every request is recorded per endpoint, and the report (latency percentiles,
+   histograms, throughput and errors) is written to a JSON file.
+
+Unlike experiments.toolkit.testagents, which uses the Django test client, the requests go through
+the network, the web server and the workers, so the results can be used to size the hardware.
+It requires aiohttp (pip install aiohttp).
+"""
+
+import asyncio
+import json
+import time
+
+import numpy as np
+from django.urls import reverse
+from django.utils import timezone, translation
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# Upper bounds (ms) of the latency histogram buckets
+HISTOGRAM_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+# Maximum number of rounds played by a participant (guards against endless loops)
+MAX_ROUNDS = 1000
+# Endpoints whose url doesn't contain the session
+SESSIONLESS_URLS = ('login', 'instructions')
+
+
+class ThinkTime(object):
+    """Distribution of the seconds a participant spends on a page before sending the form"""
+
+    def __init__(self, name, *args):
+        self.name = name
+        self.args = args
+        samplers = {
+            'none': lambda rs: 0.0,
+            'const': lambda rs: args[0],
+            'uniform': lambda rs: rs.uniform(args[0], args[1]),
+            'exp': lambda rs: rs.exponential(args[0]),
+            'lognormal': lambda rs: rs.lognormal(args[0], args[1]),
+        }
+        try:
+            self._sample = samplers[name]
+        except KeyError:
+            raise ValueError("Unknown think time distribution {}, choose from {}".format(name, sorted(samplers)))
+
+    def sample(self, random_state):
+        """:returns float - seconds (never negative)"""
+        return max(float(self._sample(random_state)), 0.0)
+
+    def __repr__(self):
+        return "ThinkTime({})".format(", ".join([repr(self.name)] + [str(arg) for arg in self.args]))
+
+
+def parse_think_time(spec):
+    """
+    Parses a think time distribution, e.g. "none", "const:2", "uniform:0,10", "exp:3" or "lognormal:1,0.5"
+    :return: ThinkTime
+    """
+    name, _, args = spec.strip().partition(':')
+    return ThinkTime(name, *[float(arg) for arg in args.split(',') if arg])
+
+
+class LatencyRecorder(object):
+    """Latencies (ms) and status codes of the requests, per endpoint"""
+
+    def __init__(self):
+        self.latencies = {}
+        self.statuses = {}
+        self.errors = {}
+        self.time_start = None
+        self.time_end = None
+
+    def record(self, endpoint, latency, status):
+        self.latencies.setdefault(endpoint, []).append(latency)
+        statuses = self.statuses.setdefault(endpoint, {})
+        statuses[status] = statuses.get(status, 0) + 1
+
+    def record_error(self, endpoint, error):
+        errors = self.errors.setdefault(endpoint, {})
+        name = type(error).__name__
+        errors[name] = errors.get(name, 0) + 1
+
+    def summary(self):
+        """:returns dict - per endpoint: count, throughput, latency percentiles and histogram"""
+        now = time.monotonic()
+        duration = (now if self.time_end is None else self.time_end) - (now if self.time_start is None
+                                                                       else self.time_start)
+        endpoints = {}
+        for endpoint, latencies in sorted(self.latencies.items()):
+            latencies = np.asarray(latencies)
+            # bucket i counts the latencies in (HISTOGRAM_BUCKETS[i - 1], HISTOGRAM_BUCKETS[i]]
+            counts = np.bincount(np.searchsorted(HISTOGRAM_BUCKETS, latencies), minlength=len(HISTOGRAM_BUCKETS) + 1)
+            endpoints[endpoint] = {
+                'requests': len(latencies),
+                'throughput': len(latencies) / duration if duration > 0 else None,
+                'mean_ms': float(latencies.mean()),
+                'p50_ms': float(np.percentile(latencies, 50)),
+                'p90_ms': float(np.percentile(latencies, 90)),
+                'p95_ms': float(np.percentile(latencies, 95)),
+                'p99_ms': float(np.percentile(latencies, 99)),
+                'max_ms': float(latencies.max()),
+                'histogram': {('<={}'.format(bound) if bound != np.inf else '>{}'.format(HISTOGRAM_BUCKETS[-1])):
+                              int(count) for bound, count in zip(HISTOGRAM_BUCKETS + (np.inf,), counts)},
+                'statuses': {str(status): count for status, count in sorted(self.statuses[endpoint].items())},
+                'errors': self.errors.get(endpoint, {}),
+            }
+        requests = sum(len(latencies) for latencies in self.latencies.values())
+        return {
+            'duration': duration,
+            'requests': requests,
+            'throughput': requests / duration if duration > 0 else None,
+            'endpoints': endpoints,
+        }
+
+
+class ParticipantError(Exception):
+    """The server answered with an unexpected status"""
+
+
+class VirtualParticipant(object):
+    """
+    Plays a whole session through HTTP, like experiments.toolkit.testagents.crd_experiment_test_agent
+    """
+
+    def __init__(self, base_url, session_id, username, password, think_time, recorder, random_state,
+                 language='en', actions=(0, 2, 4), max_wait=300):
+        self.base_url = base_url.rstrip('/')
+        self.session_id = session_id
+        self.username = username
+        self.password = password
+        self.think_time = think_time
+        self.recorder = recorder
+        self.random_state = random_state
+        self.language = language
+        self.actions = actions
+        self.max_wait = max_wait
+        self.http = None
+        self.rounds = 0
+
+    def url(self, name, **kwargs):
+        with translation.override(self.language):
+            if name not in SESSIONLESS_URLS:
+                kwargs['session_id'] = self.session_id
+            return self.base_url + reverse('experiments:{}'.format(name), kwargs=kwargs)
+
+    def csrf_token(self):
+        cookie = self.http.cookie_jar.filter_cookies(self.base_url).get('csrftoken')
+        return cookie.value if cookie is not None else ''
+
+    async def request(self, method, name, data=None, expected=(200,)):
+        """
+        Sends a request to the endpoint and records its latency
+        :return: (status, body as text, location of the redirect)
+        """
+        url = self.url(name)
+        headers = {'Referer': url}
+        if method == 'POST':
+            data = dict(data or {}, csrfmiddlewaretoken=self.csrf_token())
+            headers['X-CSRFToken'] = data['csrfmiddlewaretoken']
+        time_start = time.monotonic()
+        try:
+            async with self.http.request(method, url, data=data, headers=headers, allow_redirects=False) as response:
+                body = await response.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.recorder.record_error(name, e)
+            raise
+        self.recorder.record(name, (time.monotonic() - time_start) * 1000, response.status)
+        if response.status not in expected:
+            error = ParticipantError("[{}] {} {} returned {}".format(self.username, method, name, response.status))
+            self.recorder.record_error(name, error)
+            raise error
+        return response.status, body, response.headers.get('Location', '')
+
+    async def think(self):
+        await asyncio.sleep(self.think_time.sample(self.random_state))
+
+    async def sync(self):
+        """Waits on the barrier of the group with long-polling requests (at most max_wait seconds)"""
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            _, body, _ = await self.request('POST', 'sync', {'long_poll': 1})
+            if json.loads(body)['can_continue']:
+                return
+            if time.monotonic() > deadline:
+                # another member of the group failed, the barrier will never open
+                error = ParticipantError("[{}] barrier not open after {}s".format(self.username, self.max_wait))
+                self.recorder.record_error('sync', error)
+                raise error
+
+    def timings(self):
+        now = timezone.now()
+        return {'time_round_start': now.isoformat(), 'time_round_end': now.isoformat(), 'time_elapsed': '00:00:01'}
+
+    async def play(self, http):
+        """Plays the session: login, instructions, test, rounds and risk check"""
+        self.http = http
+        # the login page sets the csrf cookie
+        await self.request('GET', 'login')
+        await self.think()
+        await self.request('POST', 'login', {'username': self.username, 'password': self.password},
+                           expected=(302,))
+        await self.request('GET', 'instructions')
+        await self.think()
+        await self.request('GET', 'test')
+        await self.think()
+        await self.request('GET', 'results_round')
+        await self.sync()
+
+        finished = False
+        while not finished and self.rounds < MAX_ROUNDS:
+            self.rounds += 1
+            await self.request('GET', 'game')
+            await self.think()
+            action = self.actions[self.random_state.randint(len(self.actions))]
+            await self.request('POST', 'game_round', dict(self.timings(), action=action))
+            await self.sync()
+            await self.request('GET', 'results')
+            await self.think()
+            status, _, _ = await self.request('POST', 'results_round', dict(self.timings(), prediction=4),
+                                                     expected=(200, 302))
+            finished = status == 302
+            if not finished:
+                await self.sync()
+
+        await self.request('GET', 'results_risk_wait')
+        await self.sync()
+        await self.request('POST', 'results_risk')
+
+
+class LoadTest(object):
+    """
+    Runs a session with virtual participants against a server
+    """
+
+    def __init__(self, base_url, session_id, credentials, think_time='uniform:0,10', ramp_up=0.0,
+                 max_connections=1000, timeout=60, max_wait=300, seed=None, language='en'):
+        """
+        :param base_url: root url of the server (e.g. http://localhost:8000)
+        :param session_id: session played by the participants
+        :param credentials: list of (username, password), one per participant
+        :param think_time: ThinkTime or its specification (see parse_think_time)
+        :param ramp_up: seconds over which the participants start
+        :param max_connections: maximum number of simultaneous connections to the server
+        :param timeout: seconds before a request fails (must be above EXPERIMENTS_SYNC_TIMEOUT)
+        :param max_wait: seconds a participant waits on a barrier before giving up
+        :param seed: seed of the think times and actions
+        """
+        if aiohttp is None:
+            raise ImportError("aiohttp is required to run load tests (pip install aiohttp)")
+        self.base_url = base_url
+        self.session_id = session_id
+        self.credentials = credentials
+        self.think_time = parse_think_time(think_time) if isinstance(think_time, str) else think_time
+        self.ramp_up = ramp_up
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.max_wait = max_wait
+        self.seed = seed
+        self.language = language
+        self.recorder = LatencyRecorder()
+        self.completed = 0
+        self.failed = []
+
+    async def _run_participant(self, connector, index, username, password):
+        random_state = np.random.RandomState(None if self.seed is None else [self.seed, index])
+        if self.ramp_up:
+            await asyncio.sleep(self.ramp_up * index / len(self.credentials))
+        participant = VirtualParticipant(self.base_url, self.session_id, username, password, self.think_time,
+                                         self.recorder, random_state, language=self.language,
+                                         max_wait=self.max_wait)
+        # each participant has its own cookies, the connections are shared
+        async with aiohttp.ClientSession(connector=connector, connector_owner=False,
+                                         cookie_jar=aiohttp.CookieJar(unsafe=True),
+                                         timeout=aiohttp.ClientTimeout(total=self.timeout)) as http:
+            try:
+                await participant.play(http)
+            except (ParticipantError, aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                self.failed.append({'username': username, 'round': participant.rounds, 'error': str(e)})
+            else:
+                self.completed += 1
+
+    async def run_async(self):
+        connector = aiohttp.TCPConnector(limit=self.max_connections)
+        self.recorder.time_start = time.monotonic()
+        try:
+            await asyncio.gather(*[self._run_participant(connector, index, username, password)
+                                   for index, (username, password) in enumerate(self.credentials)])
+        finally:
+            self.recorder.time_end = time.monotonic()
+            await connector.close()
+        return self.report()
+
+    def run(self):
+        """:returns dict - report of the load test"""
+        return asyncio.run(self.run_async())
+
+    def report(self):
+        report = {
+            'base_url': self.base_url,
+            'session': self.session_id,
+            'participants': len(self.credentials),
+            'completed': self.completed,
+            'failed': self.failed,
+            'think_time': repr(self.think_time),
+            'ramp_up': self.ramp_up,
+            'max_connections': self.max_connections,
+            'max_wait': self.max_wait,
+        }
+        report.update(self.recorder.summary())
+        return report
+
+
+def read_credentials(path):
+    """
+    :param path: JSON file {key: {"username": ..., "password": ...}} (as saved by utils.add_users2session)
+    :return: list of (username, password)
+    """
+    with open(path) as json_file:
+        users = json.load(json_file)
+    return [(user['username'], user['password']) for _, user in sorted(users.items())]
+
+
+def write_report(report, path):
+    with open(path, 'w') as json_file:
+        json.dump(report, json_file, indent=2, sort_keys=True)
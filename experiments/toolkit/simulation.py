@@ -0,0 +1,272 @@
+# coding=utf-8
+# ==============================================================================
+# BEELPlatform
+# Copyright © 2016 Elias F. Domingos. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""
+This module simulates Collective-Risk Dilemma treatments before running them with humans.
+Groups of parametric strategies play the game in batch: every operation is applied with numpy
+to all the groups at once, and the only python loop is over the rounds of the game.
+
+The rules are the same as the ones of the platform:
+1. Each member starts with the endowment and transfers one of the valid actions per round
+   to the public account.
+2. With a fixed deadline the game lasts game.rounds rounds. With a variable deadline the final round
+   is drawn with the same distribution as experiments.utils.calculate_final_round.
+3. At the end, if the public account is below the threshold, all members of the group lose their
+   private account with probability risk_prob (see experiments.views.check_threshold_view).
+"""
+
+import numpy as np
+
+# Number of groups simulated at once, bounds the memory used by simulate
+DEFAULT_BATCH_SIZE = 100000
+
+
+class CRDParameters(object):
+    """
+    Parameters of a Collective-Risk Dilemma treatment (see experiments.models.CollectiveRiskGame).
+    """
+
+    def __init__(self, threshold, risk_prob, group_size, endowment, valid_actions, rounds,
+                 is_round_variable=False, min_round=0, termination_probability=0.0, dice_faces=6,
+                 conversion_rate=1.0):
+        self.threshold = threshold
+        self.risk_prob = risk_prob
+        self.group_size = group_size
+        self.endowment = endowment
+        self.valid_actions = np.array(sorted(int(action) for action in valid_actions), dtype=np.int64)
+        self.rounds = rounds
+        self.is_round_variable = is_round_variable
+        self.min_round = min_round
+        self.termination_probability = termination_probability
+        self.dice_faces = dice_faces
+        self.conversion_rate = conversion_rate
+
+    @staticmethod
+    def from_game(game):
+        """
+        :param game: CollectiveRiskGame object
+        :return: CRDParameters of the game
+        """
+        return CRDParameters(threshold=game.threshold, risk_prob=game.risk_prob, group_size=game.group_size,
+                             endowment=game.endowment, valid_actions=game.get_valid_actions_as_list(),
+                             rounds=game.rounds, is_round_variable=game.is_round_variable,
+                             min_round=game.min_round, termination_probability=game.termination_probability,
+                             dice_faces=game.dice_faces, conversion_rate=game.conversion_rate)
+
+    def copy(self, **kwargs):
+        """:returns CRDParameters - copy of the parameters in which the given ones are replaced"""
+        params = dict(self.__dict__, **kwargs)
+        return CRDParameters(**params)
+
+
+def get_random_state(seed=None):
+    """
+    :param seed: None, int or numpy.random.RandomState
+    :return: numpy.random.RandomState
+    """
+    if isinstance(seed, np.random.RandomState):
+        return seed
+    return np.random.RandomState(seed)
+
+
+def draw_final_rounds(p, min_round, size, random_state=None):
+    """
+    Draws final rounds like experiments.utils.calculate_final_round: uniform dice are thrown until
+    one of them is <= p and the game finishes min_round + (number of failed trials) rounds, so the
+    number of extra rounds follows a geometric distribution starting at 0.
+    :param p: termination probability (0 < p <= 1)
+    :param min_round: minimum number of rounds
+    :param size: number of final rounds to draw
+    :param random_state: seed or numpy.random.RandomState
+    :return: numpy array with the final round of each game
+    """
+    if not 0 < p <= 1:
+        raise ValueError("The termination probability must be in (0, 1], got {}".format(p))
+    random_state = get_random_state(random_state)
+    return min_round + random_state.geometric(p, size=size) - 1
+
+
+class Strategy(object):
+    """
+    Parametric strategy of a member of the group. The strategy is applied to all simulated
+    groups at once.
+    """
+
+    def act(self, params, g_round, public_account, private_account, random_state):
+        """
+        :param params: CRDParameters
+        :param g_round: current round (starting from 1)
+        :param public_account: numpy array (n_groups,) - public account of each group before the round
+        :param private_account: numpy array (n_groups,) - private account of the member in each group
+        :param random_state: numpy.random.RandomState
+        :return: numpy array (n_groups,) - contribution of the member in each group
+        """
+        raise NotImplementedError
+
+
+class FixedStrategy(Strategy):
+    """Always contributes the same action"""
+
+    def __init__(self, action):
+        self.action = action
+
+    def act(self, params, g_round, public_account, private_account, random_state):
+        return np.full(public_account.shape, self.action, dtype=np.int64)
+
+    def __repr__(self):
+        return "FixedStrategy({})".format(self.action)
+
+
+class MixedStrategy(Strategy):
+    """Contributes each valid action with a fixed probability"""
+
+    def __init__(self, probabilities):
+        self.probabilities = np.asarray(probabilities, dtype=np.float64)
+
+    def act(self, params, g_round, public_account, private_account, random_state):
+        return random_state.choice(params.valid_actions, size=public_account.shape, p=self.probabilities)
+
+    def __repr__(self):
+        return "MixedStrategy({})".format(list(self.probabilities))
+
+
+class FairShareStrategy(Strategy):
+    """
+    Contributes the smallest valid action that is at least its fair share of the threshold,
+    threshold / (group_size * horizon), where horizon is the number of rounds the member
+    expects to play (by default the minimum number of rounds of the game).
+    """
+
+    def __init__(self, horizon=None):
+        self.horizon = horizon
+
+    def act(self, params, g_round, public_account, private_account, random_state):
+        horizon = self.horizon or (params.min_round if params.is_round_variable else params.rounds)
+        fair_share = params.threshold / float(params.group_size * max(horizon, 1))
+        idx = min(np.searchsorted(params.valid_actions, fair_share), len(params.valid_actions) - 1)
+        return np.full(public_account.shape, params.valid_actions[idx], dtype=np.int64)
+
+    def __repr__(self):
+        return "FairShareStrategy({})".format(self.horizon)
+
+
+class CompensatingStrategy(Strategy):
+    """
+    Contributes high when the group is behind the pace needed to reach the threshold
+    in horizon rounds, else contributes low.
+    """
+
+    def __init__(self, low, high, horizon=None):
+        self.low = low
+        self.high = high
+        self.horizon = horizon
+
+    def act(self, params, g_round, public_account, private_account, random_state):
+        horizon = self.horizon or (params.min_round if params.is_round_variable else params.rounds)
+        target = params.threshold * (g_round - 1) / float(max(horizon, 1))
+        return np.where(public_account < target, self.high, self.low).astype(np.int64)
+
+    def __repr__(self):
+        return "CompensatingStrategy({}, {}, {})".format(self.low, self.high, self.horizon)
+
+
+class SimulationResult(object):
+    """
+    Outcome of each simulated group.
+    - final_rounds: (n_groups,) number of rounds played
+    - public_account: (n_groups,) public account at the end of the game
+    - success: (n_groups,) True if the threshold was reached
+    - loss: (n_groups,) True if the group lost its private accounts
+    - payoffs: (n_groups, group_size) final private account (EMUs) of each member
+    """
+
+    def __init__(self, params, final_rounds, public_account, success, loss, payoffs):
+        self.params = params
+        self.final_rounds = final_rounds
+        self.public_account = public_account
+        self.success = success
+        self.loss = loss
+        self.payoffs = payoffs
+
+    @property
+    def n_groups(self):
+        return len(self.success)
+
+    def summary(self, percentiles=(5, 25, 50, 75, 95)):
+        """:returns dict - success and loss rates, and distribution of the payoffs (EMUs and euros)"""
+        payoffs = self.payoffs.ravel()
+        summary = {
+            'groups': self.n_groups,
+            'success_rate': float(self.success.mean()),
+            'loss_rate': float(self.loss.mean()),
+            'mean_rounds': float(self.final_rounds.mean()),
+            'mean_public_account': float(self.public_account.mean()),
+            'mean_payoff': float(payoffs.mean()),
+            'std_payoff': float(payoffs.std()),
+            'mean_payoff_euros': float(payoffs.mean() * self.params.conversion_rate + 2.5),
+        }
+        for q, value in zip(percentiles, np.percentile(payoffs, percentiles)):
+            summary['payoff_p{}'.format(q)] = float(value)
+        return summary
+
+
+def _simulate_batch(params, strategies, n_groups, random_state):
+    if params.is_round_variable:
+        final_rounds = draw_final_rounds(params.termination_probability, params.min_round, n_groups, random_state)
+    else:
+        final_rounds = np.full(n_groups, params.rounds, dtype=np.int64)
+    # The platform checks whether the game finished after each round, so at least one round is played.
+    # The groups are sorted by decreasing final round, so the groups still playing are always a prefix
+    final_rounds = np.sort(np.maximum(final_rounds, 1))[::-1]
+
+    private_account = np.full((n_groups, params.group_size), params.endowment, dtype=np.int64)
+    public_account = np.zeros(n_groups, dtype=np.int64)
+    for g_round in range(1, int(final_rounds[0]) + 1):
+        playing = n_groups - np.searchsorted(final_rounds[::-1], g_round)
+        for member, strategy in enumerate(strategies):
+            account = private_account[:playing, member]
+            action = strategy.act(params, g_round, public_account[:playing], account, random_state)
+            # members can't transfer more than what is left on their private account
+            account -= np.minimum(action, account)
+        public_account[:playing] = params.endowment * params.group_size - private_account[:playing].sum(axis=1)
+
+    success = public_account >= params.threshold
+    # check_threshold_view: the group loses everything if random_value < risk_prob
+    loss = ~success & (random_state.random_sample(n_groups) < params.risk_prob)
+    payoffs = np.where(loss[:, None], 0, private_account)
+    return final_rounds, public_account, success, loss, payoffs
+
+
+def simulate(params, strategies, n_groups, random_state=None, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Plays n_groups games of the treatment.
+    :param params: CRDParameters of the treatment
+    :param strategies: list of Strategy objects, one per member of the group
+    :param n_groups: number of groups to simulate
+    :param random_state: seed or numpy.random.RandomState
+    :param batch_size: maximum number of groups simulated at once
+    :return: SimulationResult
+    """
+    if n_groups < 1:
+        raise ValueError("At least one group must be simulated, {} given".format(n_groups))
+    if len(strategies) != params.group_size:
+        raise ValueError("{} strategies given for groups of size {}".format(len(strategies), params.group_size))
+    random_state = get_random_state(random_state)
+    batches = [_simulate_batch(params, strategies, min(batch_size, n_groups - start), random_state)
+               for start in range(0, n_groups, batch_size)]
+    return SimulationResult(params, *[np.concatenate(values) for values in zip(*batches)])
@@ -0,0 +1,180 @@
+# coding=utf-8
+# ==============================================================================
+# BEELPlatform
+# Copyright © 2016 Elias F. Domingos. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""
+This module runs parameter sweeps of the simulation engine (experiments.toolkit.simulation)
+on all the cores of the machine:
+1. A grid of treatments is expanded from a base CRDParameters and a dict {parameter: [values]}.
+2. Each treatment is simulated on a process pool with a seed derived from the base seed and the
+   treatment key, so the results don't depend on the number of workers or on the order of the tasks.
+3. The summary of each treatment is appended to a CSV file (one column per parameter and statistic)
+   as soon as it finishes. Treatments already present in the file are skipped, so an interrupted
+   sweep can be resumed by running it again with the same output file. Each row records the run
+   key of the sweep (base parameters, groups and seed), and a file written by a sweep with another
+   run key, or without a column for a parameter of the grid, is refused.
+CSV is used rather than a columnar format because the rows are appended one at a time, which is
+what makes the sweeps resumable; load the file with pandas.read_csv to analyse it.
+"""
+
+import csv
+import itertools
+import json
+import os
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from .simulation import (simulate, FixedStrategy, MixedStrategy, FairShareStrategy, CompensatingStrategy, )
+
+STRATEGIES = {
+    'fixed': lambda *args: FixedStrategy(int(args[0])),
+    'mixed': lambda *args: MixedStrategy([float(p) for p in args]),
+    'fair': lambda *args: FairShareStrategy(*[int(h) for h in args]),
+    'compensating': lambda *args: CompensatingStrategy(*[int(v) for v in args]),
+}
+
+
+def parse_strategies(spec):
+    """
+    Parses the composition of a group, e.g. "fair*3;mixed:0.2,0.3,0.5*2;fixed:0"
+    :param spec: members separated by ";", as name[:arg,arg...][*count]
+    :return: list of Strategy objects, one per member
+    """
+    strategies = []
+    for member in spec.split(';'):
+        member, _, count = member.strip().partition('*')
+        name, _, args = member.partition(':')
+        try:
+            factory = STRATEGIES[name.strip()]
+        except KeyError:
+            raise ValueError("Unknown strategy {}, choose from {}".format(name, sorted(STRATEGIES)))
+        strategy = factory(*[arg for arg in args.split(',') if arg])
+        strategies += [strategy] * int(count or 1)
+    return strategies
+
+
+def task_key(values):
+    """:returns str - stable identifier of a treatment of the grid"""
+    return json.dumps(values, sort_keys=True)
+
+
+def run_key(base_params, n_groups, seed):
+    """:returns str - identifier of the values shared by all the treatments of a sweep"""
+    values = dict(base_params.__dict__, valid_actions=[int(action) for action in base_params.valid_actions],
+                  n_groups=n_groups, seed=seed)
+    return '{:08x}'.format(zlib.crc32(json.dumps(values, sort_keys=True, default=str).encode('utf-8')))
+
+
+def task_seed(seed, key):
+    """:returns list - seed of the task, independent of the order in which the tasks run"""
+    return [seed, zlib.crc32(key.encode('utf-8'))]
+
+
+def expand_grid(grid):
+    """
+    :param grid: dict {parameter name: list of values}
+    :return: list of dicts with every combination of the values
+    """
+    names = sorted(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+
+
+def run_task(base_params, values, n_groups, seed):
+    """
+    Simulates a treatment of the grid (runs on the worker processes)
+    :param base_params: CRDParameters with the values that are not in the grid
+    :param values: dict - values of the grid, including the composition of the group ("strategies")
+    :return: dict - values of the grid and summary of the simulation
+    """
+    values = dict(values)
+    spec = values.pop('strategies')
+    params = base_params.copy(**values)
+    result = simulate(params, parse_strategies(spec), n_groups, random_state=np.random.RandomState(seed))
+    row = dict(values, strategies=spec)
+    row.update(result.summary())
+    return row
+
+
+def read_done(output):
+    """:returns (set, list, set) - keys of the treatments already stored in the output file, its columns and
+             the run keys of its rows"""
+    if not os.path.exists(output) or os.path.getsize(output) == 0:
+        return set(), None, set()
+    with open(output, newline='') as csv_file:
+        reader = csv.DictReader(csv_file)
+        rows = [(row['task'], row.get('run')) for row in reader]
+        return {task for task, _ in rows}, reader.fieldnames, {run for _, run in rows}
+
+
+def run_sweep(base_params, grid, strategies, n_groups, output, seed=0, workers=None, callback=None):
+    """
+    Runs the sweep on a process pool and appends each finished treatment to the output CSV file.
+    :param base_params: CRDParameters with the values that are not in the grid
+    :param grid: dict {parameter name: list of values}; "strategies" can be one of the parameters
+    :param strategies: composition of the group (see parse_strategies) when not in the grid
+    :param n_groups: groups simulated per treatment
+    :param output: path of the CSV file
+    :param seed: base seed of the sweep
+    :param workers: number of processes (defaults to the number of cores)
+    :param callback: called with each finished row
+    :return: (number of treatments run, number of treatments skipped)
+    :raises ValueError: if a composition is not valid for its group size, or the output file was written
+                        by another sweep
+    """
+    tasks = [(task_key(values), values) for values in
+             [dict({'strategies': strategies}, **values) for values in expand_grid(grid)]]
+    # fail before starting the pool if a composition is not valid, or not of the size of its groups
+    for key, values in tasks:
+        size = len(parse_strategies(values['strategies']))
+        group_size = values.get('group_size', base_params.group_size)
+        if size != group_size:
+            raise ValueError("The composition {} has {} members, the groups of {} have {}".format(
+                values['strategies'], size, key, group_size))
+
+    run = run_key(base_params, n_groups, seed)
+    done, fieldnames, runs = read_done(output)
+    if runs - {run}:
+        raise ValueError("{} holds the results of a sweep with other base parameters, groups or seed, "
+                         "use another output file".format(output))
+    missing = set(grid) - set(fieldnames or grid)
+    if missing:
+        raise ValueError("{} has no column for the parameters {}, use another output file".format(
+            output, ', '.join(sorted(missing))))
+    pending = [(key, values) for key, values in tasks if key not in done]
+    if not pending:
+        return 0, len(tasks)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(run_task, base_params, values, n_groups, task_seed(seed, key)): key
+                   for key, values in pending}
+        writer = None
+        with open(output, 'a', newline='') as csv_file:
+            for future in as_completed(futures):
+                row = dict(future.result(), task=futures[future], seed=seed, run=run)
+                if writer is None:
+                    writer = csv.DictWriter(csv_file, fieldnames=fieldnames or sorted(row))
+                    if not fieldnames:
+                        writer.writeheader()
+                writer.writerow(row)
+                # flush every row, so an interrupted sweep keeps the finished treatments
+                csv_file.flush()
+                if callback is not None:
+                    callback(row)
+
+    return len(pending), len(tasks) - len(pending)
@@ -47,5 +47,7 @@ urlpatterns = [
     url(r'^monitor/$', views_admin.ExperimentsAdminView.as_view(), name='admin'),
     url(r'^monitor/(?P<session_id>[0-9]+)/$', views_admin.SessionGameView.as_view(), name='monitor'),
     url(r'^monitor/(?P<session_id>[0-9]+)/graph/$', views_admin.GraphView.as_view(), name='monitor_graph'),
+    url(r'^monitor/(?P<session_id>[0-9]+)/ajax/$', views_admin.fetch_monitor_data, name='fetch_monitor_data'),
     url(r'^monitor/ajax/$', views_admin.fetch_session_data, name='fetch_data'),
+    url(r'^monitor/metrics/$', views_admin.fetch_metrics, name='metrics'),
 ]
@@ -1,14 +1,32 @@
-import csv
 import json
-
+# import the logging library
+import logging
+import os
+import time
+from multiprocessing import Pool
+
+import django
+from django.conf import settings
+from django.contrib import messages
+from django.contrib.auth.hashers import make_password
 from django.core.exceptions import PermissionDenied
 from django.db import transaction
-from django.http import HttpResponse
+from django.utils import timezone
+import numpy as np
 
+from . import config, exports, routers
 from .constants import Constants
+from .monitors import get_monitor_backend
+from .toolkit.simulation import get_random_state, draw_final_rounds
 from .models import (RunNow, Player, GameData, Experiment, Session, RequestMonitor,
                      Profile, Game, Treatment, CollectiveRiskGame, Group)
 
+# Get an instance of a logger
+logger = logging.getLogger(__name__)
+
+# Below this number of passwords, the hashes are computed without starting the process pool
+MIN_PARALLEL_HASHES = 16
+
 
 class RunLoader(object):
     """
@@ -131,9 +149,25 @@ def delete_monitor(group, name):
     RequestMonitor.objects.all().filter(group=group, name=name).delete()
 
 
-def init_experiment():
+def get_run(session_id=None):
+    """
+    :param session_id: id of the session (the first run by default)
+    :return: RunNow - run state of the session
+    """
+    if session_id is None:
+        return RunNow.objects.order_by('pk')[:1].get()
+    return RunNow.objects.get(session_id=session_id)
+
+
+@routers.on_archive
+def init_experiment(session_id=None):
+    """
+    Resets the players, groups and monitors of the session (on the archive database, from which the session is
+    copied to the database on which it is played, see experiments.routers) and turns it on
+    :param session_id: id of the session (the first run by default)
+    """
     # get experiment from run now
-    run_now = RunNow.objects.all()[:1].get()
+    run_now = get_run(session_id)
 
     # now retrieve experiment, treatment and session
     experiment = Experiment.objects.get(pk=run_now.experiment_id)
@@ -165,29 +199,35 @@ def init_experiment():
     assign_groups2players(experiment_id=experiment.id, session_id=session.id)
 
     # initialize monitors
-    RequestMonitor.objects.filter(group__session=session).update(var=0, condition=False)
-    monitors = RequestMonitor.objects.filter(group__session=session)
-    for monitor in monitors:
-        monitor.queue.clear()
-
-        # initialize groups
-        Group.objects.filter(session=session).update(finishing_round=0,
-                                                     game_finished=False,
-                                                     public_account=0,
-                                                     current_round=0,
-                                                     random_value=0,
-                                                     random_value_generated=False,
-                                                     dice_results="0.0",
-                                                     finishing_round_selected=False)
+    get_monitor_backend().reset(session)
+
+    # initialize groups
+    Group.objects.filter(session=session).update(finishing_round=0,
+                                                 game_finished=False,
+                                                 public_account=0,
+                                                 current_round=0,
+                                                 round_contributions="",
+                                                 members_acted=0,
+                                                 random_value=0,
+                                                 random_value_generated=False,
+                                                 dice_results="0.0",
+                                                 finishing_round_selected=False)
+
+    # select the final round of each group before the participants start playing
+    sample_session_final_rounds(session, game)
+
+    # copy the session to the database on which it is played
+    routers.place_session(session)
 
     # Finally activate session through runnow
     run_now.experiment_on = True
     run_now.save()
 
 
-def init_experiment_without_setting_group():
+@routers.on_archive
+def init_experiment_without_setting_group(session_id=None):
     # get experiment from run now
-    run_now = RunNow.objects.all()[:1].get()
+    run_now = get_run(session_id)
 
     # now retrieve experiment, treatment and session
     experiment = Experiment.objects.get(pk=run_now.experiment_id)
@@ -205,46 +245,53 @@ def init_experiment_without_setting_group():
         participated=False, experiment_state=Constants.STATE_INACTIVE, transition_state=Constants.STATE_NO_TRANSITION)
 
     # initialize monitors
-    RequestMonitor.objects.filter(group__session=session).update(var=0, condition=False)
-    monitors = RequestMonitor.objects.filter(group__session=session)
-    for monitor in monitors:
-        monitor.queue.clear()
+    get_monitor_backend().reset(session)
 
     # initialize groups
     Group.objects.filter(session=session).update(finishing_round=0,
                                                  game_finished=False,
                                                  public_account=0,
                                                  current_round=0,
+                                                 round_contributions="",
+                                                 members_acted=0,
                                                  random_value=0,
                                                  random_value_generated=False,
                                                  dice_results="0.0",
                                                  finishing_round_selected=False)
 
+    # select the final round of each group before the participants start playing
+    sample_session_final_rounds(session, game)
+
+    # copy the session to the database on which it is played
+    routers.place_session(session)
+
     # Finally activate session through runnow
     run_now.experiment_on = True
     run_now.save()
 
 
+@routers.on_archive
 def init_session(session=None):
     if session is not None:
-        pass
+        session_id = getattr(session, 'pk', session)
     else:
-        run_now = RunNow.objects.all()[:1].get()
-        session_id = run_now.session_id
+        session_id = get_run().session_id
 
     # now retrieve experiment, treatment and session
     Session.objects.filter(pk=session_id).update(finished=False, structure_assigned=False)
+    config.invalidate()
     session = Session.objects.get(pk=session_id)
     Group.objects.filter(session=session).update(finishing_round=0, game_finished=False, public_account=0,
-                                                 current_round=0, random_value=0, random_value_generated=False)
+                                                 current_round=0, round_contributions="", members_acted=0,
+                                                 random_value=0, random_value_generated=False)
 
 
+@routers.on_archive
 def erase_game_data_session(session=None):
     if session is not None:
-        pass
+        session_id = getattr(session, 'pk', session)
     else:
-        run_now = RunNow.objects.all()[:1].get()
-        session_id = run_now.session_id
+        session_id = get_run().session_id
 
     # If session finished, don't ever modify it!
     if Session.objects.get(pk=session_id).finished:
@@ -256,11 +303,18 @@ def erase_game_data_session(session=None):
 
 @transaction.atomic
 def assign_groups2players(experiment_id, session_id, game_type=Constants.COLLECTIVE_RISK):
-    """Randomly assign groups of group_size to players"""
+    """
+    Randomly assign groups of group_size to players.
+    Groups and the assignment of players are written with bulk queries, so the number of statements
+    does not depend on the number of players. Groups that already exist are reused. The monitors of
+    each group are created on demand the first time they are used (see experiments.monitors).
+    :return: (nb_groups, nb_players), None if the structure was already assigned or False if the session finished
+    """
+    time_start = time.perf_counter()
 
     # First check how many players are assigned to the session
     experiment = Experiment.objects.get(id=experiment_id)
-    session = Session.objects.get(id=session_id)
+    session = Session.objects.select_related('treatment').get(id=session_id)
 
     # If session finished, don't ever modify it!
     if session.finished:
@@ -269,44 +323,47 @@ def assign_groups2players(experiment_id, session_id, game_type=Constants.COLLECT
     if session.structure_assigned:
         return None
 
-    players = Player.objects.filter(experiment=experiment, session=session, user__is_active=True).order_by('?')
+    players = list(Player.objects.filter(experiment=experiment, session=session,
+                                         user__is_active=True).order_by('?').only('pk', 'group'))
 
     # Now get the game
     if game_type is Constants.COLLECTIVE_RISK:
-        game = CollectiveRiskGame.objects.get(id=session.treatment.game.id)
+        game = CollectiveRiskGame.objects.get(id=session.treatment.game_id)
     else:
-        game = Game.objects.get(id=session.treatment.game.id)
-
-    num_rounds = game.rounds
-    if game.is_round_variable:
-        num_rounds = game.min_round + 30
+        game = Game.objects.get(id=session.treatment.game_id)
 
-    nb_players = players.count()
+    nb_players = len(players)
     group_size = session.group_size if session.group_size > 0 else game.group_size
     # Perhaps request permission of the admin in case the numbers are not divisible
     nb_groups = nb_players // group_size
-    print(nb_groups, group_size, nb_players)
+    if nb_players % group_size:
+        logger.warning("[WARNING] {} players can't be assigned to a group of size {}".format(
+            nb_players % group_size, group_size))
 
     # Create groups
-    groups = []
-    for i in range(nb_groups):
-        group = Group.objects.get_or_create(group_number=i, session=session)[0]
-        groups.append(group)
-        # Create monitors
-        for r in range(num_rounds + 1):
-            RequestMonitor.objects.get_or_create(name="monitorS2r{}".format(r), group=group)
-            RequestMonitor.objects.get_or_create(name="monitorS3r{}".format(r), group=group)
-        RequestMonitor.objects.get_or_create(name="monitorS4", group=group)
-
-    # Now randomly assign players to groups
+    existing_groups = set(Group.objects.filter(session=session,
+                                               group_number__lt=nb_groups).values_list('group_number', flat=True))
+    Group.objects.bulk_create([Group(group_number=i, session=session)
+                               for i in range(nb_groups) if i not in existing_groups])
+    groups = {group.group_number: group for group in Group.objects.filter(session=session,
+                                                                          group_number__lt=nb_groups)}
+    groups = [groups[i] for i in range(nb_groups)]
+
+    # Now randomly assign players to groups. The players left out are removed from the group
+    # they might have been assigned to before, so no group ends up with more than group_size members
+    profiles = []
     for i, player in enumerate(players):
-        group = groups[i // group_size]
-        player.profile.group_number = group.group_number
+        group = groups[i // group_size] if i < nb_groups * group_size else None
         player.group = group
-        player.save()
+        profiles.append(Profile(player_id=player.pk, group_number=group.group_number if group else None))
+    Player.objects.bulk_update(players, ['group'], batch_size=1000)
+    Profile.objects.bulk_update(profiles, ['group_number'], batch_size=1000)
+
+    Session.objects.filter(pk=session.pk).update(structure_assigned=True)
+    config.invalidate()
 
-    session.structure_assigned = True
-    session.save()
+    logger.info("Session {}: assigned {} players to {} groups of size {} in {:.3f}s".format(
+        session.pk, nb_players, nb_groups, group_size, time.perf_counter() - time_start))
 
     return nb_groups, nb_players
 
@@ -354,43 +411,111 @@ def setup_experiment():
 
 
 def set_run_now(experiment, session, treatment, experiment_on=True):
-    RunNow.objects.get_or_create(experiment_id=experiment,
-                                 session_id=session,
-                                 treatment_id=treatment,
-                                 experiment_on=experiment_on)
+    """Creates or updates the run of the session (ids), the other runs are not modified"""
+    RunNow.objects.update_or_create(session_id=session,
+                                    defaults={'experiment_id': experiment,
+                                              'treatment_id': treatment,
+                                              'experiment_on': experiment_on})
 
 
-def correct_group_monitors_if_player_fails(player_id):
-    player = Player.objects.get(pk=player_id)
-    # check which state of the game are they stuck in
-    try:
-        monitor = player.monitors.all()[0]
-    except IndexError:
-        raise IndexError("[ERROR] Player is not in a queue!")
-    else:
-        if player.monitors.all().count() > 1:
-            raise Exception("[WARNING] Player is in more than one queue!")
+def correct_group_monitors_if_player_fails(player_id, repair=True):
+    """
+    Checks the barriers of the group of the player and repairs the queues that stall it
+    (see experiments.watchdog).
+    :param player_id: id of the player
+    :param repair: if False the issues are only reported
+    :return: list - issues found on the group (dicts)
+    """
+    from .watchdog import Watchdog
+
+    player = Player.objects.select_related('session').get(pk=player_id)
+    if player.group_id is None:
+        raise IndexError("[ERROR] Player {} is not in a group!".format(player))
+    return Watchdog(stuck_after=0, repair=repair).scan(player.session, group_ids={player.group_id})['issues']
+
+
+class PasswordHasherPool(object):
+    """
+    Hashes passwords with the configured hasher (make_password) in a pool of processes, PBKDF2 is
+    CPU bound so the hashes of a batch are computed in parallel. Small batches are hashed in the
+    calling process. Use it as a context manager to terminate the pool.
+    """
+
+    def __init__(self, processes=None):
+        """
+        :param processes: number of processes (defaults to EXPERIMENTS_ENROLMENT_PROCESSES, or the number of CPUs)
+        """
+        self.processes = processes or getattr(settings, 'EXPERIMENTS_ENROLMENT_PROCESSES', None) or os.cpu_count()
+        self._pool = None
+
+    def hash(self, passwords):
+        """:returns list - encoded passwords, in the same order"""
+        if self.processes <= 1 or len(passwords) < MIN_PARALLEL_HASHES:
+            return [make_password(password) for password in passwords]
+        if self._pool is None:
+            # the workers must be able to read the settings even if they are not forked
+            self._pool = Pool(processes=self.processes, initializer=django.setup)
+        return self._pool.map(make_password, passwords,
+                              chunksize=max(1, len(passwords) // (self.processes * 4)))
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self
 
-            # Check the conditions of the monitor
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
 
-def add_users(users, experiment, session, treatment):
+def add_users(users, experiment, session, treatment, hasher=None, batch_size=500):
+    """
+    Creates the users of the dict ({key: {"username": ..., "password": ...}}) and adds them to the session.
+    The passwords are hashed in parallel (see PasswordHasherPool) and the User, Player and Profile rows are
+    inserted with bulk queries, in a single transaction. The post_save receivers of User and Player are not
+    called, the rows they would create are inserted here.
+    :param hasher: PasswordHasherPool (a new one is used by default)
+    :param batch_size: rows inserted per query
+    :return: int - number of users created, False if the session finished
+    """
     from django.contrib.auth.models import User
 
     # If session finished, don't ever modify it!
     if session.finished:
         return False
 
-    game = CollectiveRiskGame.objects.get(id=treatment.game.id)
+    time_start = time.perf_counter()
+    game = CollectiveRiskGame.objects.get(id=treatment.game_id)
+    users = list(users.values())
+    usernames = [user['username'] for user in users]
 
-    for key, user in users.items():
-        user = User.objects.create_user(username=user['username'], password=user['password'])
-        user.player.experiment = experiment
-        user.player.session = session
-        user.player.profile.private_account = game.endowment
-        user.is_active = True
-        user.save()
-        user.player.save()
+    if hasher is None:
+        with PasswordHasherPool() as hasher:
+            passwords = hasher.hash([user['password'] for user in users])
+    else:
+        passwords = hasher.hash([user['password'] for user in users])
+
+    now = timezone.now()
+    with transaction.atomic():
+        User.objects.bulk_create([User(username=username, password=password, is_active=True, date_joined=now)
+                                  for username, password in zip(usernames, passwords)], batch_size=batch_size)
+        # the ids of the new rows are not returned by every database
+        user_ids = []
+        for start in range(0, len(usernames), batch_size):
+            user_ids.extend(User.objects.filter(username__in=usernames[start:start + batch_size]).values_list(
+                'pk', flat=True))
+        Player.objects.bulk_create([Player(user_id=user_id, experiment=experiment, session=session)
+                                    for user_id in user_ids], batch_size=batch_size)
+        Profile.objects.bulk_create([Profile(player_id=user_id, created=now, experiment_state=Constants.STATE_LOGIN,
+                                             private_account=game.endowment)
+                                     for user_id in user_ids], batch_size=batch_size)
+
+    logger.info("Session {}: added {} users in {:.3f}s".format(session.pk, len(user_ids),
+                                                                 time.perf_counter() - time_start))
+    return len(user_ids)
 
 
 def make_player_inactive(username):
@@ -418,10 +543,33 @@ def change_player_group(username, group):
     Player.objects.filter(user=user).update(group=group)
 
 
+def check_live_sessions(modeladmin, request, queryset):
+    """
+    Refuses the export of the rows of the sessions that are still played on their own database, and warns
+    about the rows of the other sessions played on their own database, which are not in the export
+    :return: bool - True if the rows can be exported
+    """
+    if queryset.model._meta.model_name not in exports.SESSION_LOOKUPS:
+        return True
+    live = exports.get_live_sessions(queryset)
+    if live:
+        modeladmin.message_user(request, "Sessions {} are still played on their own database: consolidate them "
+                                         "(manage.py consolidate_sessions) before exporting their rows".format(
+                                             ', '.join(str(pk) for pk in live)), level=messages.ERROR)
+        return False
+    live = exports.get_live_sessions()
+    if live:
+        modeladmin.message_user(request, "The rows of sessions {}, still played on their own database, are not "
+                                         "exported".format(', '.join(str(pk) for pk in live)),
+                                level=messages.WARNING)
+    return True
+
+
 def export_as_csv(description="Download selected rows as CSV file", header=True):
     """
     This function returns an export csv action
-    This function ONLY downloads the columns shown in the list_display of the admin
+    The rows are streamed: foreign keys are exported as ids, plus the related columns of
+    exports.EXPORT_RELATED, all read with a single query
     'header' is whether or not to output the column names as the first row
     """
 
@@ -432,25 +580,46 @@ def export_as_csv(description="Download selected rows as CSV file", header=True)
         """
         if not request.user.is_staff:
             raise PermissionDenied
-        opts = queryset.model._meta
-
-        response = HttpResponse(content_type='text/csv')
-        response['Content-Disposition'] = 'attachment; filename=%s.csv' % str(opts).replace('.', '_')
-
-        writer = csv.writer(response)
-        field_names = [field.name for field in opts.fields]
-        # Write a first row with header information
-        if header:
-            writer.writerow(field_names)
-        # Write data rows
-        for obj in queryset:
-            writer.writerow([getattr(obj, field, None) for field in field_names])
-        return response
+        if not check_live_sessions(modeladmin, request, queryset):
+            return None
+        return exports.stream_csv(queryset, str(queryset.model._meta).replace('.', '_'), header=header)
 
     export_as_csv.short_description = description
     return export_as_csv
 
 
+def export_as_parquet(description="Download selected rows as Parquet file"):
+    """
+    This function returns an export parquet action (requires pyarrow)
+    """
+
+    def export_as_parquet(modeladmin, request, queryset):
+        if not request.user.is_staff:
+            raise PermissionDenied
+        if not check_live_sessions(modeladmin, request, queryset):
+            return None
+        return exports.parquet_response(queryset, str(queryset.model._meta).replace('.', '_'))
+
+    export_as_parquet.short_description = description
+    return export_as_parquet
+
+
+def export_as_arrow(description="Download selected rows as Arrow stream"):
+    """
+    This function returns an export arrow action (requires pyarrow)
+    """
+
+    def export_as_arrow(modeladmin, request, queryset):
+        if not request.user.is_staff:
+            raise PermissionDenied
+        if not check_live_sessions(modeladmin, request, queryset):
+            return None
+        return exports.stream_arrow(queryset, str(queryset.model._meta).replace('.', '_'))
+
+    export_as_arrow.short_description = description
+    return export_as_arrow
+
+
 def gen_participant_json(passwords, expression, randomize=True):
     """
     Function to create new users and store them in a json file
@@ -477,15 +646,19 @@ def user_dict2txt(user_dict, file):
         file.write("\n")
 
 
-def add_users2session(password_path: str, save_path: str, session: Session, expression: str, randomize: bool = True):
+def add_users2session(password_path: str, save_path: str, session: Session, expression: str, randomize: bool = True,
+                      processes: int = None, batch_size: int = 500):
     """
     Adds users to the :session with the passwords from :password_path (as many users as passwords).
-    Stores the users information in a .txt and .json files on :save_path.
+    Stores the users information in a .txt and .json files on :save_path, which are written as the
+    users are added, :batch_size users at a time (see add_users).
     :param password_path: path to a .txt file containing the passwords to be used (one per line)
     :param save_path: path where the users info should be saved
     :param session: session where the users are added to
     :param expression: common pattern for the users names
     :param randomize: indicates if the password assignment should be randomized
+    :param processes: number of processes that hash the passwords (see PasswordHasherPool)
+    :param batch_size: number of users added at a time
     :return: None or Exception
     """
 
@@ -511,35 +684,93 @@ def add_users2session(password_path: str, save_path: str, session: Session, expr
         session_name=session.session_number,
         session_date=session.scheduled_date.strftime(
             "%d%m%y"))
-    # generate txt file
     try:
-        with open("{}.txt".format(save_file), "w") as txt_file:
-            user_dict2txt(users, txt_file)
+        txt_file = open("{}.txt".format(save_file), "w")
     except TypeError as te:
         return te
     except Exception as e:
         return e
-
-    # generate json file
-
     try:
-        with open("{}.json".format(save_file), "w") as json_file:
-            json.dump(users, json_file)
-    except TypeError as te:
-        return te
+        json_file = open("{}.json".format(save_file), "w")
     except Exception as e:
+        txt_file.close()
         return e
 
-    # add users to session
+    # the files are written and the users are added batch by batch, the hashes of a batch are computed
+    # in parallel. The users are added in a single transaction.
     experiment = session.experiment
     treatment = session.treatment
-    add_users(users, experiment, session, treatment)
+    keys = list(users)
+    with txt_file, json_file, PasswordHasherPool(processes) as hasher, transaction.atomic():
+        json_file.write("{")
+        for start in range(0, len(keys), batch_size):
+            batch = {key: users[key] for key in keys[start:start + batch_size]}
+            for key, user in batch.items():
+                txt_file.write("username: {}\npassword: {}\n\n".format(user["username"], user["password"]))
+                # same output as json.dump(users, json_file)
+                json_file.write("{}{}: {}".format(", " if key != keys[0] else "", json.dumps(key), json.dumps(user)))
+            add_users(batch, experiment, session, treatment, hasher=hasher)
+        json_file.write("}")
+
+
+def sample_final_rounds(nb_groups, p, min_round, dice_faces=6, random_state=None):
+    """
+    Draws the final round and the dice trials of nb_groups groups in one vectorised call.
+    A dice is thrown each round from min_round on, and the game finishes at the first trial that
+    succeeds (uniform value <= p), so the number of extra rounds follows a geometric distribution.
+    The values of the failed trials are uniform on (p, 1] and the one of the success on (0, p].
+    :param nb_groups: number of groups
+    :param p: termination probability (0 < p <= 1)
+    :param min_round: minimum number of rounds
+    :param dice_faces: number of faces of the dice shown to the participants
+    :param random_state: seed or numpy.random.RandomState, the same seed always gives the same results
+    :return: (numpy array with the final round of each group, list with the dice trials of each group)
+    """
+    random_state = get_random_state(random_state)
+    final_rounds = draw_final_rounds(p, min_round, nb_groups, random_state)
+    nb_trials = final_rounds - min_round + 1
+    ends = np.cumsum(nb_trials)
+    values = p + (1 - p) * (1 - random_state.random_sample(ends[-1] if nb_groups else 0))
+    values[ends - 1] = p * (1 - random_state.random_sample(nb_groups))
+    dice = np.array(np.ceil(values * dice_faces), dtype=np.int32)
+    return final_rounds, np.split(dice, ends[:-1])
 
 
 def calculate_final_round(p, min_round, dice_faces=6):
-    import numpy as np
-    dice_results = np.random.rand(100)
-    check_condition = dice_results <= p
-    rounds_add = np.where(check_condition == 1)[0][0]
-    final_round = min_round + rounds_add
-    return final_round, np.array(np.ceil(dice_results[:rounds_add + 1] * dice_faces), dtype=np.int32)
+    """
+    :returns (int, numpy array) - final round of a group and the dice trials shown to its members
+    """
+    final_rounds, trials = sample_final_rounds(1, p, min_round, dice_faces)
+    return int(final_rounds[0]), trials[0]
+
+
+def sample_session_final_rounds(session, game):
+    """
+    Selects the final round of every group of the session when the deadline is variable, so that
+    the rounds are never sampled while the participants play. The draws are seeded with
+    session.random_seed (generated the first time), so they can be audited and initializing the
+    session again replays the same final rounds. Clear the seed to draw new ones.
+    :param session: Session object
+    :param game: CollectiveRiskGame of the session
+    :return: seed used, or None if the deadline is fixed
+    """
+    if not game.is_round_variable:
+        return None
+
+    seed = Session.objects.filter(pk=session.pk).values_list('random_seed', flat=True).get()
+    if seed is None:
+        seed = int(np.random.randint(2 ** 31 - 1))
+        Session.objects.filter(pk=session.pk).update(random_seed=seed)
+        config.invalidate()
+
+    groups = list(Group.objects.filter(session=session).order_by('group_number').only('pk', 'group_number'))
+    final_rounds, trials = sample_final_rounds(len(groups), p=game.termination_probability, min_round=game.min_round,
+                                               dice_faces=game.dice_faces, random_state=seed)
+    for group, final_round, dice in zip(groups, final_rounds, trials):
+        group.finishing_round = int(final_round)
+        group.dice_results = ','.join(map(str, dice))
+        group.finishing_round_selected = True
+    Group.objects.bulk_update(groups, ['finishing_round', 'dice_results', 'finishing_round_selected'],
+                              batch_size=1000)
+    logger.info("Session {}: final rounds of {} groups sampled with seed {}".format(session.pk, len(groups), seed))
+    return seed
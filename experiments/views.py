@@ -18,18 +18,19 @@
 import json
 # import the logging library
 import logging
+import time
 
+from django.conf import settings
 from django.contrib.auth import (login as auth_login, )
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.contrib.auth.models import User
 from django.contrib.auth.views import (LoginView, )
 # from django.template import Context, Template
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
-from django.db import (transaction, DatabaseError, )
-from django.db.models import (Sum, IntegerField, Count, F, )
+from django.db import (DatabaseError, IntegrityError, )
+from django.db.models import F
 from django.http import (HttpResponse, HttpResponseRedirect, )
-from django.shortcuts import (get_object_or_404, render, )
+from django.shortcuts import (render, )
 from django.urls import reverse
 from django.urls import reverse_lazy
 from django.utils import timezone
@@ -39,12 +40,17 @@ from django.views import generic
 from numpy import random, floor
 
 from .constants import Constants
-from .decorators import (check_game_finished, check_experiment_state)
+from . import fsm
+from .decorators import (check_game_finished, check_experiment_state, check_transition, get_player, get_game, )
 from .forms import UserInfoForm
+from .middleware import record_retry
+from .monitors import get_monitor_key
 import comp.comprehension as comp
 from .models import (
-    CollectiveRiskGame, Profile, Survey, Player, GameData, RequestMonitor, Instruction, Group,
+    Profile, Survey, GameData, RequestMonitor, Instruction, Group,
 )
+from .notifiers import (get_notifier, group_channel, release_connections, )
+from . import routers
 from .utils import calculate_final_round
 
 # Get an instance of a logger
@@ -62,7 +68,7 @@ class ExperimentsLogin(LoginView):
         redirect_to = None
 
         if self.user is not None:
-            redirect_to = check_user_state(self.user)
+            redirect_to = check_user_state(self.request)
 
         if redirect_to is None:
             redirect_to = self.request.POST.get(
@@ -83,40 +89,19 @@ class ExperimentsLogin(LoginView):
         return HttpResponseRedirect(self.get_success_url())
 
 
-def check_user_state(user):
+def check_user_state(request):
     """
-    Checks if the user's state and returns a redirect url
-    :param user: user object
-    :return: redirect_to_state url
+    Checks the state of the user that just logged in and returns a redirect url
+    :param request: HttpRequest of the login
+    :return: redirect_to_state url (None if the user hasn't started the experiment yet)
     """
-    redirect_to = None
+    # the session of the participant was only known once it authenticated
+    with routers.session_database(request.session.get(routers.SESSION_KEY)):
+        player = get_player(request)
     # If player was already doing the experiment, redirect to previous state
-    if user.player.profile.participated:
-        # Check if player in a transition:
-        if user.player.profile.transition_state == Constants.STATE_TRANSITION_S2:
-            # transition to state S2 is finish_results_view
-            redirect_to = reverse_lazy('experiments:results_round', kwargs={'session_id': user.player.session.id})
-        elif user.player.profile.transition_state == Constants.STATE_TRANSITION_S3:
-            # transition to state S3 is finish_round_view
-            redirect_to = reverse_lazy('experiments:game_round', kwargs={'session_id': user.player.session.id})
-        elif user.player.profile.transition_state == Constants.STATE_TRANSITION_S4:
-            # transition to state S4 is transition_risk
-            redirect_to = reverse_lazy('experiments:results_risk_wait', kwargs={'session_id': user.player.session.id})
-
-        if user.player.profile.experiment_state == Constants.STATE_TEST:
-            redirect_to = reverse_lazy('experiments:test', kwargs={'session_id': user.player.session.id})
-        elif user.player.profile.experiment_state == Constants.STATE_GAME_S2:
-            redirect_to = reverse_lazy('experiments:game', kwargs={'session_id': user.player.session.id})
-        elif user.player.profile.experiment_state == Constants.STATE_GAME_S3:
-            redirect_to = reverse_lazy('experiments:results', kwargs={'session_id': user.player.session.id})
-        elif user.player.profile.experiment_state == Constants.STATE_GAME_S4:
-            redirect_to = reverse_lazy('experiments:results_risk', kwargs={'session_id': user.player.session.id})
-        elif user.player.profile.experiment_state == Constants.STATE_QUIZ:
-            redirect_to = reverse_lazy('experiments:userinfo', kwargs={'session_id': user.player.session.id})
-        elif user.player.profile.experiment_state == Constants.STATE_FINISH:
-            redirect_to = reverse_lazy('experiments:logout')
-
-    return redirect_to
+    if not player.profile.participated:
+        return None
+    return fsm.get_redirect_url(player.profile, player.session_id)
 
 
 class InstructionsView(LoginRequiredMixin, generic.ListView):
@@ -125,11 +110,11 @@ class InstructionsView(LoginRequiredMixin, generic.ListView):
     login_url = reverse_lazy('experiments:login')
 
     def get_queryset(self):
-        user = get_object_or_404(User, pk=self.request.user.id)
-        if user.player.profile.experiment_state == Constants.STATE_LOGIN and not user.player.profile.participated:
+        player = get_player(self.request)
+        if player.profile.experiment_state == Constants.STATE_LOGIN and not player.profile.participated:
             # Update personal endowment only the first time the player has played the game
-            game = CollectiveRiskGame.objects.get(id=user.player.session.treatment.game.id)
-            Profile.objects.filter(player=user.player).update(experiment_state=Constants.STATE_INSTRUCTIONS,
+            game = get_game(player)
+            Profile.objects.filter(player=player).update(experiment_state=Constants.STATE_INSTRUCTIONS,
                                                               transition_state=Constants.STATE_NO_TRANSITION,
                                                               private_account=game.endowment,
                                                               participated=True,
@@ -137,23 +122,25 @@ class InstructionsView(LoginRequiredMixin, generic.ListView):
             self.request.session['experiment_state'] = Constants.STATE_INSTRUCTIONS
 
             # If deadline is variable, then calculate last round
+            # The final rounds are selected by init_experiment, this only covers groups created afterwards
             if game.is_round_variable:
-                if not user.player.group.finishing_round_selected:
+                if not player.group.finishing_round_selected:
                     final_round, trials = calculate_final_round(p=game.termination_probability,
                                                                 min_round=game.min_round,
                                                                 dice_faces=game.dice_faces
                                                                 )
-                    Group.objects.filter(id=user.player.group.id).update(finishing_round=final_round,
-                                                                         dice_results=','.join(map(str, trials)),
-                                                                         finishing_round_selected=True)
+                    # only the first member of the group to arrive selects the final round
+                    Group.objects.filter(id=player.group.id, finishing_round_selected=False).update(
+                        finishing_round=final_round, dice_results=','.join(map(str, trials)),
+                        finishing_round_selected=True)
 
-        return user.player
+        return player
 
     def get_context_data(self, **kwargs):
         # first get language
         lang = get_language()
         # Call the base implementation first to get a context
-        instructions = Instruction.objects.get(treatment=self.request.user.player.session.treatment, lang=lang)
+        instructions = Instruction.objects.get(treatment_id=get_player(self.request).session.treatment_id, lang=lang)
         context = super(InstructionsView, self).get_context_data(**kwargs)
         page = self.request.GET.get('page')
         instructions_pages = instructions.text.split("[PAGE]")
@@ -183,83 +170,103 @@ class TestView(LoginRequiredMixin, generic.FormView):
         # This method is called when valid form data has been POSTed.
         # It should return an HttpResponse.
         return HttpResponseRedirect(
-            reverse_lazy('experiments:results_round', kwargs={'session_id': self.request.user.player.session_id}))
+            reverse_lazy('experiments:results_round', kwargs={'session_id': get_player(self.request).session_id}))
 
     def get_context_data(self, **kwargs):
         # Call the base implementation first to get a context
-        participant = get_object_or_404(Player, pk=self.request.user.id)
+        participant = get_player(self.request)
         context = super(TestView, self).get_context_data(**kwargs)
         Profile.objects.filter(player=participant).update(experiment_state=Constants.STATE_TEST,
                                                           transition_state=Constants.STATE_NO_TRANSITION)
         self.request.session['experiment_state'] = Constants.STATE_TEST
-        self.request.session.save()
 
         return context
 
 
-def get_monitor_name(monitors, g_round):
+def check_barrier(player, phase, g_round):
+    """
+    Checks the condition of the monitor in which the player is waiting. If all active members
+    of the group are in the queue, the player is signaled and the accounts are updated.
+    :param player: Player object
+    :param phase: phase of the monitor (queue) in which the player waits
+    :param g_round: round of the monitor
+    :return: (boolean) True if the player can continue
+    """
     try:
-        monitors.all().get(name=Constants.MONITOR_S4)
-    except RequestMonitor.DoesNotExist:
-        try:
-            return monitors.filter(name__iregex=r"\ymonitorS{0}r{1}\y".format('[2-3]', g_round)).order_by('-name')[
-                0].name
-        except IndexError:
-            raise
-    else:
-        return Constants.MONITOR_S4
+        with routers.atomic():
+
+            can_continue = RequestMonitor.check_condition(player.group, phase, g_round,
+                                                          lambda x: Profile.objects.filter(
+                                                              group_number=player.profile.group_number,
+                                                              player__experiment=player.experiment,
+                                                              player__session=player.session,
+                                                              player__user__is_active=True).count() == x, True)
+
+            if can_continue:
+                # First signal the player
+                RequestMonitor.signal(player, phase=phase, g_round=g_round)
+                # then update the accounts info on GameData with the running total of the group
+                public_account = Group.objects.filter(pk=player.group_id).values_list('public_account',
+                                                                                      flat=True).get()
+                GameData.objects.filter(player=player, session=player.session, round=player.profile.last_round,
+                                        group=player.group).update(public_account=public_account,
+                                                                   time_updated=timezone.now())
+    except DatabaseError:
+        can_continue = False
+        logger.error("[Player {}] Database error on wait".format(player.pk))
+
+    return can_continue
+
+
+def notify_group(player, phase, g_round=0):
+    """Wakes up the members of the player's group that are blocked on sync_view on the barrier"""
+    try:
+        get_notifier().notify(group_channel(player.group, phase, g_round))
+    except DatabaseError:
+        logger.error("[Player {}] could not notify the group".format(player.pk))
 
 
 @login_required(login_url=reverse_lazy('experiments:login'))
 def sync_view(request, *args, **kwargs):
-    """Check monitor condition and set players on the correct queue"""
-    player = get_object_or_404(Player, pk=request.user.id)
+    """
+    Check monitor condition and set players on the correct queue.
+    If the request contains long_poll, the view blocks (at most EXPERIMENTS_SYNC_TIMEOUT seconds)
+    until the group notifier wakes it up and the player can continue. The barrier is only checked
+    again when the notifier publishes an event of its own barrier, and the database connections are
+    released while the request waits.
+    """
+    player = get_player(request)
     # First check in which queue is the player
+    monitor_keys = RequestMonitor.queues_of(player)
     try:
-        monitor_name = player.monitors.all()[0].name
+        phase, g_round = monitor_keys[0]
     except IndexError:
         logger.exception("[ERROR] Player {} is not in a queue!".format(player))
         raise IndexError
     else:
         # We check if the player is in more than one monitor, in which case we get the one for the correct round
-        if player.monitors.all().count() > 1:
+        if len(monitor_keys) > 1:
             logger.warning("[WARNING] Player {} is in more than one queue!".format(player))
             try:
-                monitor_name = get_monitor_name(player.monitors, player.profile.last_round)
+                phase, g_round = get_monitor_key(monitor_keys, player.profile.last_round)
             except IndexError:
                 logger.error("[ERROR] No monitors follow the pattern requested!")
-                monitor_name = player.monitors.all()[0].name
-
-    try:
-        with transaction.atomic():
 
-            can_continue = RequestMonitor.check_condition(player.group, monitor_name,
-                                                          lambda x: Profile.objects.filter(
-                                                              group_number=player.profile.group_number,
-                                                              player__experiment=player.experiment,
-                                                              player__session=player.session,
-                                                              player__user__is_active=True).count() == x, True)
-
-            if can_continue:
-                # First signal the player
-                RequestMonitor.signal(player, monitor_name=monitor_name)
-                game = CollectiveRiskGame.objects.get(id=player.session.treatment.game.id)
-                # then update the accounts info on GameData (public_account = total_group_end - sum(private_accounts))
-                accounts_info = Profile.objects.filter(
-                    player__group=player.group,
-                    player__experiment=player.experiment,
-                    player__session=player.session,
-                    player__user__is_active=True).aggregate(
-                    public_account=Count('player') * game.endowment - Sum('private_account',
-                                                                          output_field=IntegerField()))
-                # update game data
-                GameData.objects.filter(player=player, session=player.session, round=player.profile.last_round,
-                                        group=player.group).update(public_account=accounts_info['public_account'])
-                # update group public_account
-                Group.objects.filter(pk=player.group.pk).update(public_account=accounts_info['public_account'])
-    except DatabaseError:
-        can_continue = False
-        logger.error("[Player {}] Database error on wait".format(player.pk))
+    timeout = getattr(settings, 'EXPERIMENTS_SYNC_TIMEOUT', 25) if request.POST.get('long_poll') else 0
+    deadline = time.monotonic() + timeout
+    notifier = get_notifier()
+    channel = group_channel(player.group, phase, g_round)
+    with notifier.subscribe(channel):
+        while True:
+            # read the version before checking, so that a notification sent in between is not lost
+            version = notifier.version(channel)
+            can_continue = check_barrier(player, phase, g_round)
+            remaining = deadline - time.monotonic()
+            if can_continue or remaining <= 0:
+                break
+            release_connections()
+            if not notifier.wait(channel, version, remaining):
+                break
 
     response_data = {
         'session_id': player.session.id,
@@ -274,20 +281,16 @@ def sync_view(request, *args, **kwargs):
 @login_required(login_url=reverse_lazy('experiments:login'))
 @check_game_finished()
 @check_experiment_state(sender=[Constants.STATE_TEST, Constants.STATE_GAME_S3, Constants.STATE_GAME_S2])
+@check_transition(target=Constants.STATE_GAME_S2)
 def game_view(request, *args, **kwargs):
     """Defines the game view"""
-    player = get_object_or_404(Player, pk=request.user.id)
+    player = get_player(request)
 
-    RequestMonitor.check_condition(group=player.group,
-                                   monitor_name="{}r{}".format(Constants.MONITOR_S2, player.profile.last_round),
+    RequestMonitor.check_condition(group=player.group, phase=Constants.MONITOR_PHASE_S2,
+                                   g_round=player.profile.last_round,
                                    condition=lambda x: x == 0, update_value=False)
 
-    Profile.objects.filter(player=player).update(experiment_state=Constants.STATE_GAME_S2,
-                                                 transition_state=Constants.STATE_NO_TRANSITION)
-    request.session['experiment_state'] = Constants.STATE_GAME_S2
-    request.session.save()
-
-    game = CollectiveRiskGame.objects.get(id=player.session.treatment.game.id)
+    game = get_game(player)
     if player.profile.last_round > 1:
         last_round_actions_others = player.get_last_round_actions_others()
         player_last_action = player.get_last_round_action()
@@ -325,28 +328,33 @@ def game_view(request, *args, **kwargs):
 @check_experiment_state(sender=[Constants.STATE_GAME_S2])
 def finish_round_view(request, *args, **kwargs):
     """Defines the view that transitions between the game view (S2) and the results view (S3)"""
-    player = get_object_or_404(Player, pk=request.user.id)
+    player = get_player(request)
     if player.profile.transition_state != Constants.STATE_TRANSITION_S3:
         try:
-            with transaction.atomic():
-                game_data, created = GameData.objects.get_or_create(player=player, session=player.session,
-                                                                    opponent=player,
-                                                                    round=player.profile.last_round,
-                                                                    group=player.group)
-                if created:
-                    # First update game data
-                    game_data.action = request.POST['action']
-                    game_data.private_account = player.profile.private_account - int(request.POST['action'])
-                    game_data.time_round_start = request.POST['time_round_start']
-                    game_data.time_round_ends = request.POST['time_round_end']
-                    game_data.time_elapsed = request.POST['time_elapsed']
-                    game_data.save()
-                    # Then update player profile
-                    Profile.objects.filter(player=player).update(
-                        private_account=F('private_account') - int(request.POST['action']),
-                        transition_state=Constants.STATE_TRANSITION_S3)
-
+            with routers.atomic():
+                action = int(request.POST['action'])
+                # the action of the round is made once: only the request that finds the profile still on
+                # the round (and not already in the transition) updates it, the others update nothing
+                claimed = Profile.objects.filter(
+                    pk=player.profile.pk, experiment_state=Constants.STATE_GAME_S2,
+                    last_round=player.profile.last_round).exclude(
+                    transition_state=Constants.STATE_TRANSITION_S3).update(
+                    private_account=F('private_account') - action, transition_state=Constants.STATE_TRANSITION_S3)
+                if claimed:
+                    # (player, session, round) is unique, an action already recorded rolls all of it back
+                    GameData.objects.create(player=player, session=player.session, opponent=player,
+                                            round=player.profile.last_round, group=player.group, action=action,
+                                            private_account=player.profile.private_account - action,
+                                            time_round_start=request.POST['time_round_start'],
+                                            time_round_ends=request.POST['time_round_end'],
+                                            time_elapsed=request.POST['time_elapsed'])
+                    # and the running totals of the group
+                    Group.add_contribution(player.group_id, player.profile.last_round, action)
+        except IntegrityError:
+            logger.info("[Player {}] action of round {} already recorded".format(player.pk,
+                                                                                 player.profile.last_round))
         except DatabaseError:
+            record_retry(request)
             # if there is an error send participant back to the previous view
             logger.error("[Player {}] Database error on finish_round_view".format(player.pk))
             return HttpResponseRedirect(
@@ -359,12 +367,11 @@ def finish_round_view(request, *args, **kwargs):
 
     # otherwise send participant to the wait view
     try:
-        RequestMonitor.wait(player, monitor_name="{}r{}".format(Constants.MONITOR_S3, player.profile.last_round))
+        RequestMonitor.wait(player, phase=Constants.MONITOR_PHASE_S3, g_round=player.profile.last_round)
+        notify_group(player, Constants.MONITOR_PHASE_S3, player.profile.last_round)
     except DatabaseError:
+        record_retry(request)
         logger.error("[Player {}] did not wait on monitor".format(player.pk))
-    except RequestMonitor.DoesNotExist:
-        logger.exception("[Player {0}] did not wait on monitor {1}r{2}".format(player.pk, Constants.MONITOR_S3,
-                                                                               player.profile.last_round))
     return render(request, 'experiments/wait.html', {
         'session_id': player.session.id,
         'next': reverse("experiments:results", kwargs={'session_id': player.session.id}),
@@ -378,33 +385,40 @@ def finish_round_view(request, *args, **kwargs):
 def finish_results_view(request, *args, **kwargs):
     """Defines the view that transitions between the results view (S3) and the game view (S2)"""
     finished_game = False
-    player = get_object_or_404(Player, pk=request.user.id)
+    player = get_player(request)
 
     if player.profile.transition_state != Constants.STATE_TRANSITION_S2:
         try:
-            with transaction.atomic():
-                if player.profile.experiment_state == Constants.STATE_GAME_S3:
-                    game_data, created = GameData.objects.get_or_create(player=player, session=player.session,
-                                                                        opponent=player,
-                                                                        round=player.profile.last_round,
-                                                                        group=player.group)
-                    game_data.prediction_question = request.POST['prediction']
-                    game_data.time_question_start = request.POST['time_round_start']
-                    game_data.time_question_end = request.POST['time_round_end']
-                    game_data.time_question_elapsed = request.POST['time_elapsed']
-                    game_data.save()
-
-                    if created:
+            with routers.atomic():
+                # players never acquire the previous state: only the request that finds the profile still on
+                # the round moves it to the next one, the others (double submissions, other tabs) update nothing
+                advanced = Profile.objects.filter(
+                    pk=player.profile.pk, experiment_state=player.profile.experiment_state,
+                    last_round=player.profile.last_round).exclude(
+                    transition_state=Constants.STATE_TRANSITION_S2).update(
+                    last_round=F('last_round') + 1, transition_state=Constants.STATE_TRANSITION_S2)
+                if advanced and player.profile.experiment_state == Constants.STATE_GAME_S3:
+                    prediction = {
+                        'prediction_question': request.POST['prediction'],
+                        'time_question_start': request.POST['time_round_start'],
+                        'time_question_end': request.POST['time_round_end'],
+                        'time_question_elapsed': request.POST['time_elapsed'],
+                        'time_updated': timezone.now(),
+                    }
+                    if not GameData.objects.filter(player=player, session=player.session,
+                                                   round=player.profile.last_round).update(**prediction):
                         logger.error(
                             "[player {}]:Game data created on S3 and not S2 (when making an action)".format(player.pk))
+                        GameData.objects.create(player=player, session=player.session, opponent=player,
+                                                round=player.profile.last_round, group=player.group, **prediction)
 
-                    game = CollectiveRiskGame.objects.get(id=player.session.treatment.game.id)
+                    game = get_game(player)
                     finished_game = check_game_has_finished(player, game)
-
-                # I must check that players never acquire the previous state
-                Profile.objects.filter(player=player).update(last_round=F('last_round') + 1,
-                                                             transition_state=Constants.STATE_TRANSITION_S2)
+                elif not advanced:
+                    # the round was finished by another request of the participant
+                    finished_game = Group.objects.filter(pk=player.group_id, game_finished=True).exists()
         except DatabaseError:
+            record_retry(request)
             logger.error("[Player {}] Database error on finish_results_view".format(player.pk))
             # if there is an error go back to the previous view
             return HttpResponseRedirect(
@@ -421,12 +435,11 @@ def finish_results_view(request, *args, **kwargs):
     else:
         try:
             player.profile.refresh_from_db()
-            RequestMonitor.wait(player, monitor_name="{}r{}".format(Constants.MONITOR_S2, player.profile.last_round))
+            RequestMonitor.wait(player, phase=Constants.MONITOR_PHASE_S2, g_round=player.profile.last_round)
+            notify_group(player, Constants.MONITOR_PHASE_S2, player.profile.last_round)
         except DatabaseError:
+            record_retry(request)
             logger.error("[Player {}] did not wait on monitor".format(player.pk))
-        except RequestMonitor.DoesNotExist:
-            logger.exception("[Player {0}] did not wait on monitor {1}r{2}".format(player.pk, Constants.MONITOR_S2,
-                                                                                   player.profile.last_round))
         return render(request, 'experiments/wait.html', {
             'session_id': player.session.id,
             'next': reverse("experiments:game", kwargs={'session_id': player.session.id}),
@@ -437,19 +450,16 @@ def finish_results_view(request, *args, **kwargs):
 @login_required(login_url=reverse_lazy('experiments:login'))
 @check_game_finished()
 @check_experiment_state(sender=[Constants.STATE_GAME_S2, Constants.STATE_GAME_S3])
+@check_transition(target=Constants.STATE_GAME_S3)
 def results_view(request, *args, **kwargs):
     """Defines the view where participants can see the results of the round"""
-    player = get_object_or_404(Player, pk=request.user.id)
-    Profile.objects.filter(player=player).update(experiment_state=Constants.STATE_GAME_S3,
-                                                 transition_state=Constants.STATE_NO_TRANSITION)
-    request.session['experiment_state'] = Constants.STATE_GAME_S3
-    request.session.save()
-
-    RequestMonitor.check_condition(group=player.group,
-                                   monitor_name="{}r{}".format(Constants.MONITOR_S3, player.profile.last_round),
+    player = get_player(request)
+
+    RequestMonitor.check_condition(group=player.group, phase=Constants.MONITOR_PHASE_S3,
+                                   g_round=player.profile.last_round,
                                    condition=lambda x: x == 0, update_value=False)
 
-    game = CollectiveRiskGame.objects.get(id=player.session.treatment.game.id)
+    game = get_game(player)
 
     dice_result = -1
     show_dice_result = False
@@ -482,7 +492,6 @@ def results_view(request, *args, **kwargs):
     })
 
 
-@transaction.atomic
 def check_game_has_finished(player, game):
     """
     Checks if the game has finished
@@ -492,15 +501,17 @@ def check_game_has_finished(player, game):
     """
     finished_game = False
 
-    # Check if game has finished
-    if game.is_round_variable:
-        # Check if game already finished
-        if player.group.finishing_round <= player.profile.last_round:
+    with routers.atomic():
+        # Check if game has finished
+        if game.is_round_variable:
+            # Check if game already finished
+            if player.group.finishing_round <= player.profile.last_round:
+                finished_game = True
+                Group.objects.filter(pk=player.group.pk).update(game_finished=True)
+        elif game.rounds <= player.profile.last_round:
             finished_game = True
-            Group.objects.filter(pk=player.group.pk).update(game_finished=True)
-    elif game.rounds <= player.profile.last_round:
-        finished_game = True
-        Group.objects.filter(pk=player.group.pk).update(finishing_round=player.profile.last_round, game_finished=True)
+            Group.objects.filter(pk=player.group.pk).update(finishing_round=player.profile.last_round,
+                                                            game_finished=True)
 
     return finished_game
 
@@ -510,12 +521,14 @@ def check_game_has_finished(player, game):
 @check_experiment_state(sender=[Constants.STATE_GAME_S3])
 def transition_risk(request, *args, **kwargs):
     """Defines the view that transitions between the results view (S3) and the game view (S2)"""
-    player = get_object_or_404(Player, pk=request.user.id)
+    player = get_player(request)
     Profile.objects.filter(player=player).update(transition_state=Constants.STATE_TRANSITION_S4)
 
     try:
-        RequestMonitor.wait(player, monitor_name=Constants.MONITOR_S4)
+        RequestMonitor.wait(player, phase=Constants.MONITOR_PHASE_S4)
+        notify_group(player, Constants.MONITOR_PHASE_S4)
     except DatabaseError:
+        record_retry(request)
         logger.error("[Player {}] did not wait on monitor".format(player.pk))
     return render(request, 'experiments/wait.html', {
         'session_id': player.session.id,
@@ -527,41 +540,33 @@ def transition_risk(request, *args, **kwargs):
 @login_required(login_url=reverse_lazy('experiments:login'))
 @check_game_finished()
 @check_experiment_state(sender=[Constants.STATE_GAME_S3, Constants.STATE_GAME_S4])
+@check_transition(target=Constants.STATE_GAME_S4)
 def check_threshold_view(request, *args, **kwargs):
-    player = get_object_or_404(Player, pk=request.user.id)
-    Profile.objects.filter(player=player).update(experiment_state=Constants.STATE_GAME_S4,
-                                                 transition_state=Constants.STATE_NO_TRANSITION)
+    player = get_player(request)
 
     # reinitialize monitor
-    RequestMonitor.check_condition(group=player.group, monitor_name=Constants.MONITOR_S4,
+    RequestMonitor.check_condition(group=player.group, phase=Constants.MONITOR_PHASE_S4, g_round=0,
                                    condition=lambda x: x == 0, update_value=False)
 
     # first we get the game object
-    game = CollectiveRiskGame.objects.get(id=player.session.treatment.game.id)
-
-    # then we check how much was accumulated in the public account
-    # for that we check the private account of all members of the group
-    accounts_info = Profile.objects.filter(
-        group_number=player.profile.group_number,
-        player__experiment=player.experiment,
-        player__session=player.session,
-        player__user__is_active=True).aggregate(
-        public_account=Count('player') * game.endowment - Sum('private_account', output_field=IntegerField()))
+    game = get_game(player)
 
     # check whether the random value has been generated
     try:
-        with transaction.atomic():
+        with routers.atomic():
             if not player.group.random_value_generated:
                 Group.objects.filter(pk=player.group.pk).update(random_value=random.rand(), random_value_generated=True)
     except DatabaseError:
+        record_retry(request)
         logger.error("[Player {}] did not set group random value correctly!".format(player.pk))
 
-    player.group.refresh_from_db()
+    # then we check how much was accumulated in the public account (kept up to date on each contribution)
+    player.group.refresh_from_db(fields=['public_account', 'random_value'])
     random_value = player.group.random_value
     risk = game.risk_prob
     gain_emus = player.profile.private_account
     # Now compare it to the threshold
-    if accounts_info['public_account'] < game.threshold:
+    if player.group.public_account < game.threshold:
         # throw the dice to decide if everybody loses everything
         if random_value < game.risk_prob:
             # Return loss phrase
@@ -585,7 +590,7 @@ def check_threshold_view(request, *args, **kwargs):
         'risk': risk,
         'random_value': floor(random_value * 100) + 1,
         'threshold': game.threshold,
-        'public_account': accounts_info['public_account'],
+        'public_account': player.group.public_account,
         'gain': {
             'emus': gain_emus,
             'euros': gain_emus * game.conversion_rate + 2.5
@@ -604,7 +609,7 @@ class UserInfoView(LoginRequiredMixin, generic.FormView):
         # This method is called when valid form data has been POSTed
         # It should return and HttpResponse
         obj = form.save(commit=False)
-        obj.player = self.request.user.player
+        obj.player = get_player(self.request)
         try:
             survey = Survey.objects.get(player=obj.player)
         except Survey.DoesNotExist:
@@ -612,12 +617,12 @@ class UserInfoView(LoginRequiredMixin, generic.FormView):
         return super(UserInfoView, self).form_valid(form)
 
     def get_success_url(self):
-        participant = get_object_or_404(Player, pk=self.request.user.id)
+        participant = get_player(self.request)
         return reverse_lazy('experiments:thanks', kwargs={'session_id': participant.session.id})
 
     def get_context_data(self, **kwargs):
         # Call the base implementation first to get a context
-        participant = get_object_or_404(Player, pk=self.request.user.id)
+        participant = get_player(self.request)
         context = super(UserInfoView, self).get_context_data(**kwargs)
         context['title'] = 'Experiments admin'
         Profile.objects.filter(player=participant).update(experiment_state=Constants.STATE_QUIZ)
@@ -631,7 +636,7 @@ class ThanksView(LoginRequiredMixin, generic.ListView):
     login_url = reverse_lazy('experiments:login')
 
     def get_queryset(self):
-        player = get_object_or_404(Player, pk=self.request.user.id)
+        player = get_player(self.request)
         Profile.objects.filter(player=player).update(experiment_state=Constants.STATE_FINISH, finished=True,
                                                      time_ends_experiment=timezone.now())
         self.request.session['experiment_state'] = Constants.STATE_FINISH
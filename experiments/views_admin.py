@@ -1,14 +1,23 @@
+import datetime
+
+from django.conf import settings
 from django.contrib.admin.views.decorators import staff_member_required
-from django.http import JsonResponse
+from django.db.models import Sum, Count
+from django.http import JsonResponse, HttpResponseBadRequest, Http404
 from django.urls import reverse_lazy, reverse
+from django.utils import timezone
 from django.utils.decorators import method_decorator
 from django.views import generic
 from django.views.generic.edit import FormView
 
+from . import config
+from .dashboard import get_session_groups
 from .forms import RunNowForm
+from .middleware import metrics
 from .models import (
-    Experiment, RunNow, Player, Session, Group, CollectiveRiskGame, GameData,
+    RunNow, Player, Session, GameData,
 )
+from .watchdog import get_report
 
 
 class BaseAdminExperimentView(generic.TemplateView):
@@ -36,18 +45,29 @@ class ExperimentsAdminView(BaseAdminExperimentView, FormView):
     form_class = RunNowForm
     success_url = reverse_lazy('experiments:admin')
 
+    def get_run(self):
+        """:returns RunNow - run selected with the session_id parameter (the first run by default)"""
+        session_id = self.request.POST.get('session_id') or self.request.GET.get('session_id')
+        try:
+            if session_id:
+                return RunNow.objects.get(session_id=int(session_id))
+            return config.get_run_now()
+        except (ValueError, RunNow.DoesNotExist):
+            return None
+
     def get_context_data(self, **kwargs):
         # Call the base implementation first to get a context
         context = super(ExperimentsAdminView, self).get_context_data(**kwargs)
-        # Add in the publisher
-        context['run_now'] = RunNow.objects.all()[0]
-        # Get players for current experiment
-        run_now = RunNow.objects.all()[0]
-        experiment = Experiment.objects.get(pk=run_now.experiment_id)
-        session = Session.objects.get(pk=run_now.session_id)
-        players = Player.objects.filter(experiment=experiment, session=session, user__is_active=True)
-        context['players'] = players
-        context['session'] = session
+        # all the sessions that are being run, and the players of the selected one
+        context['runs'] = RunNow.objects.order_by('pk')
+        run_now = self.get_run()
+        context['run_now'] = run_now
+        if run_now is not None:
+            experiment = config.get_experiment(run_now.experiment_id)
+            session = config.get_session(run_now.session_id)
+            players = Player.objects.filter(experiment=experiment, session=session, user__is_active=True)
+            context['players'] = players
+            context['session'] = session
         context['title'] = 'Experiments admin'
         return context
 
@@ -63,8 +83,12 @@ class ExperimentsAdminView(BaseAdminExperimentView, FormView):
         """
         if form_class is None:
             form_class = self.get_form_class()
-        run_now = RunNow.objects.all()[0]
-        return form_class(**self.get_form_kwargs(), instance=run_now)
+        # the run of the session is updated if it exists, otherwise a new run is added
+        return form_class(**self.get_form_kwargs(), instance=self.get_run())
+
+    def get_success_url(self):
+        return '{}?session_id={}'.format(super(ExperimentsAdminView, self).get_success_url(),
+                                         self.request.POST.get('session_id'))
 
 
 class AjaxableResponseMixin(object):
@@ -98,27 +122,30 @@ class SessionGameView(BaseAdminExperimentView):
     template_name = 'experiments/admin/monitor.html'
     context_object_name = 'groups'
 
+    def get_session(self):
+        try:
+            return config.get_session(int(self.kwargs['session_id']))
+        except Session.DoesNotExist:
+            raise Http404("Session {} does not exist".format(self.kwargs['session_id']))
+
     def get_context_data(self, **kwargs):
         # Call the base implementation first to get a context
         context = super(SessionGameView, self).get_context_data(**kwargs)
-        # Add in the publisher
-        context['run_now'] = RunNow.objects.all()[0]
-        # Get players for current experiment session
-        run_now = RunNow.objects.all()[0]
-        experiment = Experiment.objects.get(pk=run_now.experiment_id)
-        session = Session.objects.get(pk=run_now.session_id)
+        session = self.get_session()
+        context['run_now'] = config.get_run(session.id)
+        # Get players for the session
+        experiment = config.get_experiment(session.experiment_id)
+        game = config.get_session_game(session.id)
         context['experiment'] = experiment
         context['session'] = session
         players = Player.objects.filter(experiment=experiment, session=session, user__is_active=True)
         context['players'] = players
         # Get groups for current session
-        groups = Group.objects.filter(session=session).order_by('group_number')
-        # for group in groups:
-        #     group.members = group.members.filter(user__is_active=True)
-        context['groups'] = groups
-        context['threshold'] = CollectiveRiskGame.objects.get(id=session.treatment.game.id).threshold
+        context['groups'] = get_session_groups(session, game)
+        context['watchdog'] = get_report(session.id)
+        context['threshold'] = game.threshold
         context['title'] = 'Monitor session'
-        context['deadline_variable'] = CollectiveRiskGame.objects.get(id=session.treatment.game.id).is_round_variable
+        context['deadline_variable'] = game.is_round_variable
         return context
 
 
@@ -126,25 +153,111 @@ class GraphView(SessionGameView):
     template_name = 'experiments/admin/visualize_session.html'
     context_object_name = 'groups'
 
+    def get_context_data(self, **kwargs):
+        # the graph doesn't show the groups, skip SessionGameView's query
+        context = super(SessionGameView, self).get_context_data(**kwargs)
+        context['session'] = self.get_session()
+        context['run_now'] = config.get_run(context['session'].id)
+        context['title'] = 'Monitor session'
+        return context
+
+
+@staff_member_required(login_url=reverse_lazy('experiments:login_admin'))
+def fetch_monitor_data(request, session_id):
+    """
+    Returns the state of the groups of the session in json format (used by the monitor to refresh itself).
+    :param request:
+    :param session_id: id of the session
+    :return:
+    """
+    try:
+        session = config.get_session(int(session_id))
+    except Session.DoesNotExist:
+        raise Http404("Session {} does not exist".format(session_id))
+    game = config.get_session_game(session.id)
+    data = {
+        'session': session.id,
+        'threshold': game.threshold,
+        'deadline_variable': game.is_round_variable,
+        'groups': get_session_groups(session, game),
+        'watchdog': get_report(session.id),
+    }
+    return JsonResponse(data)
+
+
+@staff_member_required(login_url=reverse_lazy('experiments:login_admin'))
+def fetch_metrics(request):
+    """
+    Returns the metrics of the requests served by this process in the last EXPERIMENTS_METRICS_WINDOW
+    seconds in json format: per view and experiment state, the number of queries, the database and
+    wall time percentiles and histograms, and the transaction retries (see experiments.middleware).
+    :param request:
+    :return:
+    """
+    return JsonResponse({'window': metrics.window, 'views': metrics.summary()})
+
+
+def aggregate_game_data(game_data):
+    """
+    :param game_data: GameData queryset
+    :return: list - total contribution and number of players that played of each group and round
+    """
+    return list(game_data.order_by().values('group__group_number', 'round').annotate(
+        contributions=Sum('action'), players=Count('id')).order_by('group__group_number', 'round'))
 
+
+@staff_member_required(login_url=reverse_lazy('experiments:login_admin'))
 def fetch_session_data(request):
     """
     First checks whether we have the correct admin permissions,
-    then returns the data of the session in json format.
+    then returns the data of the session modified since the last call in json format:
+    - game_data: rows updated after the since parameter (a timestamp, all rows if it is missing). The
+      rows are written in transactions that commit after their update time, so the rows updated in
+      the EXPERIMENTS_MONITOR_LAG seconds before since are sent again: the client replaces the rows
+      it already has by id.
+    - totals: contribution of each group in the rounds of these rows. They are recomputed from all
+      the rows of those rounds, so they replace the totals previously received for the same rounds.
+    - cursor: time of the call, to be used as the since parameter of the next call
+    The session_id parameter selects the session (the first run by default) and the group_number
+    parameter restricts the data to one group.
     :param request:
     :return:
     """
-    # get resource value
-    group_number = request.GET.get('group_number', 0)
+    cursor = timezone.now()
+    try:
+        since = float(request.GET.get('since', 0))
+        session_id = request.GET.get('session_id')
+        session_id = int(session_id) if session_id not in (None, '') else config.get_run_now().session_id
+        group_number = request.GET.get('group_number')
+        group_number = int(group_number) if group_number not in (None, '') else None
+    except ValueError:
+        return HttpResponseBadRequest("since must be a timestamp, session_id and group_number integers")
+
+    try:
+        session = config.get_session(session_id)
+    except Session.DoesNotExist:
+        raise Http404("Session {} does not exist".format(session_id))
+    game_data = GameData.objects.filter(session=session)
+    if group_number is not None:
+        game_data = game_data.filter(group__group_number=group_number)
+    if since > 0:
+        lag = datetime.timedelta(seconds=getattr(settings, 'EXPERIMENTS_MONITOR_LAG', 10))
+        updated_since = datetime.datetime.fromtimestamp(since, datetime.timezone.utc) - lag
+        game_data_since = game_data.filter(time_updated__gte=updated_since)
+    else:
+        game_data_since = game_data
+    new_data = list(game_data_since.order_by('id').values())
 
-    # get current session
-    run_now = RunNow.objects.all()[0]
-    experiment = Experiment.objects.get(pk=run_now.experiment_id)
-    session = Session.objects.get(pk=run_now.session_id)
-    game_data = GameData.objects.filter(session=session).order_by('round')
+    totals = []
+    if new_data:
+        groups = {row['group_id'] for row in new_data}
+        rounds = {row['round'] for row in new_data}
+        totals = aggregate_game_data(game_data.filter(group_id__in=groups, round__in=rounds))
 
     # prepare game data as json
     data = {
-        'game_data': list(game_data.values()),
+        'game_data': new_data,
+        'totals': totals,
+        'cursor': cursor.timestamp(),
     }
     return JsonResponse(data)
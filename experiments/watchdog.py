@@ -0,0 +1,258 @@
+# coding=utf-8
+# ==============================================================================
+# beelbe
+# Copyright © 2016 Elias F. Domingos. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Detects the participants that stall the barriers (RequestMonitor) of their group.
+
+A barrier only opens when every active member of the group is in its queue, so a single
+member in a wrong state blocks the whole group. The Watchdog scans the monitors of a session
+and reports the queue entries (and the members missing from a queue) that have been in the
+same state for more than EXPERIMENTS_WATCHDOG_STUCK_AFTER seconds, with their cause:
+- inactive_user: a deactivated user is in a queue, so the counter never equals the number
+  of active members. Repaired by removing the user from the queue.
+- multiple_queues: the player is in the queue of a monitor that is not the one of its current
+  round. Repaired by removing the player from that queue.
+- stale_transition: the transition_state of the player doesn't match the queue. Either the
+  player left the barrier without being signaled (repaired by removing it from the queue) or
+  it is waiting but its wait was never recorded (repaired by adding it to the queue).
+- missing_game_data: the player waits for the results of a round without an action stored.
+- not_responding: an active member never reached the barrier (e.g. the browser was closed).
+The last two need the experimenter and are only reported.
+
+The reports are stored in the Django cache selected by EXPERIMENTS_WATCHDOG_CACHE, shared by the
+watch_sessions management command and the server, where the admin monitor reads them.
+"""
+
+# import the logging library
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import timezone
+
+from .constants import Constants
+from .models import Player, GameData
+from .monitors import get_monitor_backend, get_monitor_key
+from .notifiers import get_notifier, group_channel
+
+# Get an instance of a logger
+logger = logging.getLogger(__name__)
+
+CAUSE_INACTIVE_USER = 'inactive_user'
+CAUSE_MULTIPLE_QUEUES = 'multiple_queues'
+CAUSE_STALE_TRANSITION = 'stale_transition'
+CAUSE_MISSING_GAME_DATA = 'missing_game_data'
+CAUSE_NOT_RESPONDING = 'not_responding'
+
+# transition state of the players waiting on each phase
+WAITING_TRANSITIONS = {
+    Constants.MONITOR_PHASE_S2: Constants.STATE_TRANSITION_S2,
+    Constants.MONITOR_PHASE_S3: Constants.STATE_TRANSITION_S3,
+    Constants.MONITOR_PHASE_S4: Constants.STATE_TRANSITION_S4,
+}
+
+REPORT_KEY = 'experiments:watchdog:{}'
+
+
+def _report_cache():
+    return caches[getattr(settings, 'EXPERIMENTS_WATCHDOG_CACHE', 'shared')]
+
+
+def store_report(report):
+    _report_cache().set(REPORT_KEY.format(report['session']), report, None)
+
+
+def get_report(session_id):
+    """:returns dict - last report of the watchdog on the session (None if it never ran)"""
+    return _report_cache().get(REPORT_KEY.format(session_id))
+
+
+class Issue(object):
+    """
+    Problem found on a queue entry, or on a member missing from a queue.
+    action is the repair that fixes it ('signal' or 'wait'), None when it can't be repaired.
+    """
+
+    def __init__(self, cause, player, group_id, group_number, phase, g_round, waited, detail, action=None):
+        self.cause = cause
+        self.player = player
+        self.group_id = group_id
+        self.group_number = group_number
+        self.phase = phase
+        self.round = g_round
+        self.waited = waited
+        self.detail = detail
+        self.action = action
+        self.repaired = False
+
+    def as_dict(self):
+        return {
+            'cause': self.cause,
+            'player': self.player,
+            'group_number': self.group_number,
+            'phase': self.phase,
+            'round': self.round,
+            'waited': round(self.waited, 1),
+            'detail': self.detail,
+            'repairable': self.action is not None,
+            'repaired': self.repaired,
+        }
+
+    def __str__(self):
+        return "[Player {}] group {} monitor ({}, {}): {} - {}".format(
+            self.player, self.group_number, self.phase, self.round, self.cause, self.detail)
+
+
+class Watchdog(object):
+    """
+    Scans the barriers of a session. The instance remembers when each queue entry was first
+    seen, so it must be kept between scans (a new instance considers every entry as new,
+    unless stuck_after is 0).
+    """
+
+    def __init__(self, stuck_after=None, repair=False, backend=None):
+        """
+        :param stuck_after: seconds after which a barrier that doesn't open is checked
+        :param repair: whether the repairable issues are fixed
+        :param backend: monitor backend (defaults to the one of the settings)
+        """
+        self.stuck_after = stuck_after if stuck_after is not None else getattr(
+            settings, 'EXPERIMENTS_WATCHDOG_STUCK_AFTER', 60)
+        self.repair = repair
+        self.backend = backend or get_monitor_backend()
+        # (player id, group id, phase, round) -> time.monotonic() when first seen
+        self._first_seen = {}
+
+    def _waited(self, key, now):
+        return now - self._first_seen.setdefault(key, now)
+
+    def scan(self, session, group_ids=None):
+        """
+        :param session: Session object
+        :param group_ids: only check these groups (all by default)
+        :return: dict - report with the issues found
+        """
+        now = time.monotonic()
+        monitors = [monitor for monitor in self.backend.session_monitors(session)
+                    if group_ids is None or monitor.group_id in group_ids]
+        players = {row['pk']: row for row in Player.objects.filter(session=session, group__isnull=False).values(
+            'pk', 'group_id', 'group__group_number', 'user__is_active', 'profile__last_round',
+            'profile__transition_state', 'profile__experiment_state')}
+
+        seen = {}
+        queues = {}
+        for monitor in monitors:
+            for player_id in monitor.queue:
+                key = (player_id, monitor.group_id, monitor.phase, monitor.round)
+                seen[key] = self._waited(key, now)
+                queues.setdefault(player_id, []).append((monitor.phase, monitor.round))
+        # a barrier that doesn't open for long is stalled, its oldest entry tells since when
+        for monitor in monitors:
+            if not monitor.condition and monitor.queue:
+                key = (None, monitor.group_id, monitor.phase, monitor.round)
+                seen[key] = self._waited(key, now)
+        self._first_seen = {key: self._first_seen[key] for key in seen}
+
+        stuck = [key for key, waited in seen.items() if key[0] is not None and waited >= self.stuck_after]
+        rounds_played = set(GameData.objects.filter(
+            session=session, player_id__in={key[0] for key in stuck if key[2] == Constants.MONITOR_PHASE_S3}
+        ).values_list('player_id', 'round')) if stuck else set()
+
+        issues = []
+        for player_id, group_id, phase, g_round in stuck:
+            player = players.get(player_id)
+            if player is None:
+                continue
+            issue = self._check_entry(player, queues[player_id], phase, g_round, rounds_played)
+            if issue is not None:
+                issues.append(Issue(issue[0], player_id, group_id, player['group__group_number'], phase, g_round,
+                                    seen[(player_id, group_id, phase, g_round)], *issue[1:]))
+
+        flagged = {(issue.player, issue.phase, issue.round) for issue in issues}
+        stalled = set()
+        for monitor in monitors:
+            waited = seen.get((None, monitor.group_id, monitor.phase, monitor.round))
+            if waited is None or waited < self.stuck_after:
+                continue
+            # nobody is waiting on a barrier that only holds wrong entries
+            if all((player_id, monitor.phase, monitor.round) in flagged for player_id in monitor.queue):
+                continue
+            stalled.add(monitor.group_id)
+            for player in players.values():
+                if player['group_id'] == monitor.group_id and player['user__is_active'] \
+                        and player['pk'] not in monitor.queue:
+                    issues.append(Issue(*self._check_missing(player, monitor, waited)))
+
+        if self.repair:
+            for issue in issues:
+                self._repair(issue)
+
+        for issue in issues:
+            logger.warning("[WATCHDOG] {}".format(issue))
+        return {
+            'session': session.pk,
+            'checked_at': timezone.now().isoformat(),
+            'waiting': sum(len(monitor.queue) for monitor in monitors),
+            'stalled_groups': sorted({player['group__group_number'] for player in players.values()
+                                      if player['group_id'] in stalled}),
+            'issues': [issue.as_dict() for issue in issues],
+        }
+
+    @staticmethod
+    def _check_entry(player, keys, phase, g_round, rounds_played):
+        """:returns (cause, detail, action) of a queue entry, None if it is consistent"""
+        if not player['user__is_active']:
+            return CAUSE_INACTIVE_USER, "the user is not active", 'signal'
+        try:
+            expected = get_monitor_key(keys, player['profile__last_round'])
+        except IndexError:
+            expected = None
+        if len(keys) > 1 and expected != (phase, g_round):
+            return CAUSE_MULTIPLE_QUEUES, "in {} queues, current round {}".format(
+                len(keys), player['profile__last_round']), 'signal'
+        if player['profile__transition_state'] != WAITING_TRANSITIONS[phase] or (
+                phase != Constants.MONITOR_PHASE_S4 and g_round != player['profile__last_round']):
+            return CAUSE_STALE_TRANSITION, "left the barrier without being signaled ({}, round {})".format(
+                player['profile__transition_state'], player['profile__last_round']), 'signal'
+        if phase == Constants.MONITOR_PHASE_S3 and (player['pk'], g_round) not in rounds_played:
+            return CAUSE_MISSING_GAME_DATA, "no action stored for round {}".format(g_round), None
+        return None
+
+    @staticmethod
+    def _check_missing(player, monitor, waited):
+        """:returns Issue arguments of an active member that is not in the queue of a stalled monitor"""
+        args = [player['pk'], monitor.group_id, player['group__group_number'], monitor.phase, monitor.round, waited]
+        if player['profile__transition_state'] == WAITING_TRANSITIONS[monitor.phase] and (
+                monitor.phase == Constants.MONITOR_PHASE_S4 or monitor.round == player['profile__last_round']):
+            return [CAUSE_STALE_TRANSITION] + args + ["waiting but not in the queue", 'wait']
+        return [CAUSE_NOT_RESPONDING] + args + ["{} on round {}".format(
+            player['profile__experiment_state'], player['profile__last_round'])]
+
+    def _repair(self, issue):
+        if issue.action is None:
+            return
+        player = Player.objects.only('group').get(pk=issue.player)
+        if issue.action == 'signal':
+            self.backend.signal(player, issue.phase, issue.round)
+        else:
+            self.backend.wait(player, issue.phase, issue.round)
+        issue.repaired = True
+        logger.info("[WATCHDOG] repaired {}".format(issue))
+        # the members blocked on sync_view check the barrier again
+        get_notifier().notify(group_channel(issue.group_id, issue.phase, issue.round))
+